@@ -3,14 +3,24 @@ from django.contrib import admin
 from .models import (
     Account,
     RequestCreateAccount,
+    AccountNumberCounter,
+    ExchangeRateVersion,
+    ExchangeRate,
     Replenishment,
     Transfer,
     Payment,
+    IdempotencyKey,
+    OutboxEvent,
 )
 
 
 admin.site.register(Account)
 admin.site.register(RequestCreateAccount)
+admin.site.register(AccountNumberCounter)
+admin.site.register(ExchangeRateVersion)
+admin.site.register(ExchangeRate)
 admin.site.register(Replenishment)
 admin.site.register(Transfer)
-admin.site.register(Payment)
\ No newline at end of file
+admin.site.register(Payment)
+admin.site.register(IdempotencyKey)
+admin.site.register(OutboxEvent)
@@ -0,0 +1,54 @@
+import time
+
+from django.core.cache import caches
+from django.db import transaction
+
+from apps.monitoring.metrics import registry, METRIC_LABELS
+
+ACCOUNTS_CACHE_ALIAS = 'accounts'
+
+METRIC_LABELS['account_list_cache_requests_total'] = ('result',)
+
+
+def _accounts_version_key(user_pk:int) -> str:
+    return 'accounts:version:{}'.format(user_pk)
+
+def _accounts_version(cache:object, user_pk:int) -> int:
+    """ Текущая версия списка счетов пользователя. Потерянная версия
+    создаётся заново из времени, чтобы не совпасть с прежними """
+    key = _accounts_version_key(user_pk)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+def _get_cached_accounts(user_pk:int, build) -> list:
+    """ Список счетов пользователя из кэша. При промахе список
+    строится функцией build и сохраняется под текущей версией, поэтому
+    данные, прочитанные до изменения счетов, не переживут инвалидацию """
+    cache = caches[ACCOUNTS_CACHE_ALIAS]
+    key = 'accounts:{}:{}'.format(user_pk, _accounts_version(cache, user_pk))
+    data = cache.get(key)
+    if data is not None:
+        registry.inc('account_list_cache_requests_total', ('hit',))
+        return data
+    registry.inc('account_list_cache_requests_total', ('miss',))
+    data = build()
+    cache.set(key, data)
+    return data
+
+def _bump_accounts_versions(user_pks:set) -> None:
+    cache = caches[ACCOUNTS_CACHE_ALIAS]
+    for user_pk in user_pks:
+        key = _accounts_version_key(user_pk)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), None)
+
+def _invalidate_accounts(*user_pks:int) -> None:
+    """ Сброс списков счетов пользователей после фиксации
+    текущей транзакции """
+    user_pks = set(user_pks)
+    transaction.on_commit(lambda: _bump_accounts_versions(user_pks))
@@ -0,0 +1,198 @@
+from decimal import Decimal
+import asyncio
+import io
+import json
+import logging
+import select
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, connection, connections, transaction
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from apps.monitoring.metrics import registry
+from .models import Account
+
+logger = logging.getLogger(__name__)
+
+# Метки переполнения очереди подписчика и отключения клиента
+OVERFLOW = object()
+DISCONNECT = object()
+
+
+class EventBroker:
+    """ Рассылка событий изменения балансов подписчикам процесса по pk
+    пользователя. Публиковать можно из любого потока, подписчик получает
+    события в очередь своего цикла событий. Переполненная очередь
+    очищается и получает метку OVERFLOW """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def subscribe(self, user_pk:int) -> asyncio.Queue:
+        queue = asyncio.Queue(settings.EVENTS_QUEUE_SIZE)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._subscribers.setdefault(user_pk, set()).add((loop, queue))
+            if settings.EVENTS_BACKEND == 'postgresql' and self._listener is None:
+                self._listener = threading.Thread(target=_listen_notifications, args=(self,), daemon=True)
+                self._listener.start()
+            registry.set('events_connections', (), sum(len(items) for items in self._subscribers.values()))
+        return queue
+
+    def unsubscribe(self, user_pk:int, queue:asyncio.Queue) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(user_pk, set())
+            subscribers.discard((asyncio.get_running_loop(), queue))
+            if not subscribers:
+                self._subscribers.pop(user_pk, None)
+            registry.set('events_connections', (), sum(len(items) for items in self._subscribers.values()))
+
+    def publish(self, events:list) -> None:
+        with self._lock:
+            targets = [(event, list(self._subscribers.get(event['user'], ()))) for event in events]
+        for event, subscribers in targets:
+            for loop, queue in subscribers:
+                loop.call_soon_threadsafe(_offer, queue, event)
+
+def _offer(queue:asyncio.Queue, event) -> None:
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(OVERFLOW)
+
+broker = EventBroker()
+
+def _publish_events(events:list) -> None:
+    """ Рассылка событий после фиксации текущей транзакции. С
+    EVENTS_BACKEND = 'postgresql' события уходят через NOTIFY и доходят
+    до подписчиков всех процессов, иначе только до подписчиков этого """
+    if settings.EVENTS_BACKEND == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload',
+                           [settings.EVENTS_CHANNEL, [json.dumps(event) for event in events]])
+        return
+    transaction.on_commit(lambda: broker.publish(events))
+
+def _listen_notifications(broker:EventBroker) -> None:
+    """ Передача уведомлений PostgreSQL в рассыльщик процесса. Поток держит
+    отдельное соединение с LISTEN и переподключается после ошибок; события,
+    пришедшие во время переподключения, клиенты восстанавливают по разрыву
+    смещений """
+    import psycopg2
+
+    while True:
+        try:
+            listener = psycopg2.connect(**connections['default'].get_connection_params())
+            listener.autocommit = True
+            with listener.cursor() as cursor:
+                cursor.execute('LISTEN {}'.format(settings.EVENTS_CHANNEL))
+            while True:
+                if select.select([listener], [], [], settings.EVENTS_KEEPALIVE_SECONDS) == ([], [], []):
+                    continue
+                listener.poll()
+                events = []
+                while listener.notifies:
+                    events.append(json.loads(listener.notifies.pop(0).payload))
+                if events:
+                    broker.publish(events)
+        except Exception:
+            logger.exception('Ошибка прослушивания канала %s', settings.EVENTS_CHANNEL)
+            time.sleep(1)
+
+def _authenticate(scope:dict):
+    """ Пользователь запроса по классам аутентификации DRF или None """
+    request = Request(ASGIRequest(scope, io.BytesIO()),
+                      authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    try:
+        user = request.user
+    except APIException:
+        return None
+    finally:
+        close_old_connections()
+    return user if user.is_authenticated else None
+
+def _accounts_snapshot(user_pk:int) -> list:
+    """ Балансы и смещения последних событий счетов пользователя """
+    try:
+        return list(Account.objects.filter(user_id=user_pk).order_by('id').values(
+            'id', 'number', 'balance', 'currency', 'event_offset'))
+    finally:
+        close_old_connections()
+
+def _sse(event:str, data, event_id:str=None) -> bytes:
+    lines = ['event: ' + event]
+    if event_id is not None:
+        lines.append('id: ' + event_id)
+    lines.append('data: ' + json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False))
+    return ('\n'.join(lines) + '\n\n').encode()
+
+async def _wait_disconnect(receive, queue:asyncio.Queue) -> None:
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    while True:
+        try:
+            queue.put_nowait(DISCONNECT)
+            return
+        except asyncio.QueueFull:
+            queue.get_nowait()
+
+async def events_application(scope:dict, receive, send) -> None:
+    """ ASGI-приложение потока событий Server-Sent Events. Клиент получает
+    снимок счетов (snapshot), затем по событию operation на каждое
+    изменение баланса с новым балансом счёта. При разрыве смещений,
+    новом счёте или переполнении очереди приходит reset, и поток
+    закрывается; после переподключения клиент получит новый снимок.
+    Ожидающее соединение занимает только сопрограмму и очередь """
+    user = await sync_to_async(_authenticate, thread_sensitive=False)(scope)
+    if user is None:
+        await send({'type': 'http.response.start', 'status': 401,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body',
+                    'body': json.dumps({'detail': 'Учетные данные не были предоставлены.'}).encode()})
+        return
+    queue = broker.subscribe(user.pk)
+    watcher = asyncio.ensure_future(_wait_disconnect(receive, queue))
+    try:
+        accounts = await sync_to_async(_accounts_snapshot, thread_sensitive=False)(user.pk)
+        state = {account['id']: (account['event_offset'], account['balance']) for account in accounts}
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        await send({'type': 'http.response.body', 'body': _sse('snapshot', accounts), 'more_body': True})
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), settings.EVENTS_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+                continue
+            if event is DISCONNECT:
+                return
+            offset, balance = state.get(event['account'], (None, None)) if event is not OVERFLOW else (None, None)
+            if offset is not None and event['offset'] <= offset:
+                continue
+            if offset is None or event['offset'] != offset + 1:
+                await send({'type': 'http.response.body', 'body': _sse('reset', {}), 'more_body': True})
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            balance += Decimal(event['amount'])
+            state[event['account']] = (event['offset'], balance)
+            data = dict(event, balance=balance)
+            del data['user']
+            await send({'type': 'http.response.body', 'more_body': True, 'body': _sse(
+                'operation', data, '{}:{}'.format(event['account'], event['offset']))})
+    finally:
+        watcher.cancel()
+        broker.unsubscribe(user.pk, queue)
@@ -0,0 +1,99 @@
+from decimal import Decimal, Context, ROUND_HALF_EVEN
+from types import MappingProxyType
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import (
+    ExchangeRateVersion,
+    ExchangeRate,
+)
+
+# Курсы валют к общей расчётной единице, которые
+# используются, пока в базе нет ни одной версии курсов
+DEFAULT_RATES = {
+    'r': Decimal('59.65'),
+    'd': Decimal('1.02'),
+    'e': Decimal('0.95'),
+}
+CROSS_RATE_CONTEXT = Context(prec=28, rounding=ROUND_HALF_EVEN)
+AMOUNT_QUANTUM = Decimal('0.01')
+AMOUNT_ROUNDING = ROUND_HALF_EVEN
+
+_lock = threading.Lock()
+# (версия, матрица, время проверки) либо None. Кортеж заменяется
+# целиком, поэтому чтение без блокировки видит согласованную пару
+_cache = None
+
+
+def _build_rate_matrix(rates:dict) -> dict:
+    """ Матрица кросс-курсов {(из валюты, в валюту): курс} """
+    return {
+        (from_currency, to_currency): CROSS_RATE_CONTEXT.divide(to_rate, from_rate)
+        for from_currency, from_rate in rates.items()
+        for to_currency, to_rate in rates.items()
+    }
+
+def _load_rate_matrix(version:int) -> dict:
+    """ Построение матрицы кросс-курсов для версии курсов """
+    if version is None:
+        return _build_rate_matrix(DEFAULT_RATES)
+    rates = dict(ExchangeRate.objects.filter(version_id=version).values_list('currency', 'rate'))
+    return _build_rate_matrix(rates)
+
+def _get_rate_matrix() -> tuple:
+    """ Текущая версия курсов и её матрица кросс-курсов. Матрица хранится
+    в памяти процесса, а номер последней версии перечитывается из базы
+    не чаще одного раза в EXCHANGE_RATES_REFRESH_SECONDS """
+    global _cache
+    now = time.monotonic()
+    cache = _cache
+    if cache is not None and now - cache[2] < settings.EXCHANGE_RATES_REFRESH_SECONDS:
+        return cache[0], cache[1]
+    version = ExchangeRateVersion.objects.order_by('-pk').values_list('pk', flat=True).first()
+    with _lock:
+        cache = _cache
+        if cache is None or version != cache[0]:
+            cache = (version, MappingProxyType(_load_rate_matrix(version)), now)
+        else:
+            cache = (version, cache[1], now)
+        _cache = cache
+    return cache[0], cache[1]
+
+def _reset_rate_matrix() -> None:
+    """ Сброс матрицы кросс-курсов процесса """
+    global _cache
+    with _lock:
+        _cache = None
+
+def _convert(matrix:dict, from_currency:str, to_currency:str, amount:Decimal) -> Decimal:
+    """ Перевод суммы в другую валюту по матрице кросс-курсов
+    с округлением до копеек """
+    if from_currency == to_currency:
+        return amount
+    return (amount * matrix[from_currency, to_currency]).quantize(AMOUNT_QUANTUM, AMOUNT_ROUNDING)
+
+def _convert_many(matrix:dict, from_currency:str, to_currency:str, amounts:list) -> list:
+    """ Перевод набора сумм в другую валюту по одному кросс-курсу """
+    if from_currency == to_currency:
+        return list(amounts)
+    rate = matrix[from_currency, to_currency]
+    return [(amount * rate).quantize(AMOUNT_QUANTUM, AMOUNT_ROUNDING) for amount in amounts]
+
+@transaction.atomic
+def _publish_exchange_rates(rates:dict) -> object:
+    """ Публикация новой версии курсов валют. Курсы нужны для
+    всех валют и должны быть положительными """
+    if set(rates) != set(DEFAULT_RATES):
+        raise ValueError('Курсы должны быть заданы для всех валют.')
+    if any(not rate.is_finite() or rate <= 0 for rate in rates.values()):
+        raise ValueError('Курсы должны быть положительными числами.')
+    version = ExchangeRateVersion.objects.create()
+    ExchangeRate.objects.bulk_create([
+        ExchangeRate(version=version, currency=currency, rate=rate)
+        for currency, rate in rates.items()
+    ])
+    transaction.on_commit(_reset_rate_matrix)
+    return version
@@ -0,0 +1,134 @@
+from datetime import datetime, time, timedelta
+import csv
+import heapq
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework.exceptions import ValidationError
+
+from .exchange import _convert, _load_rate_matrix
+from .models import (
+    Replenishment,
+    Transfer,
+    Payment,
+)
+
+STATEMENT_FIELDS = ('created', 'operation', 'id', 'amount', 'currency', 'counterparty')
+STATEMENT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+# Начальные символы, с которых табличные редакторы
+# начинают формулу в ячейке CSV
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+class Echo:
+    """ Псевдо-буфер, который отдаёт записанную строку
+    вместо её сохранения """
+
+    def write(self, value):
+        return value
+
+def _replenishment_rows(account:object, period:Q, chunk_size:int):
+    queryset = Replenishment.objects.filter(period, account=account).order_by('created', 'id')
+    for row in queryset.values('id', 'created', 'amount', 'currency').iterator(chunk_size=chunk_size):
+        row.update(operation='replenishment', counterparty='')
+        yield row
+
+def _transfer_rows(account:object, period:Q, chunk_size:int):
+    """ Переводы по счёту. Входящий перевод показывается зачисленной
+    суммой в валюте счёта получателя по курсам, которые использовал перевод """
+    queryset = Transfer.objects.filter(
+        period, Q(from_account=account) | Q(to_account=account),
+    ).order_by('created', 'id').values(
+        'id', 'created', 'amount', 'currency', 'from_account_id', 'rate_version_id',
+        'from_account__number', 'to_account__number', 'to_account__currency',
+    )
+    matrices = {}
+    for row in queryset.iterator(chunk_size=chunk_size):
+        outgoing = row.pop('from_account_id') == account.pk
+        version = row.pop('rate_version_id')
+        from_number = row.pop('from_account__number')
+        to_number = row.pop('to_account__number')
+        to_currency = row.pop('to_account__currency')
+        if outgoing:
+            yield dict(row, operation='outgoing_transfer', counterparty=to_number)
+        if not outgoing or from_number == to_number:
+            if version not in matrices:
+                matrices[version] = _load_rate_matrix(version)
+            amount = _convert(matrices[version], row['currency'], to_currency, row['amount'])
+            yield dict(row, operation='incoming_transfer', counterparty=from_number,
+                       amount=amount, currency=to_currency)
+
+def _payment_rows(account:object, period:Q, chunk_size:int):
+    queryset = Payment.objects.filter(period, account=account).order_by('created', 'id')
+    for row in queryset.values('id', 'created', 'amount', 'currency', 'merchant').iterator(chunk_size=chunk_size):
+        row.update(operation='payment', counterparty=row.pop('merchant'))
+        yield row
+
+def _statement_rows(account:object, date_from=None, date_to=None, chunk_size:int=2000):
+    """ Операции по счёту в хронологическом порядке. Каждый вид
+    операций читается серверным курсором порциями по chunk_size
+    строк, поэтому расход памяти не зависит от длины выписки """
+    period = Q()
+    if date_from is not None:
+        period &= Q(created__gte=timezone.make_aware(datetime.combine(date_from, time.min)))
+    if date_to is not None:
+        period &= Q(created__lt=timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time.min)))
+    streams = (
+        _replenishment_rows(account, period, chunk_size),
+        _transfer_rows(account, period, chunk_size),
+        _payment_rows(account, period, chunk_size),
+    )
+    return heapq.merge(*streams, key=lambda row: (row['created'], row['id']))
+
+def _statement_values(row:dict) -> list:
+    """ Значения полей выписки в порядке STATEMENT_FIELDS.
+    Время операции форматируется одинаково для всех форматов """
+    return [row['created'].isoformat() if field == 'created' else row[field] for field in STATEMENT_FIELDS]
+
+def _csv_cell(value):
+    """ Значение ячейки CSV. Строка, которую табличный редактор
+    принял бы за формулу, экранируется апострофом """
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def _csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(STATEMENT_FIELDS)
+    for row in rows:
+        yield writer.writerow([_csv_cell(value) for value in _statement_values(row)])
+
+def _ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(STATEMENT_FIELDS, _statement_values(row))), cls=DjangoJSONEncoder) + '\n'
+
+def _parse_statement_date(request, name:str):
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    date = parse_date(value)
+    if date is None:
+        raise ValidationError({name: ['Ожидается дата в формате ГГГГ-ММ-ДД.']})
+    return date
+
+def _statement_response(account:object, request) -> StreamingHttpResponse:
+    """ Потоковая выгрузка выписки по счёту в CSV или NDJSON """
+    file_format = request.query_params.get('file_format', 'csv')
+    if file_format not in STATEMENT_FORMATS:
+        raise ValidationError({'file_format': ['Поддерживаются форматы: csv, ndjson.']})
+    rows = _statement_rows(account,
+                           _parse_statement_date(request, 'date_from'),
+                           _parse_statement_date(request, 'date_to'),
+                           settings.STATEMENT_EXPORT_CHUNK_SIZE)
+    lines = _csv_lines(rows) if file_format == 'csv' else _ndjson_lines(rows)
+    response = StreamingHttpResponse(lines, content_type=STATEMENT_FORMATS[file_format])
+    response['Content-Disposition'] = 'attachment; filename="statement-{}.{}"'.format(account.number, file_format)
+    return response
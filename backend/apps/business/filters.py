@@ -0,0 +1,78 @@
+import django_filters
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import OrderingFilter
+
+from .models import Account, Replenishment, Transfer, Payment
+
+
+class BankAccountAdminFilter(django_filters.FilterSet):
+    """ Фильтры списка банковских счетов для персонала. Пользователь,
+    баланс и дата создания обслуживаются индексами bank_account, а
+    валюта и вид счёта отбирают большую долю строк и проверяются при
+    чтении индекса по сортировке """
+    user = django_filters.NumberFilter(field_name='user_id')
+    balance_min = django_filters.NumberFilter(field_name='balance', lookup_expr='gte')
+    balance_max = django_filters.NumberFilter(field_name='balance', lookup_expr='lte')
+    created_after = django_filters.IsoDateTimeFilter(field_name='created', lookup_expr='gte')
+    created_before = django_filters.IsoDateTimeFilter(field_name='created', lookup_expr='lt')
+
+    class Meta:
+        model = Account
+        fields = ('user', 'currency', 'type')
+
+class OperationFilter(django_filters.FilterSet):
+    """ Общие фильтры истории операций по дате и сумме. Выборка
+    идёт по индексам (счёт, created, id), (created, id) или (amount),
+    валюта проверяется при чтении индекса """
+    created_after = django_filters.IsoDateTimeFilter(field_name='created', lookup_expr='gte')
+    created_before = django_filters.IsoDateTimeFilter(field_name='created', lookup_expr='lt')
+    amount_min = django_filters.NumberFilter(field_name='amount', lookup_expr='gte')
+    amount_max = django_filters.NumberFilter(field_name='amount', lookup_expr='lte')
+
+class ReplenishmentFilter(OperationFilter):
+    """ Фильтры истории пополнений """
+    account = django_filters.NumberFilter(field_name='account_id')
+
+    class Meta:
+        model = Replenishment
+        fields = ('account', 'currency')
+
+class TransferFilter(OperationFilter):
+    """ Фильтры истории переводов """
+    account = django_filters.NumberFilter(field_name='from_account_id')
+    to_account = django_filters.NumberFilter(field_name='to_account_id')
+
+    class Meta:
+        model = Transfer
+        fields = ('account', 'to_account', 'currency')
+
+class PaymentFilter(OperationFilter):
+    """ Фильтры истории оплат, продавец ищется по началу названия """
+    account = django_filters.NumberFilter(field_name='account_id')
+    merchant = django_filters.CharFilter(field_name='merchant', lookup_expr='startswith')
+
+    class Meta:
+        model = Payment
+        fields = ('account', 'merchant', 'currency')
+
+class IndexedOrderingFilter(OrderingFilter):
+    """ Сортировка только по ordering_fields с добавлением id в том же
+    направлении, что соответствует индексам (столбец, id). Сортировка
+    по другим полям отклоняется, а не заменяется сортировкой по умолчанию """
+
+    def get_ordering(self, request, queryset, view):
+        params = request.query_params.get(self.ordering_param)
+        if params:
+            valid_fields = {item[0] for item in self.get_valid_fields(queryset, view, {'request': request})}
+            invalid = [term.strip() for term in params.split(',') if term.strip().lstrip('-') not in valid_fields]
+            if invalid:
+                raise ValidationError({self.ordering_param: [
+                    'Сортировка возможна только по полям: {}.'.format(', '.join(sorted(valid_fields)))]})
+        ordering = super().get_ordering(request, queryset, view)
+        if not ordering:
+            return ordering
+        ordering = list(ordering)[:1]
+        field = ordering[0].lstrip('-')
+        if field not in ('id', 'pk'):
+            ordering.append('-id' if ordering[0].startswith('-') else 'id')
+        return tuple(ordering)
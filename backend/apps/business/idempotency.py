@@ -0,0 +1,146 @@
+from datetime import timedelta
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from apps.monitoring.metrics import registry, METRIC_LABELS
+from .models import IdempotencyKey
+from .services import _retry_on_conflict
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_REPLAYED_HEADER = 'Idempotent-Replayed'
+
+METRIC_LABELS['idempotency_requests_total'] = ('result',)
+
+
+class IdempotencyLeaseLost(Exception):
+    """ Аренду ключа перехватил другой запрос """
+
+def _request_fingerprint(request) -> str:
+    """ Отпечаток метода, пути и тела запроса """
+    body = json.dumps(request.data, cls=JSONEncoder, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256('{}\n{}\n{}'.format(request.method, request.path, body).encode()).hexdigest()
+
+def _expired_before():
+    return timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+
+def _lease_until():
+    return timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_LEASE_SECONDS)
+
+def _claim_idempotency_key(user, key:str, fingerprint:str) -> tuple:
+    """ Захват ключа вставкой строки с арендой до locked_until. Возвращает
+    (запись, True) для захваченного ключа или (существующая запись, False).
+    Просроченный ключ удаляется и захватывается заново. Ключ с истёкшей
+    арендой без ответа перехватывается: ответ фиксируется в одной
+    транзакции с изменениями запроса, значит, они не зафиксированы """
+    while True:
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(user=user, key=key, fingerprint=fingerprint,
+                                                     locked_until=_lease_until()), True
+        except IntegrityError:
+            pass
+        try:
+            record = IdempotencyKey.objects.get(user=user, key=key)
+        except IdempotencyKey.DoesNotExist:
+            continue
+        if record.created < _expired_before():
+            IdempotencyKey.objects.filter(pk=record.pk, created=record.created).delete()
+            continue
+        if record.status_code is not None or record.fingerprint != fingerprint \
+                or record.locked_until > timezone.now():
+            return record, False
+        locked_until = _lease_until()
+        if IdempotencyKey.objects.filter(pk=record.pk, status_code__isnull=True,
+                                         locked_until=record.locked_until).update(locked_until=locked_until):
+            record.locked_until = locked_until
+            return record, True
+
+def _wait_idempotency_key(record:IdempotencyKey):
+    """ Ожидание ответа выполняющегося запроса с тем же ключом.
+    Возвращает None, если запрос завершился ошибкой и освободил ключ """
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+    delay = 0.05
+    while record.status_code is None and time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+        record = IdempotencyKey.objects.filter(pk=record.pk).first()
+        if record is None:
+            return None
+    return record
+
+def _leased_key(record:IdempotencyKey):
+    return IdempotencyKey.objects.filter(pk=record.pk, status_code__isnull=True,
+                                         locked_until=record.locked_until)
+
+@_retry_on_conflict
+def _execute_idempotent(record:IdempotencyKey, handler) -> Response:
+    """ Выполнение запроса и сохранение ответа в одной транзакции.
+    Ответ 4xx освобождает ключ, остальные сохраняются. Если аренду
+    перехватил другой запрос, транзакция откатывается """
+    response = handler()
+    if 400 <= response.status_code < 500:
+        saved = _leased_key(record).delete()[0]
+    else:
+        saved = _leased_key(record).update(status_code=response.status_code,
+                                           response=response.data, locked_until=None)
+    if not saved:
+        raise IdempotencyLeaseLost
+    return response
+
+def _idempotent_response(request, key:str, handler) -> Response:
+    """ Выполнение запроса на создание не больше одного раза на ключ.
+    Повтор получает сохранённый ответ, повтор с другим телом - 422,
+    повтор выполняющегося запроса - 409. Ответы 4xx не сохраняются,
+    и запрос можно повторить с тем же ключом """
+    if not key or len(key) > IdempotencyKey._meta.get_field('key').max_length:
+        return Response({'detail': 'Неверный ключ идемпотентности.'}, status=400)
+    fingerprint = _request_fingerprint(request)
+    record, claimed = _claim_idempotency_key(request.user, key, fingerprint)
+    if not claimed:
+        if record.fingerprint != fingerprint:
+            registry.inc('idempotency_requests_total', ('mismatch',))
+            return Response({'detail': 'Ключ идемпотентности использован с другим запросом.'}, status=422)
+        record = _wait_idempotency_key(record)
+        if record is None or record.status_code is None:
+            registry.inc('idempotency_requests_total', ('conflict',))
+            return Response({'detail': 'Запрос с этим ключом идемпотентности ещё выполняется.'},
+                            status=409, headers={'Retry-After': '1'})
+        registry.inc('idempotency_requests_total', ('replayed',))
+        return Response(record.response, status=record.status_code,
+                        headers={IDEMPOTENCY_REPLAYED_HEADER: 'true'})
+    try:
+        response = _execute_idempotent(record, handler)
+    except IdempotencyLeaseLost:
+        registry.inc('idempotency_requests_total', ('conflict',))
+        return Response({'detail': 'Запрос с этим ключом идемпотентности ещё выполняется.'},
+                        status=409, headers={'Retry-After': '1'})
+    except Exception:
+        # Ключ без ответа освобождается: его транзакция откатилась. Если
+        # не удалось и это, ключ перехватят после окончания аренды
+        try:
+            _leased_key(record).delete()
+        except DatabaseError:
+            pass
+        raise
+    registry.inc('idempotency_requests_total', ('executed',))
+    return response
+
+def _purge_idempotency_keys(batch_size:int, progress=None) -> int:
+    """ Удаление просроченных ключей порциями по индексу created """
+    expired_before = _expired_before()
+    purged = 0
+    while True:
+        pks = list(IdempotencyKey.objects.filter(created__lt=expired_before)
+                   .order_by('created').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return purged
+        purged += IdempotencyKey.objects.filter(pk__in=pks).delete()[0]
+        if progress is not None:
+            progress(purged)
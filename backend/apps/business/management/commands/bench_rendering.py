@@ -0,0 +1,83 @@
+import gzip
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from apps.business.models import Account
+from apps.business.seeding import _seed
+from apps.business.views import OperationsHistoryView, BankAccountsAdminView
+from backend.middleware import brotli
+from backend.renderers import FastJSONRenderer, orjson
+
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = ('Время рендеринга и объём ответов истории операций и списка '
+            'счетов для персонала с разными рендерерами и сжатием. '
+            'Данные создаются в транзакции, которая откатывается')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--accounts-per-user', type=int, default=3)
+        parser.add_argument('--operations-per-account', type=int, default=300)
+        parser.add_argument('--page-size', type=int, default=settings.OPERATIONS_MAX_PAGE_SIZE)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        if orjson is None:
+            self.stdout.write(self.style.WARNING('orjson не установлен, FastJSONRenderer использует json'))
+        if brotli is None:
+            self.stdout.write(self.style.WARNING('brotli не установлен, сжатие br пропущено'))
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def best(self, func) -> float:
+        """ Лучшее время из repeat запусков, мс """
+        best = None
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000
+
+    def run(self, options:dict) -> None:
+        tokens = _seed(options['users'], options['accounts_per_user'], options['operations_per_account'])
+        account = (Account.objects.filter(user__auth_token__key__in=tokens).select_related('user')
+                   .annotate(operations=Count('payment')).order_by('-operations').first())
+        user = account.user
+        staff = get_user_model()(username='bench_rendering_staff', is_staff=True)
+        factory = APIRequestFactory()
+
+        request = factory.get('/api/operations/', {'page_size': options['page_size']})
+        force_authenticate(request, user)
+        operations = OperationsHistoryView.as_view({'get': 'list'})(request).data
+        request = factory.get('/api/accounts-admin/')
+        force_authenticate(request, staff)
+        accounts = BankAccountsAdminView.as_view({'get': 'list'})(request).data
+
+        self.stdout.write('{:<12} {:<18} {:>12} {:>10}'.format('ответ', 'вариант', 'время, мс', 'байт'))
+        for name, data in (('operations', operations), ('accounts', accounts)):
+            for renderer in (JSONRenderer(), FastJSONRenderer()):
+                content = renderer.render(data)
+                self.stdout.write('{:<12} {:<18} {:>12.3f} {:>10}'.format(
+                    name, type(renderer).__name__, self.best(lambda: renderer.render(data)), len(content)))
+            compressors = [('gzip', lambda: gzip.compress(content, settings.COMPRESSION_GZIP_LEVEL, mtime=0))]
+            if brotli is not None:
+                compressors.append(('br', lambda: brotli.compress(content, quality=settings.COMPRESSION_BROTLI_QUALITY)))
+            for encoding, compress in compressors:
+                self.stdout.write('{:<12} {:<18} {:>12.3f} {:>10}'.format(
+                    name, '+' + encoding, self.best(compress), len(compress())))
@@ -0,0 +1,145 @@
+from decimal import Decimal
+import json
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from apps.business.exchange import _get_rate_matrix, _convert_many
+from apps.business.models import Account, Replenishment, Transfer, Payment
+from apps.business.serializers import (
+    ReplenishmentSerializer,
+    TransferSerializer,
+    PaymentSerializer,
+    BankAccountSerializer,
+    OperationSerializer,
+    ReplenishmentValuesSerializer,
+    TransferValuesSerializer,
+    PaymentValuesSerializer,
+    BankAccountValuesSerializer,
+    OperationValuesSerializer,
+)
+from apps.business.services import (
+    _currency_exchange,
+    _operations_timeline,
+    _apply_operations_batch,
+    _create_payment,
+)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'bench_services.json')
+
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = ('Микробенчмарки функций services.py и сериализаторов. Завершается '
+            'с ошибкой, если время или число запросов превышают базовые значения')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+        parser.add_argument('--save-baseline', action='store_true')
+        parser.add_argument('--threshold', type=float, default=1.5,
+                            help='Допустимое отношение времени к базовому')
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        results = {}
+        try:
+            with transaction.atomic():
+                self.run(options['rows'], results)
+                raise Rollback
+        except Rollback:
+            pass
+
+        self.stdout.write('{:<32} {:>12} {:>8}'.format('бенчмарк', 'время, мс', 'запросы'))
+        for name, (seconds, queries) in results.items():
+            self.stdout.write('{:<32} {:>12.3f} {:>8}'.format(name, seconds * 1000, queries))
+
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as file:
+                json.dump(results, file, indent=4, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS('Базовые значения сохранены в {}'.format(options['baseline'])))
+            return
+        if not os.path.exists(options['baseline']):
+            return
+        with open(options['baseline']) as file:
+            baseline = json.load(file)
+        regressions = []
+        for name, (seconds, queries) in results.items():
+            if name not in baseline:
+                continue
+            base_seconds, base_queries = baseline[name]
+            if queries > base_queries:
+                regressions.append('{}: запросов {} вместо {}'.format(name, queries, base_queries))
+            if seconds > base_seconds * options['threshold']:
+                regressions.append('{}: {:.3f} мс вместо {:.3f} мс'.format(
+                    name, seconds * 1000, base_seconds * 1000))
+        if regressions:
+            raise CommandError('Регрессии производительности:\n' + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS('Регрессий не обнаружено'))
+
+    def measure(self, results:dict, name:str, func) -> None:
+        """ Лучшее время из repeat запусков и число запросов """
+        best = None
+        for _ in range(self.repeat):
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = (best, len(context.captured_queries))
+
+    def run(self, rows:int, results:dict) -> None:
+        user = get_user_model().objects.create_user('bench_services')
+        other = get_user_model().objects.create_user('bench_services_other')
+        account = Account.objects.create(user=user, number='bench-1', type='a', currency='r',
+                                         balance=Decimal('100000000'))
+        other_account = Account.objects.create(user=other, number='bench-2', type='a', currency='d')
+        Replenishment.objects.bulk_create(
+            [Replenishment(account=account, amount=Decimal('1.00'), currency='r') for _ in range(rows)])
+        Transfer.objects.bulk_create(
+            [Transfer(from_account=account, to_account=other_account, amount=Decimal('1.00'), currency='r')
+             for _ in range(rows)])
+        Payment.objects.bulk_create(
+            [Payment(account=account, merchant='shop', amount=Decimal('1.00'), currency='r') for _ in range(rows)])
+
+        amounts = [Decimal(i) / 100 for i in range(1, rows + 1)]
+        _get_rate_matrix()
+        self.measure(results, 'currency_exchange', lambda: [
+            _currency_exchange('r', 'd', amount) for amount in amounts])
+        self.measure(results, 'convert_many', lambda: _convert_many(_get_rate_matrix()[1], 'r', 'd', amounts))
+        self.measure(results, 'operations_timeline_50', lambda: _operations_timeline(user, 50))
+        self.measure(results, 'create_payment', lambda: _create_payment(account, 'shop', Decimal('1.00')))
+        batch = [{'type': 'payment', 'account': account.pk, 'merchant': 'shop', 'amount': Decimal('1.00')}] * 100
+        self.measure(results, 'operations_batch_100', lambda: _apply_operations_batch(user, batch))
+
+        replenishments = list(Replenishment.objects.select_related('account').filter(account=account))
+        transfers = list(Transfer.objects.select_related('from_account', 'to_account').filter(from_account=account))
+        payments = list(Payment.objects.select_related('account').filter(account=account))
+        self.measure(results, 'replenishment_serializer', lambda: ReplenishmentSerializer(replenishments, many=True).data)
+        self.measure(results, 'transfer_serializer', lambda: TransferSerializer(transfers, many=True).data)
+        self.measure(results, 'payment_serializer', lambda: PaymentSerializer(payments, many=True).data)
+        self.measure(results, 'bank_account_serializer', lambda: BankAccountSerializer([account] * rows, many=True).data)
+        page = [(kind, operation) for kind, position, operation in _operations_timeline(user, 50)]
+        self.measure(results, 'operation_serializer_50', lambda: OperationSerializer(page, many=True).data)
+
+        for name, serializer, queryset in (
+            ('replenishment_values', ReplenishmentValuesSerializer, Replenishment.objects.filter(account=account)),
+            ('transfer_values', TransferValuesSerializer, Transfer.objects.filter(from_account=account)),
+            ('payment_values', PaymentValuesSerializer, Payment.objects.filter(account=account)),
+            ('bank_account_values', BankAccountValuesSerializer, Account.objects.filter(user=user)),
+        ):
+            rows_values = list(serializer.select(queryset))
+            if serializer is BankAccountValuesSerializer:
+                rows_values = rows_values * rows
+            self.measure(results, name, lambda: serializer(rows_values, many=True).data)
+        lookups = OperationValuesSerializer.lookups_by_kind()
+        self.measure(results, 'operations_timeline_values_50', lambda: _operations_timeline(user, 50, None, lookups))
+        page = [(kind, row) for kind, position, row in _operations_timeline(user, 50, None, lookups)]
+        self.measure(results, 'operation_values_50', lambda: OperationValuesSerializer(page, many=True).data)
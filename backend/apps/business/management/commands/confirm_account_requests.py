@@ -0,0 +1,40 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.business.models import RequestCreateAccount
+from apps.business.services import _confirm_requests_create_account
+
+
+class Command(BaseCommand):
+    help = 'Подтверждение запросов на создание банковских счетов порциями'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', choices=[value for value, name in RequestCreateAccount.TYPES])
+        parser.add_argument('--currency', choices=[value for value, name in RequestCreateAccount.CURRENCIES])
+        parser.add_argument('--created-before')
+        parser.add_argument('--chunk-size', type=int, default=settings.ACCOUNT_REQUESTS_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        queryset = RequestCreateAccount.objects.all()
+        if options['type']:
+            queryset = queryset.filter(type=options['type'])
+        if options['currency']:
+            queryset = queryset.filter(currency=options['currency'])
+        if options['created_before']:
+            queryset = queryset.filter(created__lt=options['created_before'])
+
+        total = queryset.count()
+        started = time.perf_counter()
+
+        def progress(confirmed):
+            elapsed = time.perf_counter() - started
+            self.stdout.write('{}/{} подтверждено, {:.0f} запросов/с'.format(
+                confirmed, total, confirmed / elapsed if elapsed else 0,
+            ))
+
+        confirmed = _confirm_requests_create_account(queryset, options['chunk_size'], progress)
+        self.stdout.write(self.style.SUCCESS('Подтверждено запросов: {} за {:.2f} с'.format(
+            confirmed, time.perf_counter() - started,
+        )))
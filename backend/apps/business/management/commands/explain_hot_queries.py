@@ -0,0 +1,97 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+from django.db.models import Count
+
+from apps.business.models import (
+    Account,
+    Replenishment,
+    Transfer,
+    Payment,
+)
+from apps.business.seeding import _seed
+
+# Индексы по внешним ключам, которые были в схеме
+# до появления составных индексов
+BASELINE_INDEXES = (
+    (Account, 'user'),
+    (Replenishment, 'account'),
+    (Transfer, 'from_account'),
+    (Transfer, 'to_account'),
+    (Payment, 'account'),
+)
+
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = 'Планы выполнения горячих запросов до и после добавления составных индексов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed-users', type=int, default=0)
+        parser.add_argument('--accounts-per-user', type=int, default=3)
+        parser.add_argument('--operations-per-account', type=int, default=200)
+        parser.add_argument('--compare', action='store_true',
+                            help='Показать также планы на схеме без составных индексов')
+
+    def handle(self, *args, **options):
+        if options['compare'] and connection.vendor != 'postgresql':
+            raise CommandError('Сравнение планов поддерживается только для PostgreSQL')
+        if options['seed_users']:
+            _seed(options['seed_users'], options['accounts_per_user'], options['operations_per_account'])
+            with connection.cursor() as cursor:
+                for model in (Account, Replenishment, Transfer, Payment):
+                    if connection.vendor == 'postgresql':
+                        cursor.execute('ANALYZE {}'.format(model._meta.db_table))
+
+        account = Account.objects.annotate(operations=Count('payment')).order_by('-operations').first()
+        if account is None:
+            self.stderr.write('Нет данных, запустите команду с --seed-users')
+            return
+
+        if options['compare']:
+            self.stdout.write(self.style.MIGRATE_HEADING('=== Без составных индексов ==='))
+            try:
+                with transaction.atomic():
+                    self.use_baseline_indexes()
+                    self.explain_all(account)
+                    raise Rollback
+            except Rollback:
+                pass
+            self.stdout.write(self.style.MIGRATE_HEADING('=== С составными индексами ==='))
+        self.explain_all(account)
+
+    def use_baseline_indexes(self) -> None:
+        """ Замена составных индексов на индексы по внешним ключам
+        внутри транзакции, которая затем откатывается """
+        with connection.schema_editor(atomic=False) as editor:
+            for model in (Account, Replenishment, Transfer, Payment):
+                for index in model._meta.indexes:
+                    editor.remove_index(model, index)
+            for model, field in BASELINE_INDEXES:
+                name = '{}_{}_baseline'.format(model._meta.db_table, field)
+                editor.add_index(model, models.Index(fields=[field], name=name[:30]))
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                for model in (Account, Replenishment, Transfer, Payment):
+                    cursor.execute('ANALYZE {}'.format(model._meta.db_table))
+
+    def explain_all(self, account:object) -> None:
+        user = account.user
+        queries = {
+            'Счета пользователя': Account.objects.filter(user=user).values('id', 'number', 'balance', 'currency'),
+            'Счёт по номеру': Account.objects.filter(number=account.number),
+            'История пополнений': Replenishment.objects.filter(account__user=user).order_by('-created', '-id')[:50],
+            'История переводов (исходящие)': Transfer.objects.filter(from_account__user=user).order_by('-created', '-id')[:50],
+            'История переводов (входящие)': Transfer.objects.filter(to_account__user=user).order_by('-created', '-id')[:50],
+            'История оплат': Payment.objects.filter(account__user=user).order_by('-created', '-id')[:50],
+            'Оплаты по счёту': Payment.objects.filter(account=account).order_by('-created', '-id')[:50],
+            'Все пополнения (персонал)': Replenishment.objects.order_by('-created', '-id')[:50],
+            'Все переводы (персонал)': Transfer.objects.order_by('-created', '-id')[:50],
+            'Все оплаты (персонал)': Payment.objects.order_by('-created', '-id')[:50],
+        }
+        analyze = connection.vendor == 'postgresql'
+        for title, queryset in queries.items():
+            self.stdout.write(self.style.SQL_KEYWORD(title))
+            self.stdout.write(queryset.explain(analyze=analyze) if analyze else queryset.explain())
+            self.stdout.write('')
@@ -0,0 +1,157 @@
+from urllib.parse import urlsplit
+import http.client
+import json
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Доли запросов каждого вида по умолчанию
+DEFAULT_MIX = 'payment=4,transfer=2,replenishment=1,history=10'
+HISTORY_PATHS = (
+    '/api/operations/',
+    '/api/operations/payments/',
+    '/api/operations/transfers/',
+    '/api/operations/replenishments/',
+)
+
+
+class Client:
+    """ HTTP-соединение одного потока с повторным
+    использованием keep-alive """
+
+    def __init__(self, url:str):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+    def request(self, method:str, path:str, token:str, body=None):
+        headers = {'Authorization': 'Token ' + token}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            raise
+
+class Command(BaseCommand):
+    help = 'Нагрузочное тестирование API оплат, переводов, пополнений и истории операций'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--tokens-file', required=True)
+        parser.add_argument('--staff-token', help='Токен персонала для пополнений')
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--duration', type=float, default=30)
+        parser.add_argument('--mix', default=DEFAULT_MIX)
+
+    def handle(self, *args, **options):
+        with open(options['tokens_file']) as file:
+            tokens = [line.strip() for line in file if line.strip()]
+        if not tokens:
+            raise CommandError('Файл токенов пуст')
+        mix = {name: float(weight) for name, weight in
+               (item.split('=') for item in options['mix'].split(','))}
+        if 'replenishment' in mix and not options['staff_token']:
+            del mix['replenishment']
+        self.url = options['url']
+        self.staff_token = options['staff_token']
+        self.accounts = {}
+        self.numbers = []
+        self.lock = threading.Lock()
+        self.results = {}
+
+        deadline = time.monotonic() + options['duration']
+        threads = [
+            threading.Thread(target=self.work, args=(tokens, mix, deadline))
+            for _ in range(options['concurrency'])
+        ]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.report(time.monotonic() - started)
+
+    def work(self, tokens:list, mix:dict, deadline:float) -> None:
+        client = Client(self.url)
+        kinds, weights = list(mix), list(mix.values())
+        while time.monotonic() < deadline:
+            kind = random.choices(kinds, weights)[0]
+            token = random.choice(tokens)
+            started = time.perf_counter()
+            try:
+                status = getattr(self, kind)(client, token)
+            except (OSError, http.client.HTTPException):
+                status = 0
+                client = Client(self.url)
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                latencies, errors = self.results.setdefault(kind, ([], [0]))
+                latencies.append(elapsed)
+                if not 200 <= status < 300:
+                    errors[0] += 1
+
+    def user_accounts(self, client:Client, token:str) -> list:
+        """ Счета пользователя токена, запрашиваются один раз """
+        accounts = self.accounts.get(token)
+        if accounts is None:
+            status, body = client.request('GET', '/api/accounts/', token)
+            accounts = json.loads(body) if status == 200 else []
+            with self.lock:
+                self.accounts[token] = accounts
+                self.numbers.extend(account['number'] for account in accounts)
+        return accounts
+
+    def payment(self, client:Client, token:str) -> int:
+        accounts = self.user_accounts(client, token)
+        if not accounts:
+            return 0
+        status, body = client.request('POST', '/api/operations/payments/create/', token, {
+            'account': random.choice(accounts)['id'],
+            'merchant': 'load-test',
+            'amount': '1.00',
+        })
+        return status
+
+    def transfer(self, client:Client, token:str) -> int:
+        accounts = self.user_accounts(client, token)
+        if not accounts or not self.numbers:
+            return 0
+        status, body = client.request('POST', '/api/operations/transfers/create/another/', token, {
+            'from_account': random.choice(accounts)['id'],
+            'account_for_enrollment': random.choice(self.numbers),
+            'amount': '1.00',
+        })
+        return status
+
+    def replenishment(self, client:Client, token:str) -> int:
+        accounts = self.user_accounts(client, token)
+        if not accounts:
+            return 0
+        account = random.choice(accounts)
+        status, body = client.request('POST', '/api/operations/replenishments/create/', self.staff_token, {
+            'account': account['id'],
+            'amount': '100.00',
+            'currency': account['currency'],
+        })
+        return status
+
+    def history(self, client:Client, token:str) -> int:
+        status, body = client.request('GET', random.choice(HISTORY_PATHS), token)
+        return status
+
+    def report(self, elapsed:float) -> None:
+        self.stdout.write('{:<14} {:>8} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+            'запрос', 'всего', 'зап/с', 'p50 мс', 'p90 мс', 'p99 мс', 'ошибки'))
+        for kind, (latencies, errors) in sorted(self.results.items()):
+            latencies.sort()
+            percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+            self.stdout.write('{:<14} {:>8} {:>9.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>7.2%}'.format(
+                kind, len(latencies), len(latencies) / elapsed,
+                percentile(0.5), percentile(0.9), percentile(0.99), errors[0] / len(latencies),
+            ))
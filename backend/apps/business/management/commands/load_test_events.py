@@ -0,0 +1,176 @@
+from urllib.parse import urlsplit
+import asyncio
+import json
+import random
+import resource
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def _rss_kb(pid:int) -> int:
+    """ Резидентная память процесса в КБ по /proc """
+    with open('/proc/{}/status'.format(pid)) as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+async def _read_head(reader) -> tuple:
+    """ Код ответа и заголовки HTTP-ответа """
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            return status, headers
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+async def _read_body(reader, headers:dict):
+    """ Части тела ответа с учётом chunked-кодирования """
+    if headers.get('transfer-encoding') != 'chunked':
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            yield data
+    while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if not size:
+            return
+        yield await reader.readexactly(size)
+        await reader.readexactly(2)
+
+class Command(BaseCommand):
+    help = ('Нагрузочное тестирование потока событий: удержание простаивающих '
+            'SSE-соединений и задержка доставки изменений балансов')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--tokens-file', required=True)
+        parser.add_argument('--connections', type=int, default=2000)
+        parser.add_argument('--ramp', type=float, default=500, help='Новых соединений в секунду')
+        parser.add_argument('--duration', type=float, default=30, help='Удержание соединений, с')
+        parser.add_argument('--payments-per-second', type=float, default=5)
+        parser.add_argument('--server-pid', type=int, help='Процесс сервера для замера памяти')
+
+    def handle(self, *args, **options):
+        with open(options['tokens_file']) as file:
+            tokens = [line.strip() for line in file if line.strip()]
+        if not tokens:
+            raise CommandError('Файл токенов пуст')
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, min(hard, options['connections'] + 1024)), hard))
+        parts = urlsplit(options['url'])
+        self.host, self.port = parts.hostname, parts.port or 80
+        asyncio.run(self.run(tokens, options))
+
+    async def run(self, tokens:list, options:dict) -> None:
+        self.connect_times, self.accounts = [], {}
+        self.sent, self.received = {}, {}
+        self.failed = self.resets = self.dropped = 0
+        pid = options['server_pid']
+        rss_before = _rss_kb(pid) if pid else None
+
+        listeners = []
+        started = time.monotonic()
+        for i in range(options['connections']):
+            listeners.append(asyncio.ensure_future(self.listen(tokens[i % len(tokens)])))
+            await asyncio.sleep(max(0.0, started + (i + 1) / options['ramp'] - time.monotonic()))
+        while len(self.connect_times) + self.failed < options['connections'] \
+                and time.monotonic() - started < options['connections'] / options['ramp'] + 30:
+            await asyncio.sleep(0.1)
+        rss_connected = _rss_kb(pid) if pid else None
+
+        deadline = time.monotonic() + options['duration']
+        while time.monotonic() < deadline:
+            if options['payments_per_second'] > 0 and self.accounts:
+                asyncio.ensure_future(self.payment(random.choice(list(self.accounts.items()))))
+                await asyncio.sleep(1 / options['payments_per_second'])
+            else:
+                await asyncio.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+        await asyncio.sleep(1)
+        for listener in listeners:
+            listener.cancel()
+        await asyncio.gather(*listeners, return_exceptions=True)
+        self.report(options['connections'], rss_before, rss_connected)
+
+    async def listen(self, token:str) -> None:
+        """ Одно SSE-соединение: время до снимка счетов
+        и время получения каждого события """
+        started = time.perf_counter()
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            writer.write('GET /api/events/ HTTP/1.1\r\nHost: {}\r\nAuthorization: Token {}\r\n'
+                         'Accept: text/event-stream\r\n\r\n'.format(self.host, token).encode())
+            status, headers = await _read_head(reader)
+            if status != 200:
+                self.failed += 1
+                return
+            buffer, connected = b'', False
+            async for data in _read_body(reader, headers):
+                buffer += data
+                *chunks, buffer = buffer.split(b'\n\n')
+                for chunk in chunks:
+                    fields = dict(line.split(': ', 1) for line in chunk.decode().split('\n') if ': ' in line
+                                  and not line.startswith(':'))
+                    if fields.get('event') == 'snapshot':
+                        connected = True
+                        self.connect_times.append(time.perf_counter() - started)
+                        accounts = [account for account in json.loads(fields['data'])
+                                    if float(account['balance']) >= 1]
+                        if accounts:
+                            self.accounts[token] = accounts
+                    elif fields.get('event') == 'operation':
+                        event = json.loads(fields['data'])
+                        self.received.setdefault((event['account'], event['operation']), time.perf_counter())
+                    elif fields.get('event') == 'reset':
+                        self.resets += 1
+            if connected:
+                self.dropped += 1
+        except asyncio.CancelledError:
+            pass
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            self.failed += 1
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def payment(self, item:tuple) -> None:
+        """ Оплата по случайному счёту пользователя с засечкой времени
+        отправки для замера задержки доставки события """
+        token, accounts = item
+        account = random.choice(accounts)
+        body = json.dumps({'account': account['id'], 'merchant': 'load-test', 'amount': '1.00'}).encode()
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            writer.write('POST /api/operations/payments/create/ HTTP/1.1\r\nHost: {}\r\n'
+                         'Authorization: Token {}\r\nContent-Type: application/json\r\n'
+                         'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                             self.host, token, len(body)).encode() + body)
+            status, headers = await _read_head(reader)
+            data = b''.join([chunk async for chunk in _read_body(reader, headers)])
+            writer.close()
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            return
+        if status == 201:
+            self.sent[account['id'], json.loads(data)['id']] = started
+
+    def report(self, requested:int, rss_before:int, rss_connected:int) -> None:
+        def percentile(values, p):
+            return values[min(int(len(values) * p), len(values) - 1)] * 1000 if values else 0
+
+        connect_times = sorted(self.connect_times)
+        latencies = sorted(self.received[key] - sent for key, sent in self.sent.items() if key in self.received)
+        self.stdout.write('соединений: {} из {}, ошибок {}, разорвано сервером {}, reset {}'.format(
+            len(connect_times), requested, self.failed, self.dropped, self.resets))
+        self.stdout.write('до снимка счетов: p50 {:.1f} мс, p99 {:.1f} мс'.format(
+            percentile(connect_times, 0.5), percentile(connect_times, 0.99)))
+        self.stdout.write('событий доставлено: {} из {} оплат, задержка p50 {:.1f} мс, p99 {:.1f} мс'.format(
+            len(latencies), len(self.sent), percentile(latencies, 0.5), percentile(latencies, 0.99)))
+        if rss_before is not None and connect_times:
+            self.stdout.write('память сервера: {:.1f} МБ -> {:.1f} МБ, {:.1f} КБ на соединение'.format(
+                rss_before / 1024, rss_connected / 1024, (rss_connected - rss_before) / len(connect_times)))
@@ -0,0 +1,21 @@
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.business.exchange import _publish_exchange_rates
+
+
+class Command(BaseCommand):
+    help = 'Публикация новой версии курсов валют, например: r=59.65 d=1.02 e=0.95'
+
+    def add_arguments(self, parser):
+        parser.add_argument('rates', nargs='+')
+
+    def handle(self, *args, **options):
+        try:
+            rates = {currency: Decimal(rate) for currency, rate in
+                     (item.split('=', 1) for item in options['rates'])}
+            version = _publish_exchange_rates(rates)
+        except (ValueError, InvalidOperation) as error:
+            raise CommandError(error)
+        self.stdout.write(self.style.SUCCESS('Опубликована версия курсов {}'.format(version.pk)))
@@ -0,0 +1,24 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.business.idempotency import _purge_idempotency_keys
+
+
+class Command(BaseCommand):
+    help = 'Удаление просроченных ключей идемпотентности порциями'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.IDEMPOTENCY_PURGE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+
+        def progress(purged):
+            self.stdout.write('{} ключей удалено'.format(purged))
+
+        purged = _purge_idempotency_keys(options['batch_size'], progress)
+        self.stdout.write(self.style.SUCCESS('Удалено ключей: {} за {:.2f} с'.format(
+            purged, time.perf_counter() - started,
+        )))
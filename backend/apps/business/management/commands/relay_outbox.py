@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.business.outbox import _get_outbox_sink, _relay_outbox
+
+
+class Command(BaseCommand):
+    help = 'Отправка событий изменения балансов из outbox в приёмник OUTBOX_SINK'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.OUTBOX_BATCH_SIZE)
+        parser.add_argument('--interval', type=float, default=settings.OUTBOX_POLL_INTERVAL)
+        parser.add_argument('--once', action='store_true', help='Отправить накопленные события и завершиться')
+
+    def handle(self, *args, **options):
+        sink = _get_outbox_sink()
+        while True:
+            started = time.perf_counter()
+            relayed = _relay_outbox(sink, options['batch_size'])
+            if relayed:
+                self.stdout.write('Отправлено событий: {} за {:.2f} с'.format(
+                    relayed, time.perf_counter() - started,
+                ))
+            if options['once']:
+                return
+            time.sleep(options['interval'])
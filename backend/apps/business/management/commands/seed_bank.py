@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.business.seeding import _seed, SEED_PASSWORD
+
+
+class Command(BaseCommand):
+    help = 'Заполнение базы синтетическими пользователями, счетами и операциями'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--accounts-per-user', type=int, default=3)
+        parser.add_argument('--operations-per-account', type=int, default=100)
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument('--batch-size', type=int, default=50000)
+        parser.add_argument('--tokens-file', help='Файл, в который записываются токены пользователей')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+
+        def progress(written):
+            elapsed = time.perf_counter() - started
+            self.stdout.write('Записано операций: {}, {:.0f} строк/с'.format(written, written / elapsed))
+
+        tokens = _seed(options['users'], options['accounts_per_user'], options['operations_per_account'],
+                       options['days'], options['batch_size'], progress)
+        if options['tokens_file']:
+            with open(options['tokens_file'], 'w') as file:
+                file.write('\n'.join(tokens) + '\n')
+        self.stdout.write(self.style.SUCCESS(
+            'Создано пользователей: {} за {:.1f} с, пароль: {}'.format(
+                len(tokens), time.perf_counter() - started, SEED_PASSWORD)
+        ))
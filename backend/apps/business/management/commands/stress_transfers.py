@@ -0,0 +1,69 @@
+import random
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Sum
+
+from apps.business.models import Account
+from apps.business.services import _create_transfer
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочная проверка конкурентных переводов между счетами'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+        parser.add_argument('--accounts', type=int, default=20)
+        parser.add_argument('--transfers', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        suffix = uuid.uuid4().hex
+        user = get_user_model().objects.create_user('stress_transfers_' + suffix)
+        try:
+            accounts = Account.objects.bulk_create([
+                Account(user=user, number='stress-{}-{}'.format(suffix, i), type='a', currency='r')
+                for i in range(options['accounts'])
+            ])
+            accounts = list(Account.objects.filter(user=user))
+            self.stdout.write('workers  transfers/s  errors  balance')
+            for workers in options['workers']:
+                self.run(accounts, workers, options['transfers'])
+        finally:
+            user.delete()
+
+    def run(self, accounts:list, workers:int, transfers:int) -> None:
+        Account.objects.filter(pk__in=[account.pk for account in accounts]).update(balance=Decimal('1000000'))
+        expected = Account.objects.filter(user=accounts[0].user).aggregate(total=Sum('balance'))['total']
+        errors = []
+
+        def work(count):
+            try:
+                for _ in range(count):
+                    from_account, to_account = random.sample(accounts, 2)
+                    try:
+                        _create_transfer(from_account, to_account, Decimal(random.randint(1, 100)))
+                    except Exception as error:
+                        errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=work, args=(transfers // workers,)) for _ in range(workers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        total = Account.objects.filter(user=accounts[0].user).aggregate(total=Sum('balance'))['total']
+        self.stdout.write('{:>7}  {:>11.1f}  {:>6}  {}'.format(
+            workers,
+            transfers // workers * workers / elapsed,
+            len(errors),
+            'OK' if total == expected else 'MISMATCH {} != {}'.format(total, expected),
+        ))
@@ -0,0 +1,137 @@
+from hashlib import md5
+
+from django.db.models import Count, Max
+from django.utils.http import parse_etags
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework.response import Response
+
+from backend.routers import _replica_reads, _is_pinned, _pick_replica
+
+from .caching import _get_cached_accounts
+from .filters import BankAccountAdminFilter, IndexedOrderingFilter
+from .idempotency import IDEMPOTENCY_HEADER, _idempotent_response
+from .models import Account
+from .pagination import StaffCursorPagination
+from .serializers import BankAccountValuesSerializer, BankAccountAdminValuesSerializer
+
+
+def _weak_etag(*parts) -> str:
+    return 'W/"{}"'.format(md5(repr(parts).encode()).hexdigest())
+
+def _not_modified(request, etag:str) -> bool:
+    """ Совпадает ли ETag с одним из If-None-Match
+    при слабом сравнении """
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    etags = {value[2:] if value.startswith('W/') else value for value in parse_etags(header)}
+    return '*' in etags or etag[2:] in etags
+
+class ReplicaReadMixin:
+    """ Чтения действий replica_actions (всех действий, если None) идут
+    на одну реплику на запрос, если пользователь не закреплён за основной
+    базой после собственной записи. Аутентификация выполняется до
+    переключения """
+    replica_actions = None
+    _replica_token = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method not in ('GET', 'HEAD'):
+            return
+        if self.replica_actions is not None and getattr(self, 'action', None) not in self.replica_actions:
+            return
+        if not _is_pinned(request.user.pk):
+            self._replica_token = _replica_reads.set(_pick_replica())
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if self._replica_token is not None:
+            _replica_reads.reset(self._replica_token)
+            self._replica_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+class ValuesListMixin:
+    """ Список из строк values() со столбцами, которые выбирает
+    list_serializer_class или ValuesSerializer представления """
+    list_serializer_class = None
+
+    def get_list_serializer_class(self):
+        return self.list_serializer_class or self.get_serializer_class()
+
+    def list(self, request, *args, **kwargs):
+        serializer_class = self.get_list_serializer_class()
+        queryset = serializer_class.select(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer_class(page, many=True).data)
+        return Response(serializer_class(queryset, many=True).data)
+
+class ConditionalListMixin(ValuesListMixin):
+    """ Слабый ETag списка. Для постраничного списка он строится по
+    строкам страницы, которые затем и сериализуются, поэтому страница
+    читается одним запросом. Для остальных - из числа строк и
+    наибольшего значения etag_field. При совпадении с If-None-Match
+    ответ 304 отдаётся без сериализации """
+    etag_field = 'created'
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        if self.paginator is None:
+            fingerprint = queryset.order_by().aggregate(count=Count('pk'), last=Max(self.etag_field),
+                                                        last_pk=Max('pk'))
+            etag = _weak_etag(request.user.pk, request.get_full_path(),
+                              fingerprint['count'], fingerprint['last'], fingerprint['last_pk'])
+            if _not_modified(request, etag):
+                return Response(status=304, headers={'ETag': etag})
+            response = super().list(request, *args, **kwargs)
+        else:
+            serializer_class = self.get_list_serializer_class()
+            page = self.paginate_queryset(serializer_class.select(queryset))
+            etag = _weak_etag(request.user.pk, request.get_full_path(),
+                              [sorted(row.items()) for row in page], self.paginator.get_next_link())
+            if _not_modified(request, etag):
+                return Response(status=304, headers={'ETag': etag})
+            response = self.get_paginated_response(serializer_class(page, many=True).data)
+        response['ETag'] = etag
+        return response
+
+class StaffBankAccountsListMixin(ValuesListMixin):
+    """ Постраничный список всех банковских счетов для персонала
+    с фильтрами и сортировкой по индексированным столбцам """
+    filter_backends = [DjangoFilterBackend, IndexedOrderingFilter]
+    filterset_class = BankAccountAdminFilter
+    ordering_fields = ('id', 'balance', 'created')
+    ordering = ('-id',)
+    pagination_class = StaffCursorPagination
+    list_serializer_class = BankAccountAdminValuesSerializer
+
+class UserBankAccountsListMixin:
+    """ Список банковских счетов пользователя из кэша списков
+    счетов. ETag хранится в кэше вместе со списком """
+
+    def list(self, request, *args, **kwargs):
+        user_pk = request.user.pk
+
+        def build():
+            data = BankAccountValuesSerializer(
+                BankAccountValuesSerializer.select(Account.objects.filter(user_id=user_pk)), many=True).data
+            return _weak_etag(user_pk, [sorted(item.items()) for item in data]), data
+
+        etag, data = _get_cached_accounts(user_pk, build)
+        if _not_modified(request, etag):
+            return Response(status=304, headers={'ETag': etag})
+        return Response(data, headers={'ETag': etag})
+
+class IdempotentCreateMixin:
+    """ Запрос на создание с заголовком Idempotency-Key выполняется
+    один раз, повторы получают сохранённый ответ """
+
+    def idempotent(self, request, handler):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return handler()
+        return _idempotent_response(request, key, handler)
+
+    def create(self, request, *args, **kwargs):
+        return self.idempotent(request, lambda: super(IdempotentCreateMixin, self).create(
+            request, *args, **kwargs))
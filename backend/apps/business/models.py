@@ -1,3 +1,4 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.conf import settings
 
@@ -8,6 +9,7 @@ class Account(models.Model):
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
         verbose_name='Пользователь',
+        db_index=False,
     )
     number = models.CharField('Номер счёта', max_length=255, unique=True)
     TYPES = (
@@ -24,9 +26,18 @@ class Account(models.Model):
     currency = models.CharField('Валюта', max_length=1, choices=CURRENCIES)
     created = models.DateTimeField('Дата и время создания', auto_now_add=True)
     updated = models.DateTimeField('Дата и время изменения', auto_now=True)
+    event_offset = models.BigIntegerField('Смещение последнего события', default=0)
 
     class Meta:
         db_table = 'bank_account'
+        indexes = [
+            # Список счетов пользователя читается только из индекса
+            models.Index(fields=['user', 'id'], include=['number', 'balance', 'currency'],
+                         name='bank_account_user_idx'),
+            # Фильтры и сортировки списка счетов для персонала
+            models.Index(fields=['balance', 'id'], name='bank_account_balance_idx'),
+            models.Index(fields=['created', 'id'], name='bank_account_created_idx'),
+        ]
 
     def __str__(self):
         return self.number
@@ -54,12 +65,57 @@ class RequestCreateAccount(models.Model):
     class Meta:
         db_table = 'request_create_account'
 
+class AccountNumberCounter(models.Model):
+    """ Счётчик номеров банковских счетов пользователя """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        verbose_name='Пользователь',
+    )
+    last_value = models.BigIntegerField('Последний выделенный номер')
+    block = models.IntegerField('Размер последнего выделенного блока')
+
+    class Meta:
+        db_table = 'account_number_counter'
+
+class ExchangeRateVersion(models.Model):
+    """ Версия курсов валют """
+    created = models.DateTimeField('Дата и время публикации', auto_now_add=True)
+
+    class Meta:
+        db_table = 'exchange_rate_version'
+
+    def __str__(self):
+        return str(self.pk)
+
+class ExchangeRate(models.Model):
+    """ Курс валюты к общей расчётной единице """
+    version = models.ForeignKey(
+        ExchangeRateVersion,
+        on_delete=models.CASCADE,
+        verbose_name='Версия курсов',
+        related_name='rates',
+    )
+    CURRENCIES = (
+        ('r', 'Рубли'),
+        ('d', 'Доллары'),
+        ('e', 'Евро'),
+    )
+    currency = models.CharField('Валюта', max_length=1, choices=CURRENCIES)
+    rate = models.DecimalField('Курс', max_digits=18, decimal_places=8)
+
+    class Meta:
+        db_table = 'exchange_rate'
+        unique_together = ('version', 'currency')
+
 class Replenishment(models.Model):
     """ Пополнение банековского счёта """
     account = models.ForeignKey(
         Account,
         on_delete=models.CASCADE,
-        verbose_name='Банковский счёт'
+        verbose_name='Банковский счёт',
+        db_index=False,
     )
     amount = models.DecimalField('Величина пополнения', max_digits=12, decimal_places=2)
     CURRENCIES = (
@@ -72,6 +128,11 @@ class Replenishment(models.Model):
 
     class Meta:
         db_table = 'replenishment'
+        indexes = [
+            models.Index(fields=['account', '-created', '-id'], name='replenishment_account_idx'),
+            models.Index(fields=['-created', '-id'], name='replenishment_created_idx'),
+            models.Index(fields=['amount'], name='replenishment_amount_idx'),
+        ]
 
 class Transfer(models.Model):
     """ Перевод средств со счёта на счёт """
@@ -80,12 +141,14 @@ class Transfer(models.Model):
         on_delete=models.CASCADE,
         verbose_name='Банковский счёт для списания',
         related_name='from_account',
+        db_index=False,
     )
     to_account = models.ForeignKey(
         Account,
         on_delete=models.CASCADE,
         verbose_name='Банковский счёт для пополнения',
         related_name='to_account',
+        db_index=False,
     )
     amount = models.DecimalField('Величина перевода', max_digits=12, decimal_places=2)
     CURRENCIES = (
@@ -94,10 +157,23 @@ class Transfer(models.Model):
         ('e', 'Евро'),
     )
     currency = models.CharField('Валюта', max_length=1, choices=CURRENCIES)
+    rate_version = models.ForeignKey(
+        ExchangeRateVersion,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        verbose_name='Версия курсов валют',
+    )
     created = models.DateTimeField('Дата и время перевода', auto_now_add=True)
 
     class Meta:
         db_table = 'transfer'
+        indexes = [
+            models.Index(fields=['from_account', '-created', '-id'], name='transfer_from_account_idx'),
+            models.Index(fields=['to_account', '-created', '-id'], name='transfer_to_account_idx'),
+            models.Index(fields=['-created', '-id'], name='transfer_created_idx'),
+            models.Index(fields=['amount'], name='transfer_amount_idx'),
+        ]
 
 class Payment(models.Model):
     """ Оплата """
@@ -105,6 +181,7 @@ class Payment(models.Model):
         Account,
         on_delete=models.CASCADE,
         verbose_name='Банковский счёт',
+        db_index=False,
     )
     merchant = models.CharField('Продавец', max_length=255)
     amount = models.DecimalField('Величина оплаты', max_digits=12, decimal_places=2)
@@ -118,3 +195,68 @@ class Payment(models.Model):
 
     class Meta:
         db_table = 'payment'
+        indexes = [
+            models.Index(fields=['account', '-created', '-id'], name='payment_account_idx'),
+            models.Index(fields=['-created', '-id'], name='payment_created_idx'),
+            models.Index(fields=['amount'], name='payment_amount_idx'),
+            models.Index(fields=['merchant'], name='payment_merchant_idx', opclasses=['varchar_pattern_ops']),
+        ]
+
+class IdempotencyKey(models.Model):
+    """ Ключ идемпотентности запроса на создание. Пока ответ
+    не сохранён, запрос с этим ключом выполняется, а после
+    locked_until ключ может перехватить повтор """
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        verbose_name='Пользователь',
+        db_index=False,
+    )
+    key = models.CharField('Ключ', max_length=255)
+    fingerprint = models.CharField('Отпечаток запроса', max_length=64)
+    status_code = models.PositiveSmallIntegerField('Код ответа', null=True)
+    response = models.JSONField('Тело ответа', null=True, encoder=DjangoJSONEncoder)
+    locked_until = models.DateTimeField('Аренда ключа до', null=True)
+    created = models.DateTimeField('Дата и время создания', auto_now_add=True)
+
+    class Meta:
+        db_table = 'idempotency_key'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='idempotency_key_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['created'], name='idempotency_key_created_idx'),
+        ]
+
+class OutboxEvent(models.Model):
+    """ Событие изменения баланса банковского счёта для внешних
+    систем. Смещения событий счёта идут подряд в порядке изменений """
+    account = models.ForeignKey(
+        Account,
+        on_delete=models.CASCADE,
+        verbose_name='Банковский счёт',
+        db_index=False,
+    )
+    offset = models.BigIntegerField('Смещение')
+    KINDS = (
+        ('replenishment', 'Пополнение'),
+        ('outgoing_transfer', 'Исходящий перевод'),
+        ('incoming_transfer', 'Входящий перевод'),
+        ('payment', 'Оплата'),
+    )
+    kind = models.CharField('Вид операции', max_length=20, choices=KINDS)
+    operation_id = models.BigIntegerField('Операция', null=True)
+    amount = models.DecimalField('Изменение баланса', max_digits=12, decimal_places=2)
+    CURRENCIES = (
+        ('r', 'Рубли'),
+        ('d', 'Доллары'),
+        ('e', 'Евро'),
+    )
+    currency = models.CharField('Валюта', max_length=1, choices=CURRENCIES)
+    created = models.DateTimeField('Дата и время операции')
+
+    class Meta:
+        db_table = 'outbox_event'
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'offset'], name='outbox_event_offset_unique'),
+        ]
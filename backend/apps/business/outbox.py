@@ -0,0 +1,99 @@
+from collections import Counter
+import json
+import os
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from apps.monitoring.metrics import registry
+from .events import _publish_events
+from .models import Account, OutboxEvent
+
+
+class OutboxSink:
+    """ Приёмник событий outbox. publish получает события одной
+    порции по порядку и должен либо принять все, либо выбросить
+    исключение; в этом случае порция будет отправлена повторно """
+
+    def publish(self, events:list) -> None:
+        raise NotImplementedError
+
+class MemorySink(OutboxSink):
+    """ Приёмник, накапливающий события в памяти процесса """
+
+    def __init__(self):
+        self.events = []
+
+    def publish(self, events:list) -> None:
+        self.events.extend(events)
+
+class FileSink(OutboxSink):
+    """ Приёмник, дописывающий события в файл по строке JSON
+    на событие. Порция сбрасывается на диск до подтверждения """
+
+    def __init__(self, path:str=None):
+        self.path = path or settings.OUTBOX_FILE_PATH
+
+    def publish(self, events:list) -> None:
+        with open(self.path, 'a', encoding='utf-8') as file:
+            for event in events:
+                file.write(json.dumps(event, ensure_ascii=False) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+def _get_outbox_sink() -> OutboxSink:
+    """ Приёмник событий из настройки OUTBOX_SINK """
+    return import_string(settings.OUTBOX_SINK)()
+
+def _write_outbox(events:list) -> None:
+    """ Запись событий изменения балансов в текущей транзакции. events -
+    список (счёт, вид операции, операция, изменение баланса) в порядке
+    изменений. Счётчик event_offset уже увеличен вместе с балансом,
+    и смещения событий отсчитываются назад от его значения. События
+    также рассылаются подписчикам потока событий """
+    counts = Counter(account.pk for account, kind, operation, amount in events)
+    offsets = {
+        account_pk: event_offset - counts[account_pk] + 1
+        for account_pk, event_offset in Account.objects.filter(pk__in=counts).values_list('pk', 'event_offset')
+    }
+    rows = []
+    for account, kind, operation, amount in events:
+        rows.append(OutboxEvent(account_id=account.pk, offset=offsets[account.pk], kind=kind,
+                                operation_id=operation.pk, amount=amount, currency=account.currency,
+                                created=operation.created))
+        offsets[account.pk] += 1
+    OutboxEvent.objects.bulk_create(rows)
+    _publish_events([dict(_event_payload(row), user=account.user_id)
+                     for row, (account, kind, operation, amount) in zip(rows, events)])
+
+def _event_payload(event:OutboxEvent) -> dict:
+    return {
+        'account': event.account_id,
+        'offset': event.offset,
+        'kind': event.kind,
+        'operation': event.operation_id,
+        'amount': '{:.2f}'.format(event.amount),
+        'currency': event.currency,
+        'created': event.created.isoformat(),
+    }
+
+def _relay_outbox(sink:OutboxSink, batch_size:int, progress=None) -> int:
+    """ Отправка накопленных событий в приёмник порциями по pk.
+    Порция удаляется в той же транзакции после успешной отправки,
+    поэтому при сбое события доставляются повторно. События счёта
+    фиксируются под блокировкой строки счёта и попадают в outbox
+    в порядке смещений. Строки порции блокируются, поэтому
+    параллельные ретрансляторы ждут друг друга """
+    relayed = 0
+    while True:
+        with transaction.atomic():
+            events = list(OutboxEvent.objects.select_for_update().order_by('pk')[:batch_size])
+            if not events:
+                return relayed
+            sink.publish([_event_payload(event) for event in events])
+            OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).delete()
+        relayed += len(events)
+        registry.inc('outbox_events_relayed_total', value=len(events))
+        if progress is not None:
+            progress(relayed)
@@ -0,0 +1,122 @@
+from base64 import b64decode, b64encode
+import json
+
+from django.conf import settings
+from django.db import connections
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class OperationsCursorPagination(CursorPagination):
+    """ Курсорная пагинация истории операций
+    по паре (created, id) """
+    ordering = ('-created', '-id')
+    page_size = settings.OPERATIONS_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.OPERATIONS_MAX_PAGE_SIZE
+
+def _estimated_count(queryset) -> int:
+    """ Число строк выборки по статистике планировщика PostgreSQL:
+    reltuples таблицы без фильтров или оценка строк плана с фильтрами.
+    Выборки меньше ESTIMATED_COUNT_THRESHOLD и другие СУБД
+    считаются точно """
+    queryset = queryset.order_by()
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+            estimate = row[0] if row else -1
+        else:
+            sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            estimate = plan[0]['Plan']['Plan Rows']
+    if estimate < settings.ESTIMATED_COUNT_THRESHOLD:
+        return queryset.count()
+    return int(estimate)
+
+class StaffCursorPagination(CursorPagination):
+    """ Курсорная пагинация списков для персонала с оценкой
+    числа строк вместо COUNT(*) """
+    ordering = '-id'
+    page_size = settings.STAFF_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.STAFF_MAX_PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_queryset = queryset
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'count': _estimated_count(self.count_queryset),
+            'results': data,
+        })
+
+class OperationsTimelinePagination(BasePagination):
+    """ Курсорная пагинация общей ленты операций
+    по позиции (created, вид операции, id) """
+    cursor_query_param = 'cursor'
+    page_size = settings.OPERATIONS_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.OPERATIONS_MAX_PAGE_SIZE
+    invalid_cursor_message = 'Неверный курсор.'
+
+    def paginate_timeline(self, timeline, request) -> list:
+        """ Получение страницы ленты. timeline(limit, position)
+        возвращает не более limit операций после позиции """
+        self.request = request
+        page_size = self.get_page_size(request)
+        operations = timeline(page_size + 1, self.decode_cursor(request))
+        self.has_next = len(operations) > page_size
+        page = operations[:page_size]
+        self.next_position = page[-1][1] if self.has_next else None
+        return [(kind, operation) for kind, position, operation in page]
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            created, rank, pk = b64decode(encoded.encode('ascii')).decode('ascii').split('|')
+            created = parse_datetime(created)
+            if created is None:
+                raise ValueError
+            return created, int(rank), int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position) -> str:
+        created, rank, pk = position
+        encoded = b64encode('{}|{}|{}'.format(created.isoformat(), rank, pk).encode('ascii'))
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded.decode('ascii'))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.next_position)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
@@ -0,0 +1,136 @@
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+import binascii
+import csv
+import io
+import os
+import random
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from .models import (
+    Account,
+    Replenishment,
+    Transfer,
+    Payment,
+)
+from .services import ACCOUNT_NUMBER_BASE
+
+CURRENCIES = [currency for currency, name in Account.CURRENCIES]
+MERCHANTS = ['Магнит', 'Пятёрочка', 'Яндекс Такси', 'Ozon', 'Wildberries', 'Аптека', 'МТС', 'Кофейня']
+SEED_PASSWORD = 'seed-password'
+
+
+@contextmanager
+def _explicit_created(*models):
+    """ Отключение auto_now_add у поля created, чтобы
+    операции получили заданные даты """
+    fields = [model._meta.get_field('created') for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+def _random_created(now:object, days:int) -> object:
+    """ Случайная дата за последние days дней, недавние
+    даты встречаются чаще """
+    return now - timedelta(seconds=min(random.expovariate(3 / days), days) * 24 * 60 * 60)
+
+def _random_amount() -> Decimal:
+    """ Сумма операции с логнормальным распределением:
+    много мелких операций и редкие крупные """
+    return Decimal(min(random.lognormvariate(7, 1.5), 10 ** 8)).quantize(Decimal('0.01'))
+
+def _operations_count(mean:int) -> int:
+    """ Число операций по счёту с тяжёлым хвостом распределения """
+    return int(mean * (random.paretovariate(2) - 1))
+
+def _write_rows(model:object, fields:tuple, rows:list) -> None:
+    """ Запись строк в таблицу модели через COPY в PostgreSQL
+    или bulk_create в остальных базах """
+    if not rows:
+        return
+    fields = [model._meta.get_field(field) for field in fields]
+    if connection.vendor != 'postgresql':
+        attnames = [field.attname for field in fields]
+        with _explicit_created(model):
+            model.objects.bulk_create([model(**dict(zip(attnames, row))) for row in rows], batch_size=1000)
+        return
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    columns = ', '.join(field.column for field in fields)
+    with connection.cursor() as cursor:
+        cursor.cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(model._meta.db_table, columns), buffer,
+        )
+
+def _seed(users:int, accounts_per_user:int, operations_per_account:int,
+          days:int=365, batch_size:int=50000, progress=None) -> list:
+    """ Заполнение базы синтетическими пользователями, счетами и операциями.
+    У пользователя от 1 до accounts_per_user счетов, операций по счёту
+    в среднем operations_per_account. Операции пишутся порциями по
+    batch_size строк. Возвращает ключи токенов созданных пользователей """
+    user_model = get_user_model()
+    prefix = 'seed_{}_'.format(binascii.hexlify(os.urandom(3)).decode())
+    password = make_password(SEED_PASSWORD)
+    user_model.objects.bulk_create(
+        [user_model(username=prefix + str(i), password=password) for i in range(users)],
+        batch_size=10000,
+    )
+    user_pks = list(user_model.objects.filter(username__startswith=prefix).values_list('pk', flat=True))
+    tokens = [Token(user_id=user_pk, key=binascii.hexlify(os.urandom(20)).decode()) for user_pk in user_pks]
+    Token.objects.bulk_create(tokens, batch_size=10000)
+    Account.objects.bulk_create([
+        Account(user_id=user_pk,
+                number=str(user_pk * ACCOUNT_NUMBER_BASE + n),
+                type=random.choice('ab'),
+                currency=random.choice(CURRENCIES),
+                balance=Decimal(random.randint(0, 10 ** 8)) / 100)
+        for user_pk in user_pks
+        for n in range(1, random.randint(1, accounts_per_user) + 1)
+    ], batch_size=10000)
+    accounts = list(Account.objects.filter(user_id__in=user_pks).values_list('pk', 'currency'))
+    account_pks = [account_pk for account_pk, currency in accounts]
+
+    now = timezone.now()
+    written = 0
+    replenishments, transfers, payments = [], [], []
+    for account_pk, currency in accounts:
+        for _ in range(_operations_count(operations_per_account)):
+            kind = random.random()
+            if kind < 0.15:
+                replenishments.append((account_pk, _random_amount(), currency, _random_created(now, days)))
+            elif kind < 0.4:
+                transfers.append((account_pk, random.choice(account_pks), _random_amount(),
+                                  currency, _random_created(now, days)))
+            else:
+                payments.append((account_pk, random.choice(MERCHANTS), _random_amount(),
+                                 currency, _random_created(now, days)))
+        if len(replenishments) + len(transfers) + len(payments) >= batch_size:
+            written += _flush_operations(replenishments, transfers, payments)
+            if progress is not None:
+                progress(written)
+    written += _flush_operations(replenishments, transfers, payments)
+    if progress is not None:
+        progress(written)
+    return [token.key for token in tokens]
+
+def _flush_operations(replenishments:list, transfers:list, payments:list) -> int:
+    """ Запись накопленных операций и очистка списков """
+    _write_rows(Replenishment, ('account', 'amount', 'currency', 'created'), replenishments)
+    _write_rows(Transfer, ('from_account', 'to_account', 'amount', 'currency', 'created'), transfers)
+    _write_rows(Payment, ('account', 'merchant', 'amount', 'currency', 'created'), payments)
+    written = len(replenishments) + len(transfers) + len(payments)
+    replenishments.clear()
+    transfers.clear()
+    payments.clear()
+    return written
@@ -1,5 +1,7 @@
-from django.db import transaction
+from decimal import Decimal
+
 from rest_framework import serializers
+from rest_framework.settings import ISO_8601, api_settings
 
 from .models import (
     RequestCreateAccount,
@@ -9,9 +11,12 @@ from .models import (
     Payment,
 )
 from .services import (
-    _check_number_bank_account,
+    InsufficientFundsError,
+    _get_bank_account_by_number,
     _check_amount,
-    _transfer_funds_from_account_to_account,
+    _create_replenishment,
+    _create_transfer,
+    _create_payment,
 )
 
 
@@ -66,6 +71,7 @@ class BankAccountDetailAdminSerializer(serializers.ModelSerializer):
     class Meta:
         model = Account
         fields = '__all__'
+        read_only_fields = ('event_offset',)
 
 class CreateReplenishmentSerializer(serializers.ModelSerializer):
     """ Пополнение банковского счёта """
@@ -80,6 +86,11 @@ class CreateReplenishmentSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('Количество отправляемых средств должно быть больше нуля.')
         return value
 
+    def create(self, validated_data):
+        return _create_replenishment(validated_data['account'],
+                                     validated_data['amount'],
+                                     validated_data['currency'])
+
 class ReplenishmentSerializer(serializers.ModelSerializer):
     """ Просмотр операции пополнения
     банковского счёта """
@@ -91,7 +102,7 @@ class ReplenishmentSerializer(serializers.ModelSerializer):
 
 class CreateTransferAnotherSerializer(serializers.ModelSerializer):
     """ Перевод средств пользователем другому пользователю """
-    account_for_enrollment = serializers.CharField()
+    account_for_enrollment = serializers.CharField(write_only=True)
 
     class Meta:
         model = Transfer
@@ -106,8 +117,9 @@ class CreateTransferAnotherSerializer(serializers.ModelSerializer):
     def validate_account_for_enrollment(self, value):
         """ Проверка корректного номера
         банковского счёта """
-        if _check_number_bank_account(value):
-            return value
+        account = _get_bank_account_by_number(value)
+        if account is not None:
+            return account
         else:
             raise serializers.ValidationError('Банковского счёта с таким номером не существует.')
 
@@ -123,16 +135,12 @@ class CreateTransferAnotherSerializer(serializers.ModelSerializer):
         else:
             raise serializers.ValidationError('Количество отправляемых средств превышает размер текущего баланса.')
 
-    @transaction.atomic
     def create(self, validated_data):
-        acc_for_enroll = validated_data.pop('account_for_enrollment')
-        to_account = Account.objects.get(number=acc_for_enroll)
-        transfer = Transfer.objects.create(from_account=validated_data['from_account'],
-                                           to_account=to_account,
-                                           amount=validated_data['amount'],
-                                           currency=validated_data['from_account'].currency)
-        _transfer_funds_from_account_to_account(transfer.from_account, transfer.to_account, transfer.amount)
-        return transfer
+        to_account = validated_data.pop('account_for_enrollment')
+        try:
+            return _create_transfer(validated_data['from_account'], to_account, validated_data['amount'])
+        except InsufficientFundsError as error:
+            raise serializers.ValidationError(str(error))
 
 class CreateTransferYourselfSerializer(serializers.ModelSerializer):
     """ Перевод средств пользователем
@@ -140,7 +148,7 @@ class CreateTransferYourselfSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Transfer
-        exclude = ('id', 'currency')
+        exclude = ('id', 'currency', 'rate_version')
 
     def __init__(self, *args, **kwargs):
         super(CreateTransferYourselfSerializer, self).__init__(*args, **kwargs)
@@ -151,6 +159,26 @@ class CreateTransferYourselfSerializer(serializers.ModelSerializer):
             queryset=Account.objects.filter(user=self.context['request'].user)
         )
 
+    def validate_amount(self, value):
+        """ Проверка количества отправляемых средств """
+        if value <= 0:
+            raise serializers.ValidationError('Количество отправляемых средств должно быть больше нуля.')
+        return value
+
+    def validate(self, data):
+        if _check_amount(data['from_account'].balance, data['amount']):
+            return data
+        else:
+            raise serializers.ValidationError('Количество отправляемых средств превышает размер текущего баланса.')
+
+    def create(self, validated_data):
+        try:
+            return _create_transfer(validated_data['from_account'],
+                                    validated_data['to_account'],
+                                    validated_data['amount'])
+        except InsufficientFundsError as error:
+            raise serializers.ValidationError(str(error))
+
 class TransferSerializer(serializers.ModelSerializer):
     """ Просмотр операции перевода средств """
     from_account = serializers.StringRelatedField()
@@ -173,6 +201,20 @@ class CreatePaymentSerializer(serializers.ModelSerializer):
             queryset=Account.objects.filter(user=self.context['request'].user)
         )
 
+    def validate_amount(self, value):
+        """ Проверка суммы оплаты """
+        if value <= 0:
+            raise serializers.ValidationError('Сумма оплаты должна быть больше нуля.')
+        return value
+
+    def create(self, validated_data):
+        try:
+            return _create_payment(validated_data['account'],
+                                   validated_data['merchant'],
+                                   validated_data['amount'])
+        except InsufficientFundsError as error:
+            raise serializers.ValidationError(str(error))
+
 class PaymentSerializer(serializers.ModelSerializer):
     """ Просмотр операции оплаты товаров или услуг """
     account = serializers.StringRelatedField()
@@ -181,8 +223,191 @@ class PaymentSerializer(serializers.ModelSerializer):
         model = Payment
         fields = ('id', 'account', 'merchant', 'amount')
 
-class OperationsHistorySerializer(serializers.Serializer):
-    """ Вывод списка всех операций пользователя """
-    replenishment = ReplenishmentSerializer(many=True)
-    transfer = TransferSerializer(many=True)
-    payment = PaymentSerializer(many=True)
\ No newline at end of file
+class BatchOperationSerializer(serializers.Serializer):
+    """ Оплата или перевод в составе пакета операций """
+    TYPES = (
+        ('payment', 'Оплата'),
+        ('transfer', 'Перевод'),
+    )
+    type = serializers.ChoiceField(choices=TYPES)
+    account = serializers.IntegerField(required=False)
+    merchant = serializers.CharField(required=False, max_length=255)
+    from_account = serializers.IntegerField(required=False)
+    account_for_enrollment = serializers.CharField(required=False)
+    amount = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+    def validate_amount(self, value):
+        """ Проверка количества отправляемых средств """
+        if value <= 0:
+            raise serializers.ValidationError('Количество отправляемых средств должно быть больше нуля.')
+        return value
+
+    def validate(self, data):
+        if data['type'] == 'payment':
+            required = ('account', 'merchant')
+        else:
+            required = ('from_account', 'account_for_enrollment')
+        missing = {field: ['Обязательное поле.'] for field in required if field not in data}
+        if missing:
+            raise serializers.ValidationError(missing)
+        return data
+
+class ValuesSerializer:
+    """ Представление строк выборки values() без создания объектов
+    моделей. Вывод совпадает с соответствующим ModelSerializer,
+    связанные значения берутся из выборки через соединение в SQL """
+    fields = ()
+    extra_lookups = ()
+    decimal_field = serializers.DecimalField(max_digits=12, decimal_places=2)
+    datetime_field = serializers.DateTimeField()
+
+    def __init__(self, instance=None, many=False, **kwargs):
+        self.instance = instance
+        self.many = many
+
+    @classmethod
+    def lookups(cls) -> tuple:
+        """ Столбцы для values() """
+        lookups = [lookup for name, lookup, kind in cls.fields]
+        return tuple(lookups) + tuple(lookup for lookup in cls.extra_lookups if lookup not in lookups)
+
+    @classmethod
+    def select(cls, queryset):
+        return queryset.values(*cls.lookups())
+
+    def get_converters(self) -> dict:
+        """ Преобразования значений, повторяющие to_representation
+        полей DRF, но без проверок на каждую строку """
+        quantum = Decimal(1).scaleb(-self.decimal_field.decimal_places)
+        coerce_to_string = getattr(self.decimal_field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+
+        def decimal(value):
+            value = value.quantize(quantum)
+            return '{:f}'.format(value) if coerce_to_string else value
+
+        output_format = getattr(self.datetime_field, 'format', api_settings.DATETIME_FORMAT)
+        if output_format is None or output_format.lower() != ISO_8601:
+            return {'decimal': decimal, 'datetime': self.datetime_field.to_representation}
+        default_timezone = self.datetime_field.default_timezone()
+
+        def datetime(value):
+            if default_timezone is not None:
+                value = value.astimezone(default_timezone)
+            value = value.isoformat()
+            if value.endswith('+00:00'):
+                value = value[:-6] + 'Z'
+            return value
+
+        return {'decimal': decimal, 'datetime': datetime}
+
+    def to_representation(self, row:dict, converters:dict=None) -> dict:
+        if converters is None:
+            converters = self.get_converters()
+        data = {}
+        for name, lookup, kind in self.fields:
+            value = row[lookup]
+            if value is not None and kind is not None:
+                value = converters[kind](value)
+            data[name] = value
+        return data
+
+    @property
+    def data(self):
+        converters = self.get_converters()
+        if self.many:
+            return [self.to_representation(row, converters) for row in self.instance]
+        return self.to_representation(self.instance, converters)
+
+class BankAccountValuesSerializer(ValuesSerializer):
+    """ Банковский счёт, который видит
+    пользователь, из выборки values() """
+    fields = (
+        ('id', 'id', None),
+        ('number', 'number', None),
+        ('balance', 'balance', 'decimal'),
+        ('currency', 'currency', None),
+    )
+
+class BankAccountAdminValuesSerializer(ValuesSerializer):
+    """ Банковский счёт, который видит
+    персонал, из выборки values() """
+    fields = (
+        ('id', 'id', None),
+        ('number', 'number', None),
+        ('user', 'user__username', None),
+        ('type', 'type', None),
+        ('balance', 'balance', 'decimal'),
+        ('currency', 'currency', None),
+    )
+    extra_lookups = ('created',)
+
+class ReplenishmentValuesSerializer(ValuesSerializer):
+    """ Операция пополнения банковского
+    счёта из выборки values() """
+    fields = (
+        ('id', 'id', None),
+        ('account', 'account__number', None),
+        ('amount', 'amount', 'decimal'),
+        ('currency', 'currency', None),
+        ('created', 'created', 'datetime'),
+    )
+
+class TransferValuesSerializer(ValuesSerializer):
+    """ Операция перевода средств
+    из выборки values() """
+    fields = (
+        ('id', 'id', None),
+        ('from_account', 'from_account__number', None),
+        ('to_account', 'to_account__number', None),
+        ('amount', 'amount', 'decimal'),
+        ('currency', 'currency', None),
+        ('rate_version', 'rate_version', None),
+        ('created', 'created', 'datetime'),
+    )
+
+class PaymentValuesSerializer(ValuesSerializer):
+    """ Операция оплаты товаров или
+    услуг из выборки values() """
+    fields = (
+        ('id', 'id', None),
+        ('account', 'account__number', None),
+        ('merchant', 'merchant', None),
+        ('amount', 'amount', 'decimal'),
+    )
+    extra_lookups = ('created',)
+
+class OperationSerializer(serializers.BaseSerializer):
+    """ Операция из общей ленты операций
+    пользователя, представленная парой (вид, объект) """
+    serializers_by_kind = {
+        'replenishment': ReplenishmentSerializer,
+        'outgoing_transfer': TransferSerializer,
+        'incoming_transfer': TransferSerializer,
+        'payment': PaymentSerializer,
+    }
+
+    def to_representation(self, instance):
+        kind, operation = instance
+        data = {'operation': kind}
+        data.update(self.serializers_by_kind[kind](operation).data)
+        return data
+
+class OperationValuesSerializer(ValuesSerializer):
+    """ Операция из общей ленты операций, представленная
+    парой (вид, строка выборки values()) """
+    serializers_by_kind = {
+        'replenishment': ReplenishmentValuesSerializer(),
+        'outgoing_transfer': TransferValuesSerializer(),
+        'incoming_transfer': TransferValuesSerializer(),
+        'payment': PaymentValuesSerializer(),
+    }
+
+    @classmethod
+    def lookups_by_kind(cls) -> dict:
+        return {kind: serializer.lookups() for kind, serializer in cls.serializers_by_kind.items()}
+
+    def to_representation(self, instance, converters:dict=None) -> dict:
+        kind, row = instance
+        data = {'operation': kind}
+        data.update(self.serializers_by_kind[kind].to_representation(row, converters))
+        return data
\ No newline at end of file
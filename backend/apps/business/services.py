@@ -1,44 +1,166 @@
 from decimal import *
+from collections import Counter
+from functools import wraps
+from itertools import islice
+import heapq
+import random
+import time
 
+from django.db import transaction, connection, OperationalError
+from django.db.models import Q, F, Case, When, Count, Max, Value, IntegerField
+from django.utils import timezone
+
+from .caching import _invalidate_accounts
+from .exchange import _get_rate_matrix, _convert
+from .outbox import _write_outbox
 from .models import (
     Account,
+    AccountNumberCounter,
+    RequestCreateAccount,
+    Replenishment,
+    Transfer,
+    Payment,
+)
+
+# Коды ошибок PostgreSQL, после которых транзакцию можно повторить:
+# serialization_failure и deadlock_detected
+RETRYABLE_PGCODES = ('40001', '40P01')
+TRANSACTION_ATTEMPTS = 5
+TRANSACTION_RETRY_DELAY = 0.01
+
+# Номер счёта составляется из pk пользователя и порядкового
+# номера счёта: pk * ACCOUNT_NUMBER_BASE + n
+ACCOUNT_NUMBER_BASE = 10000
+
+OPERATION_KINDS = (
+    'replenishment',
+    'outgoing_transfer',
+    'incoming_transfer',
+    'payment',
 )
 
 
+class InsufficientFundsError(Exception):
+    """ Недостаточно средств на банковском счёте """
+
+class AccountNumbersExhaustedError(Exception):
+    """ Исчерпаны номера банковских счетов пользователя """
+
+def _retry_on_conflict(func):
+    """ Выполнение функции в транзакции с ограниченным числом повторов
+    при ошибках сериализации и взаимоблокировках. Внутри уже открытой
+    транзакции повтор невозможен, и функция выполняется один раз """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if connection.in_atomic_block:
+            with transaction.atomic():
+                return func(*args, **kwargs)
+        for attempt in range(1, TRANSACTION_ATTEMPTS + 1):
+            try:
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            except OperationalError as error:
+                pgcode = getattr(error.__cause__, 'pgcode', None)
+                if pgcode not in RETRYABLE_PGCODES or attempt == TRANSACTION_ATTEMPTS:
+                    raise
+            time.sleep(random.uniform(0, TRANSACTION_RETRY_DELAY * 2 ** attempt))
+    return wrapper
+
+def _debit_bank_account(account_pk:int, amount:Decimal) -> None:
+    """ Списание средств с банковского счёта. Проверка баланса
+    и списание выполняются одним условным UPDATE """
+    debited = Account.objects.filter(pk=account_pk, balance__gte=amount).update(
+        balance=F('balance') - amount,
+        event_offset=F('event_offset') + 1,
+        updated=timezone.now(),
+    )
+    if not debited:
+        raise InsufficientFundsError('Количество отправляемых средств превышает размер текущего баланса.')
+
+def _credit_bank_account(account_pk:int, amount:Decimal) -> None:
+    """ Зачисление средств на банковский счёт """
+    Account.objects.filter(pk=account_pk).update(
+        balance=F('balance') + amount,
+        event_offset=F('event_offset') + 1,
+        updated=timezone.now(),
+    )
+
+def _allocate_numbers_bank_account(counts:dict) -> dict:
+    """ Выделение блоков номеров банковских счетов одним запросом.
+    Принимает {pk пользователя: количество номеров}, возвращает
+    {pk пользователя: [номера]}. Счётчик пользователя создаётся при
+    первом выделении и начинается после уже существующих номеров.
+    Номер не может выйти за ACCOUNT_NUMBER_BASE - 1, иначе он совпадёт с
+    номером следующего пользователя: в этом случае выделение отменяется
+    и выбрасывается AccountNumbersExhaustedError """
+    if not counts:
+        return {}
+    values = ', '.join(['(%s, %s)'] * len(counts))
+    params = [value for user_pk, count in counts.items() for value in (user_pk, count)]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {AccountNumberCounter._meta.db_table} (user_id, last_value, block) '
+            f'SELECT requested.column1, COALESCE(('
+            f'    SELECT MAX(CAST(number AS BIGINT)) - requested.column1 * %s '
+            f'    FROM {Account._meta.db_table} WHERE user_id = requested.column1'
+            f'), 0) + requested.column2, requested.column2 '
+            f'FROM (VALUES {values}) AS requested WHERE true '
+            f'ON CONFLICT (user_id) DO UPDATE SET '
+            f'last_value = {AccountNumberCounter._meta.db_table}.last_value + EXCLUDED.block, '
+            f'block = EXCLUDED.block '
+            f'RETURNING user_id, last_value, block',
+            [ACCOUNT_NUMBER_BASE] + params,
+        )
+        rows = cursor.fetchall()
+        if any(last_value >= ACCOUNT_NUMBER_BASE for user_pk, last_value, block in rows):
+            raise AccountNumbersExhaustedError('Исчерпаны номера банковских счетов пользователя.')
+    return {
+        user_pk: [str(user_pk * ACCOUNT_NUMBER_BASE + value) for value in range(last_value - block + 1, last_value + 1)]
+        for user_pk, last_value, block in rows
+    }
+
 def _generate_number_bank_account(user:object) -> str:
     """ Генерация номера банковского счёта """
-    if Account.objects.filter(user=user).last():
-        account = Account.objects.filter(user=user).last()
-        return str(int(account.number) + 1)
-    else:
-        number = str(user.pk) + '0001'
-        return number
+    return _allocate_numbers_bank_account({user.pk: 1})[user.pk][0]
+
+def _confirm_requests_create_account(queryset:object, chunk_size:int, progress=None) -> int:
+    """ Подтверждение запросов на создание банковских счетов порциями.
+    В каждой порции номера выделяются одним запросом, счета создаются
+    через bulk_create, а обработанные запросы удаляются. progress
+    вызывается с числом подтверждённых запросов после каждой порции """
+    confirmed = 0
+    while True:
+        with transaction.atomic():
+            requests = list(queryset.select_for_update(skip_locked=True).order_by('pk')[:chunk_size])
+            if not requests:
+                return confirmed
+            numbers = _allocate_numbers_bank_account({request.user_id: 1 for request in requests})
+            Account.objects.bulk_create([
+                Account(user_id=request.user_id,
+                        number=numbers[request.user_id][0],
+                        type=request.type,
+                        currency=request.currency)
+                for request in requests
+            ])
+            RequestCreateAccount.objects.filter(pk__in=[request.pk for request in requests]).delete()
+            _invalidate_accounts(*[request.user_id for request in requests])
+        confirmed += len(requests)
+        if progress is not None:
+            progress(confirmed)
 
 def _currency_exchange(from_currency:str, to_currency:str, amount:Decimal) -> Decimal:
-    """ Обмен валюты """
-    currencies = {
-        'r': 59.65,
-        'd': 1.02,
-        'e': 0.95,
-    }
-    franc = amount / Decimal(currencies[from_currency])
-    return franc * Decimal(currencies[to_currency])
+    """ Обмен валюты по текущей версии курсов """
+    version, matrix = _get_rate_matrix()
+    return _convert(matrix, from_currency, to_currency, amount)
 
 def _replenishment_bank_account(account_pk:int, amount:Decimal, currency:str) -> None:
     """ Пополнение банковского счёта """
-    account = Account.objects.get(pk=account_pk)
-    account.balance += amount
-    account.save()
-
-def _check_number_bank_account(number:str) -> bool:
-    """ Проверка существования банковского счёта
-    с данным номером """
-    try:
-        Account.objects.get(number=number)
-    except:
-        return False
+    _credit_bank_account(account_pk, amount)
 
-    return True
+def _get_bank_account_by_number(number:str) -> object:
+    """ Банковский счёт с данным номером или None,
+    если такого счёта не существует """
+    return Account.objects.filter(number=number).first()
 
 def _check_amount(balance:Decimal, amount:Decimal) -> bool:
     """ Проверка не превышает ли количество отправляемых
@@ -48,16 +170,197 @@ def _check_amount(balance:Decimal, amount:Decimal) -> bool:
     else:
         return True
 
-def _transfer_funds_from_account_to_account(from_account:object, to_account:object, amount:Decimal) -> None:
-    """ Перевод средств со счёта на счёт """
-    new_amount = _currency_exchange(from_account.currency, to_account.currency, amount)
-    from_account.balance -= amount
-    to_account.balance += new_amount
-    from_account.save()
-    to_account.save()
+def _transfer_funds_from_account_to_account(from_account:object, to_account:object, amount:Decimal) -> tuple:
+    """ Перевод средств со счёта на счёт. Строки счетов обновляются
+    в порядке возрастания pk, чтобы встречные переводы не приводили
+    к взаимоблокировкам. Возвращает использованную версию курсов
+    и зачисленную сумму """
+    version, matrix = _get_rate_matrix()
+    new_amount = _convert(matrix, from_account.currency, to_account.currency, amount)
+    if from_account.pk <= to_account.pk:
+        _debit_bank_account(from_account.pk, amount)
+        _credit_bank_account(to_account.pk, new_amount)
+    else:
+        _credit_bank_account(to_account.pk, new_amount)
+        _debit_bank_account(from_account.pk, amount)
+    return version, new_amount
 
-def _payment(account_pk:str, amount:Decimal) -> None:
+def _payment(account_pk:int, amount:Decimal) -> None:
     """ Оплата товаров или услуг """
-    account = Account.objects.get(pk=account_pk)
-    account.balance -= amount
-    account.save()
\ No newline at end of file
+    _debit_bank_account(account_pk, amount)
+
+@_retry_on_conflict
+def _create_replenishment(account:object, amount:Decimal, currency:str) -> object:
+    """ Пополнение банковского счёта с записью операции """
+    _replenishment_bank_account(account.pk, amount, currency)
+    _invalidate_accounts(account.user_id)
+    replenishment = Replenishment.objects.create(account=account, amount=amount, currency=currency)
+    _write_outbox([(account, 'replenishment', replenishment, amount)])
+    return replenishment
+
+@_retry_on_conflict
+def _create_transfer(from_account:object, to_account:object, amount:Decimal) -> object:
+    """ Перевод средств со счёта на счёт с записью операции """
+    version, new_amount = _transfer_funds_from_account_to_account(from_account, to_account, amount)
+    _invalidate_accounts(from_account.user_id, to_account.user_id)
+    transfer = Transfer.objects.create(from_account=from_account,
+                                       to_account=to_account,
+                                       amount=amount,
+                                       currency=from_account.currency,
+                                       rate_version_id=version)
+    _write_outbox([(from_account, 'outgoing_transfer', transfer, -amount),
+                   (to_account, 'incoming_transfer', transfer, new_amount)])
+    return transfer
+
+@_retry_on_conflict
+def _create_payment(account:object, merchant:str, amount:Decimal) -> object:
+    """ Оплата товаров или услуг с записью операции """
+    _payment(account.pk, amount)
+    _invalidate_accounts(account.user_id)
+    payment = Payment.objects.create(account=account,
+                                     merchant=merchant,
+                                     amount=amount,
+                                     currency=account.currency)
+    _write_outbox([(account, 'payment', payment, -amount)])
+    return payment
+
+def _operation_streams(user:object, lookups:dict=None) -> tuple:
+    """ Выборки операций пользователя каждого вида, в порядке
+    OPERATION_KINDS. Если переданы столбцы по видам операций,
+    выборки возвращают словари values() """
+    streams = (
+        Replenishment.objects.select_related('account').filter(account__user=user),
+        Transfer.objects.select_related('from_account', 'to_account').filter(from_account__user=user),
+        Transfer.objects.select_related('from_account', 'to_account').filter(to_account__user=user),
+        Payment.objects.select_related('account').filter(account__user=user),
+    )
+    if lookups is None:
+        return streams
+    return tuple(queryset.values(*lookups[kind]) for kind, queryset in zip(OPERATION_KINDS, streams))
+
+def _after_position(rank:int, position:tuple) -> Q:
+    """ Условие на операции вида rank, идущие в ленте
+    после позиции (created, rank, id) """
+    created, position_rank, pk = position
+    if rank < position_rank:
+        return Q(created__lte=created)
+    condition = Q(created__lt=created)
+    if rank == position_rank:
+        condition |= Q(created=created, id__lt=pk)
+    return Q(created__lte=created) & condition
+
+def _operations_timeline(user:object, limit:int, position:tuple=None, lookups:dict=None) -> list:
+    """ Лента всех операций пользователя по убыванию (created, вид, id).
+    Каждый вид читается отдельным упорядоченным запросом не более
+    чем из limit строк, после чего потоки сливаются. Со столбцами
+    lookups операции возвращаются словарями values() """
+    streams = []
+    for rank, queryset in enumerate(_operation_streams(user, lookups)):
+        if position is not None:
+            queryset = queryset.filter(_after_position(rank, position))
+        operations = queryset.order_by('-created', '-id')[:limit]
+        if lookups is None:
+            streams.append([((operation.created, rank, operation.pk), operation)
+                            for operation in operations])
+        else:
+            streams.append([((operation['created'], rank, operation['id']), operation)
+                            for operation in operations])
+    merged = heapq.merge(*streams, key=lambda item: item[0], reverse=True)
+    return [(OPERATION_KINDS[key[1]], key, operation)
+            for key, operation in islice(merged, limit)]
+
+def _operations_fingerprint(user:object) -> tuple:
+    """ Число операций, время и pk последней операции каждого
+    вида в ленте пользователя, одним запросом """
+    user_fields = ('account__user', 'from_account__user', 'to_account__user', 'account__user')
+    rows = []
+    for rank, (queryset, user_field) in enumerate(zip(_operation_streams(user), user_fields)):
+        rows.append(queryset.select_related(None).order_by().values(user_field).annotate(
+            rank=Value(rank, output_field=IntegerField()),
+            count=Count('pk'),
+            last=Max('created'),
+            last_pk=Max('pk'),
+        ).values_list('rank', 'count', 'last', 'last_pk'))
+    return tuple(sorted(rows[0].union(*rows[1:], all=True)))
+
+def _bulk_create(model:object, objects:list) -> None:
+    """ Вставка операций через bulk_create с заполнением первичных
+    ключей. Если база не возвращает ключи вставленных строк, в SQLite
+    они дочитываются в той же транзакции, где запись уже
+    сериализована, а в остальных базах операции сохраняются по одной """
+    if not objects or connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objects)
+    elif connection.vendor == 'sqlite':
+        model.objects.bulk_create(objects)
+        pks = model.objects.order_by('-pk').values_list('pk', flat=True)[:len(objects)]
+        for obj, pk in zip(objects, reversed(list(pks))):
+            obj.pk = pk
+    else:
+        for obj in objects:
+            obj.save(force_insert=True)
+
+@_retry_on_conflict
+def _apply_operations_batch(user:object, operations:list) -> list:
+    """ Пакетное проведение оплат и переводов пользователя.
+    Все задействованные счета читаются и блокируются одним запросом,
+    операции пишутся через bulk_create, а балансы обновляются одним
+    UPDATE. Возвращает результат по каждой операции в исходном порядке """
+    own_pks = {operation.get('account') or operation.get('from_account') for operation in operations}
+    numbers = {operation['account_for_enrollment'] for operation in operations
+               if operation['type'] == 'transfer'}
+    accounts = list(Account.objects.select_for_update().filter(
+        Q(user=user, pk__in=own_pks) | Q(number__in=numbers)
+    ).order_by('pk'))
+    own = {account.pk: account for account in accounts if account.user_id == user.pk}
+    by_number = {account.number: account for account in accounts}
+
+    version, matrix = _get_rate_matrix()
+    balances = {account.pk: account.balance for account in accounts}
+    results, transfers, payments, events = [], [], [], []
+    for operation in operations:
+        account = own.get(operation.get('account') or operation.get('from_account'))
+        if account is None:
+            results.append({'status': 'error', 'errors': ['Банковский счёт не найден.']})
+            continue
+        amount = operation['amount']
+        if balances[account.pk] < amount:
+            results.append({'status': 'error',
+                            'errors': ['Количество отправляемых средств превышает размер текущего баланса.']})
+            continue
+        if operation['type'] == 'payment':
+            balances[account.pk] -= amount
+            payments.append(Payment(account=account, merchant=operation['merchant'],
+                                    amount=amount, currency=account.currency))
+            events.append((account, 'payment', payments[-1], -amount))
+            results.append({'status': 'ok', 'operation': payments[-1]})
+            continue
+        to_account = by_number.get(operation['account_for_enrollment'])
+        if to_account is None:
+            results.append({'status': 'error', 'errors': ['Банковского счёта с таким номером не существует.']})
+            continue
+        new_amount = _convert(matrix, account.currency, to_account.currency, amount)
+        balances[account.pk] -= amount
+        balances[to_account.pk] += new_amount
+        transfers.append(Transfer(from_account=account, to_account=to_account,
+                                  amount=amount, currency=account.currency,
+                                  rate_version_id=version))
+        events.append((account, 'outgoing_transfer', transfers[-1], -amount))
+        events.append((to_account, 'incoming_transfer', transfers[-1], new_amount))
+        results.append({'status': 'ok', 'operation': transfers[-1]})
+
+    counts = Counter(account.pk for account, kind, operation, amount in events)
+    changed = [account for account in accounts if account.pk in counts]
+    if changed:
+        Account.objects.filter(pk__in=[account.pk for account in changed]).update(
+            balance=Case(*[When(pk=account.pk, then=F('balance') + (balances[account.pk] - account.balance))
+                           for account in changed]),
+            event_offset=Case(*[When(pk=account.pk, then=F('event_offset') + counts[account.pk])
+                                for account in changed]),
+            updated=timezone.now(),
+        )
+        _invalidate_accounts(*[account.user_id for account in changed])
+    _bulk_create(Transfer, transfers)
+    _bulk_create(Payment, payments)
+    if events:
+        _write_outbox(events)
+    return results
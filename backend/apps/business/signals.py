@@ -0,0 +1,12 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .caching import _invalidate_accounts
+from .models import Account
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def invalidate_accounts(sender, instance, **kwargs):
+    """ Создание, изменение и удаление банковского счёта """
+    _invalidate_accounts(instance.user_id)
@@ -1,3 +1,923 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connection, connections, transaction
+from django.db.models import F, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory
+
+from backend.routers import ReplicaRouter, _use_replica
+from .caching import ACCOUNTS_CACHE_ALIAS
+from .events import events_application
+from .exchange import (
+    _convert,
+    _convert_many,
+    _get_rate_matrix,
+    _publish_exchange_rates,
+    _reset_rate_matrix,
+)
+from .exports import STATEMENT_FIELDS
+from .idempotency import _idempotent_response, _request_fingerprint
+from .models import (
+    Account,
+    AccountNumberCounter,
+    ExchangeRateVersion,
+    RequestCreateAccount,
+    Replenishment,
+    Transfer,
+    Payment,
+    IdempotencyKey,
+    OutboxEvent,
+)
+from .outbox import MemorySink, OutboxSink, _relay_outbox
+from .pagination import _estimated_count
+from .seeding import MERCHANTS, _seed
+from .serializers import (
+    ReplenishmentSerializer,
+    TransferSerializer,
+    PaymentSerializer,
+    OperationSerializer,
+    ReplenishmentValuesSerializer,
+    TransferValuesSerializer,
+    PaymentValuesSerializer,
+    OperationValuesSerializer,
+)
+from .services import (
+    AccountNumbersExhaustedError,
+    InsufficientFundsError,
+    _create_replenishment,
+    _create_transfer,
+    _create_payment,
+    _apply_operations_batch,
+    _allocate_numbers_bank_account,
+    _confirm_requests_create_account,
+    _operations_timeline,
+)
+
+
+class TransferEngineTest(TestCase):
+    """ Списание и зачисление средств """
+
+    def setUp(self):
+        user = get_user_model().objects.create_user('user')
+        self.first = Account.objects.create(user=user, number='10001', type='a', currency='r', balance=100)
+        self.second = Account.objects.create(user=user, number='10002', type='a', currency='r', balance=0)
+
+    def test_transfer(self):
+        _create_transfer(self.first, self.second, Decimal('30'))
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual(self.first.balance, Decimal('70'))
+        self.assertEqual(self.second.balance, Decimal('30'))
+
+    def test_insufficient_funds(self):
+        with self.assertRaises(InsufficientFundsError):
+            _create_payment(self.first, 'shop', Decimal('100.01'))
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.balance, Decimal('100'))
+        self.assertFalse(Transfer.objects.exists())
+
+class ExchangeRatesTest(TestCase):
+    """ Кросс-курсы округляют суммы до копеек по банковскому
+    правилу, а матрица обновляется с новой версией курсов """
+
+    def setUp(self):
+        _reset_rate_matrix()
+
+    def test_rounding(self):
+        _publish_exchange_rates({'r': Decimal('2'), 'd': Decimal('1'), 'e': Decimal('3')})
+        version, matrix = _get_rate_matrix()
+        self.assertEqual(_convert(matrix, 'r', 'd', Decimal('0.05')), Decimal('0.02'))
+        self.assertEqual(_convert(matrix, 'r', 'd', Decimal('0.07')), Decimal('0.04'))
+        self.assertEqual(_convert(matrix, 'r', 'd', Decimal('0.01')), Decimal('0.00'))
+        self.assertEqual(_convert(matrix, 'e', 'r', Decimal('1.00')), Decimal('0.67'))
+        self.assertEqual(_convert(matrix, 'e', 'e', Decimal('1.005')), Decimal('1.005'))
+        self.assertEqual(_convert_many(matrix, 'r', 'd', [Decimal('0.05'), Decimal('0.07')]),
+                         [Decimal('0.02'), Decimal('0.04')])
+
+    def test_invalidation(self):
+        version, matrix = _get_rate_matrix()
+        self.assertIsNone(version)
+        with self.captureOnCommitCallbacks(execute=True):
+            published = _publish_exchange_rates({'r': Decimal('2'), 'd': Decimal('1'), 'e': Decimal('3')})
+        version, matrix = _get_rate_matrix()
+        self.assertEqual(version, published.pk)
+        self.assertEqual(matrix['r', 'd'], Decimal('0.5'))
+        with self.assertNumQueries(0):
+            self.assertEqual(_get_rate_matrix(), (version, matrix))
+
+        with override_settings(EXCHANGE_RATES_REFRESH_SECONDS=0):
+            published = _publish_exchange_rates({'r': Decimal('4'), 'd': Decimal('1'), 'e': Decimal('3')})
+            version, matrix = _get_rate_matrix()
+            self.assertEqual(version, published.pk)
+            self.assertEqual(matrix['r', 'd'], Decimal('0.25'))
+            with self.assertNumQueries(1):
+                self.assertIs(_get_rate_matrix()[1], matrix)
+
+    def test_invalid_rates(self):
+        for rate in ('0', '-1', 'NaN', 'Infinity'):
+            with self.assertRaises(ValueError):
+                _publish_exchange_rates({'r': Decimal(rate), 'd': Decimal('1'), 'e': Decimal('3')})
+        with self.assertRaises(ValueError):
+            _publish_exchange_rates({'r': Decimal('2'), 'd': Decimal('1')})
+        self.assertFalse(ExchangeRateVersion.objects.exists())
+
+class QueryBudgetTest(TestCase):
+    """ Число SQL-запросов на один вызов API не зависит
+    от количества операций и счетов пользователя """
+
+    def setUp(self):
+        _reset_rate_matrix()
+        caches[ACCOUNTS_CACHE_ALIAS].clear()
+        user = get_user_model().objects.create_user('user')
+        other = get_user_model().objects.create_user('other')
+        self.account = Account.objects.create(user=user, number='10001', type='a', currency='r', balance=1000)
+        self.other_account = Account.objects.create(user=other, number='20001', type='a', currency='d')
+        for _ in range(20):
+            Replenishment.objects.create(account=self.account, amount=1, currency='r')
+            Transfer.objects.create(from_account=self.account, to_account=self.other_account, amount=1, currency='r')
+            Transfer.objects.create(from_account=self.other_account, to_account=self.account, amount=1, currency='d')
+            Payment.objects.create(account=self.account, merchant='shop', amount=1, currency='r')
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def assertBudget(self, budget, method, path, data=None):
+        with self.assertNumQueries(budget):
+            response = getattr(self.client, method)(path, data, format='json')
+        self.assertLess(response.status_code, 300)
+
+    def test_history_budgets(self):
+        self.assertBudget(1, 'get', '/api/accounts/')
+        self.assertBudget(1, 'get', '/api/operations/replenishments/')
+        self.assertBudget(1, 'get', '/api/operations/transfers/')
+        self.assertBudget(1, 'get', '/api/operations/payments/')
+        self.assertBudget(5, 'get', '/api/operations/')
+
+    def test_not_modified(self):
+        for path, budget in (('/api/accounts/', 0),
+                             ('/api/operations/replenishments/', 1),
+                             ('/api/operations/transfers/', 1),
+                             ('/api/operations/payments/', 1),
+                             ('/api/operations/', 1)):
+            etag = self.client.get(path)['ETag']
+            with self.assertNumQueries(budget):
+                response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+        etags = [self.client.get(path)['ETag'] for path in ('/api/operations/', '/api/operations/payments/')]
+        Payment.objects.create(account=self.account, merchant='shop', amount=1, currency='r')
+        self.assertEqual(self.client.get('/api/operations/', HTTP_IF_NONE_MATCH=etags[0]).status_code, 200)
+        self.assertEqual(self.client.get('/api/operations/payments/', HTTP_IF_NONE_MATCH=etags[1]).status_code, 200)
+
+    def test_create_budgets(self):
+        self.assertBudget(10, 'post', '/api/operations/transfers/create/another/', {
+            'from_account': self.account.pk, 'account_for_enrollment': '20001', 'amount': '1',
+        })
+        self.assertBudget(7, 'post', '/api/operations/payments/create/', {
+            'account': self.account.pk, 'merchant': 'shop', 'amount': '1',
+        })
+
+    def test_batch_budget(self):
+        operations = [
+            {'type': 'payment', 'account': self.account.pk, 'merchant': 'shop', 'amount': '1'},
+            {'type': 'transfer', 'from_account': self.account.pk, 'account_for_enrollment': '20001', 'amount': '1'},
+        ] * 40
+        # Без RETURNING в bulk_create ключи переводов и оплат дочитываются отдельно
+        budget = 9 if connection.features.can_return_rows_from_bulk_insert else 11
+        self.assertBudget(budget, 'post', '/api/operations/batch/create/', operations)
+
+    def test_values_serializers(self):
+        """ Быстрое представление через values()
+        совпадает с ModelSerializer """
+        for serializer, values_serializer, model in (
+            (ReplenishmentSerializer, ReplenishmentValuesSerializer, Replenishment),
+            (TransferSerializer, TransferValuesSerializer, Transfer),
+            (PaymentSerializer, PaymentValuesSerializer, Payment),
+        ):
+            queryset = model.objects.order_by('id')
+            self.assertEqual([dict(item) for item in serializer(queryset, many=True).data],
+                             values_serializer(values_serializer.select(queryset), many=True).data)
+        user = self.account.user
+        lookups = OperationValuesSerializer.lookups_by_kind()
+        self.assertEqual(
+            OperationSerializer([(kind, row) for kind, position, row in _operations_timeline(user, 100)],
+                                many=True).data,
+            OperationValuesSerializer([(kind, row) for kind, position, row in _operations_timeline(user, 100, None, lookups)],
+                                      many=True).data,
+        )
+
+class TimelinePaginationTest(TestCase):
+    """ Страницы ленты операций без пропусков и повторов,
+    в том числе для операций разных видов с одинаковым временем """
+
+    def setUp(self):
+        _reset_rate_matrix()
+        self.user = get_user_model().objects.create_user('user')
+        other = get_user_model().objects.create_user('other')
+        account = Account.objects.create(user=self.user, number='10001', type='a', currency='r', balance=1000)
+        other_account = Account.objects.create(user=other, number='20001', type='a', currency='r', balance=1000)
+        for _ in range(3):
+            Replenishment.objects.create(account=account, amount=1, currency='r')
+            Transfer.objects.create(from_account=account, to_account=other_account, amount=1, currency='r')
+            Transfer.objects.create(from_account=other_account, to_account=account, amount=1, currency='r')
+            Payment.objects.create(account=account, merchant='shop', amount=1, currency='r')
+        created = timezone.now()
+        for model in (Replenishment, Transfer, Payment):
+            pks = list(model.objects.order_by('pk').values_list('pk', flat=True))
+            model.objects.filter(pk__in=pks[::2]).update(created=created)
+            model.objects.filter(pk__in=pks[1::2]).update(created=created - timedelta(seconds=1))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_pages(self):
+        expected = [(kind, operation.pk) for kind, position, operation in _operations_timeline(self.user, 100)]
+        self.assertEqual(len(expected), 12)
+        for page_size in (1, 2, 5):
+            seen, url = [], '/api/operations/?page_size={}'.format(page_size)
+            while url and len(seen) <= len(expected):
+                data = self.client.get(url).data
+                seen.extend((item['operation'], item['id']) for item in data['results'])
+                url = data['next']
+            self.assertEqual(seen, expected)
+
+class HistoryPaginationTest(TestCase):
+    """ Страницы истории операций одного вида без пропусков и повторов
+    в порядке (-created, -id), в том числе при одинаковом времени """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user')
+        other = get_user_model().objects.create_user('other')
+        account = Account.objects.create(user=self.user, number='10001', type='a', currency='r', balance=1000)
+        other_account = Account.objects.create(user=other, number='20001', type='a', currency='r', balance=1000)
+        for _ in range(7):
+            Replenishment.objects.create(account=account, amount=1, currency='r')
+            Transfer.objects.create(from_account=account, to_account=other_account, amount=1, currency='r')
+            Payment.objects.create(account=account, merchant='shop', amount=1, currency='r')
+        Payment.objects.create(account=other_account, merchant='shop', amount=1, currency='r')
+        created = timezone.now()
+        for model in (Replenishment, Transfer, Payment):
+            pks = list(model.objects.order_by('pk').values_list('pk', flat=True))
+            model.objects.filter(pk__in=pks[::3]).update(created=created)
+            model.objects.filter(pk__in=pks[1::3]).update(created=created - timedelta(seconds=1))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_pages(self):
+        for path, queryset in (('payments', Payment.objects.filter(account__user=self.user)),
+                               ('transfers', Transfer.objects.filter(from_account__user=self.user)),
+                               ('replenishments', Replenishment.objects.filter(account__user=self.user))):
+            expected = list(queryset.order_by('-created', '-id').values_list('pk', flat=True))
+            self.assertEqual(len(expected), 7)
+            for page_size in (1, 2, 3):
+                seen, url = [], '/api/operations/{}/?page_size={}'.format(path, page_size)
+                while url and len(seen) <= len(expected):
+                    data = self.client.get(url).data
+                    self.assertLessEqual(len(data['results']), page_size)
+                    seen.extend(item['id'] for item in data['results'])
+                    url = data['next']
+                self.assertEqual(seen, expected, path)
+
+class BatchOperationsTest(TestCase):
+    """ Пакетное проведение операций возвращает результат по
+    каждой операции и меняет балансы только проведённых """
+
+    def setUp(self):
+        _reset_rate_matrix()
+        user = get_user_model().objects.create_user('user')
+        other = get_user_model().objects.create_user('other')
+        self.account = Account.objects.create(user=user, number='10001', type='a', currency='r', balance=100)
+        self.other_account = Account.objects.create(user=other, number='20001', type='a', currency='r')
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def post(self, operations):
+        return self.client.post('/api/operations/batch/create/', operations, format='json')
+
+    def test_items(self):
+        response = self.post([
+            {'type': 'payment', 'account': self.account.pk, 'merchant': 'shop', 'amount': '10'},
+            {'type': 'payment', 'account': self.other_account.pk, 'merchant': 'shop', 'amount': '1'},
+            {'type': 'transfer', 'from_account': self.account.pk, 'account_for_enrollment': '20001', 'amount': '20'},
+            {'type': 'payment', 'account': self.account.pk, 'merchant': 'shop', 'amount': '100'},
+            {'type': 'transfer', 'from_account': self.account.pk, 'account_for_enrollment': '99999', 'amount': '1'},
+            {'type': 'payment', 'account': self.account.pk, 'amount': '1'},
+        ])
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([result['status'] for result in response.data],
+                         ['ok', 'error', 'ok', 'error', 'error', 'error'])
+        self.assertEqual(response.data[0]['id'], Payment.objects.get().pk)
+        self.assertEqual(response.data[2]['id'], Transfer.objects.get().pk)
+        self.assertIn('merchant', response.data[5]['errors'])
+        self.assertEqual(Account.objects.get(pk=self.account.pk).balance, Decimal('70'))
+        self.assertEqual(Account.objects.get(pk=self.other_account.pk).balance, Decimal('20'))
+        self.assertEqual(sorted(OutboxEvent.objects.values_list('operation_id', flat=True)),
+                         sorted([response.data[0]['id'], response.data[2]['id'], response.data[2]['id']]))
+
+    def test_statuses(self):
+        payment = {'type': 'payment', 'account': self.account.pk, 'merchant': 'shop', 'amount': '1'}
+        self.assertEqual(self.post([payment, payment]).status_code, 200)
+        response = self.post([dict(payment, amount='1000'), dict(payment, account=self.other_account.pk)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([result['status'] for result in response.data], ['error', 'error'])
+        self.assertEqual(Account.objects.get(pk=self.account.pk).balance, Decimal('98'))
+
+class AccountNumbersTest(TestCase):
+    """ Номера счетов выделяются подряд в диапазоне
+    пользователя и не выходят за его границу """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user')
+        self.other = get_user_model().objects.create_user('other')
+        self.base = self.user.pk * 10000
+
+    def test_sequential(self):
+        Account.objects.create(user=self.user, number=str(self.base + 5), type='a', currency='r')
+        self.assertEqual(_allocate_numbers_bank_account({self.user.pk: 1}), {self.user.pk: [str(self.base + 6)]})
+        self.assertEqual(_allocate_numbers_bank_account({self.user.pk: 1}), {self.user.pk: [str(self.base + 7)]})
+
+    def test_blocks(self):
+        numbers = _allocate_numbers_bank_account({self.user.pk: 3, self.other.pk: 2})
+        self.assertEqual(numbers[self.user.pk], [str(self.base + n) for n in (1, 2, 3)])
+        self.assertEqual(numbers[self.other.pk], [str(self.other.pk * 10000 + n) for n in (1, 2)])
+        self.assertEqual(_allocate_numbers_bank_account({self.user.pk: 2})[self.user.pk],
+                         [str(self.base + n) for n in (4, 5)])
+
+    def test_overflow(self):
+        _allocate_numbers_bank_account({self.user.pk: 9998})
+        with self.assertRaises(AccountNumbersExhaustedError):
+            _allocate_numbers_bank_account({self.user.pk: 2, self.other.pk: 1})
+        self.assertEqual(AccountNumberCounter.objects.get(user=self.user).last_value, 9998)
+        self.assertFalse(AccountNumberCounter.objects.filter(user=self.other).exists())
+        self.assertEqual(_allocate_numbers_bank_account({self.user.pk: 1}), {self.user.pk: [str(self.base + 9999)]})
+
+        RequestCreateAccount.objects.create(user=self.user, type='a', currency='r')
+        client = APIClient()
+        client.force_authenticate(get_user_model().objects.create_user('staff', is_staff=True))
+        response = client.post('/api/requests-admin/{}/confirm/'.format(RequestCreateAccount.objects.get().pk))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Account.objects.filter(user=self.user).exists())
+
+class ConfirmRequestsTest(TestCase):
+    """ Массовое подтверждение запросов на создание счетов
+    затрагивает только отфильтрованные запросы и идёт порциями """
+
+    def setUp(self):
+        self.users = [get_user_model().objects.create_user('user{}'.format(i)) for i in range(5)]
+        for user, account_type in zip(self.users, 'aabab'):
+            RequestCreateAccount.objects.create(user=user, type=account_type, currency='r')
+        self.client = APIClient()
+        self.client.force_authenticate(get_user_model().objects.create_user('staff', is_staff=True))
+
+    @override_settings(ACCOUNT_REQUESTS_CHUNK_SIZE=2)
+    def test_filters(self):
+        response = self.client.post('/api/requests-admin/confirm-bulk/?type=a')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['confirmed'], 3)
+        self.assertEqual(list(RequestCreateAccount.objects.values_list('type', flat=True)), ['b', 'b'])
+        self.assertEqual(sorted(Account.objects.values_list('user_id', 'type')),
+                         [(self.users[i].pk, 'a') for i in (0, 1, 3)])
+        self.assertEqual(self.client.post('/api/requests-admin/confirm-bulk/?type=a').data['confirmed'], 0)
+
+    def test_chunks(self):
+        progress = []
+        self.assertEqual(_confirm_requests_create_account(RequestCreateAccount.objects.all(), 2, progress.append), 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertFalse(RequestCreateAccount.objects.exists())
+        self.assertEqual(sorted(Account.objects.values_list('number', flat=True)),
+                         sorted(str(user.pk * 10000 + 1) for user in self.users))
+
+class StatementExportTest(TestCase):
+    """ Выписка по счёту выгружается потоком в CSV и NDJSON
+    с одинаковыми значениями и экранированием формул в CSV """
+
+    def setUp(self):
+        _reset_rate_matrix()
+        user = get_user_model().objects.create_user('user')
+        self.account = Account.objects.create(user=user, number='10001', type='a', currency='r', balance=100)
+        other_account = Account.objects.create(user=user, number='10002', type='a', currency='r')
+        old = Replenishment.objects.create(account=self.account, amount=5, currency='r')
+        Replenishment.objects.filter(pk=old.pk).update(created=timezone.now() - timedelta(days=3))
+        _create_payment(self.account, '=HYPERLINK("http://example.com")', Decimal('10'))
+        _create_transfer(self.account, other_account, Decimal('20'))
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def get(self, query):
+        response = self.client.get('/api/accounts/{}/statement/?{}'.format(self.account.pk, query))
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_formats(self):
+        response, content = self.get('file_format=csv')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        header, *rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(tuple(header), STATEMENT_FIELDS)
+        response, content = self.get('file_format=ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        items = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([item['operation'] for item in items], ['replenishment', 'payment', 'outgoing_transfer'])
+        self.assertEqual(rows[1][STATEMENT_FIELDS.index('counterparty')], '\'=HYPERLINK("http://example.com")')
+        self.assertEqual(items[1]['counterparty'], '=HYPERLINK("http://example.com")')
+        for row, item in zip(rows, items):
+            self.assertEqual(row[:4], [item['created'], item['operation'], str(item['id']), item['amount']])
+
+    def test_period(self):
+        today = timezone.now().date()
+        response, content = self.get('file_format=ndjson&date_from={}'.format(today - timedelta(days=1)))
+        self.assertEqual([json.loads(line)['operation'] for line in content.splitlines()],
+                         ['payment', 'outgoing_transfer'])
+        response, content = self.get('file_format=ndjson&date_to={}'.format(today - timedelta(days=2)))
+        self.assertEqual([json.loads(line)['operation'] for line in content.splitlines()], ['replenishment'])
+        url = '/api/accounts/{}/statement/'.format(self.account.pk)
+        self.assertEqual(self.client.get(url + '?date_from=yesterday').status_code, 400)
+        self.assertEqual(self.client.get(url + '?file_format=xlsx').status_code, 400)
+
+    def test_cross_currency_transfer(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            _publish_exchange_rates({'r': Decimal('2'), 'd': Decimal('1'), 'e': Decimal('3')})
+        dollars = Account.objects.create(user=self.account.user, number='10003', type='a', currency='d')
+        _create_transfer(self.account, dollars, Decimal('20'))
+        with self.captureOnCommitCallbacks(execute=True):
+            _publish_exchange_rates({'r': Decimal('4'), 'd': Decimal('1'), 'e': Decimal('3')})
+        response = self.client.get('/api/accounts/{}/statement/?file_format=ndjson'.format(dollars.pk))
+        item, = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual((item['operation'], item['amount'], item['currency'], item['counterparty']),
+                         ('incoming_transfer', '10.00', 'd', '10001'))
+        response, content = self.get('file_format=ndjson')
+        item = [json.loads(line) for line in content.splitlines()][-1]
+        self.assertEqual((item['operation'], item['amount'], item['currency']), ('outgoing_transfer', '20.00', 'r'))
+
+class StaffAccountsListTest(TestCase):
+    """ Список счетов для персонала: фильтры, сортировка только
+    по индексированным полям, курсорная пагинация и число строк """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user')
+        other = get_user_model().objects.create_user('other')
+        self.accounts = [
+            Account.objects.create(user=user, number=str(10001 + i), type=account_type,
+                                   currency=currency, balance=balance)
+            for i, (user, account_type, currency, balance) in enumerate([
+                (self.user, 'a', 'r', 100), (self.user, 'b', 'd', 50), (other, 'a', 'r', 100),
+                (other, 'a', 'e', 10), (self.user, 'a', 'r', 0),
+            ])
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(get_user_model().objects.create_user('staff', is_staff=True))
+
+    def ids(self, query=''):
+        response = self.client.get('/api/accounts-admin/?' + query)
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.data['results']]
+
+    def pk(self, *indexes):
+        return [self.accounts[index].pk for index in indexes]
+
+    def test_filters(self):
+        self.assertEqual(self.ids('user={}'.format(self.user.pk)), self.pk(4, 1, 0))
+        self.assertEqual(self.ids('currency=r&type=a'), self.pk(4, 2, 0))
+        self.assertEqual(self.ids('balance_min=50&balance_max=100'), self.pk(2, 1, 0))
+        Account.objects.filter(pk=self.accounts[0].pk).update(created=timezone.now() - timedelta(days=2))
+        after = (timezone.now() - timedelta(days=1)).isoformat()
+        self.assertEqual(self.client.get('/api/accounts-admin/', {'created_after': after}).data['count'], 4)
+        self.assertEqual(self.client.get('/api/accounts-admin/', {'created_before': after}).data['count'], 1)
+
+    def test_ordering(self):
+        self.assertEqual(self.ids('ordering=balance'), self.pk(4, 3, 1, 0, 2))
+        self.assertEqual(self.ids('ordering=-balance'), self.pk(2, 0, 1, 3, 4))
+        for ordering in ('number', 'user__username', '-balance,number'):
+            response = self.client.get('/api/accounts-admin/', {'ordering': ordering})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('ordering', response.data)
+
+    def test_pagination(self):
+        for query, expected in (('', self.pk(4, 3, 2, 1, 0)), ('ordering=-balance', self.pk(2, 0, 1, 3, 4))):
+            seen, url = [], '/api/accounts-admin/?page_size=2&' + query
+            while url and len(seen) <= len(expected):
+                data = self.client.get(url).data
+                self.assertEqual(data['count'], 5)
+                seen.extend(item['id'] for item in data['results'])
+                url = data['next']
+            self.assertEqual(seen, expected)
+        self.assertEqual(self.client.get('/api/accounts-admin/?currency=r&page_size=1').data['count'], 3)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Требуется планировщик PostgreSQL')
+    def test_estimated_count(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE bank_account')
+        self.assertEqual(_estimated_count(Account.objects.filter(currency='r')), 3)
+        with override_settings(ESTIMATED_COUNT_THRESHOLD=0):
+            for queryset in (Account.objects.all(), Account.objects.filter(currency='r')):
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertIsInstance(_estimated_count(queryset), int)
+                self.assertNotIn('COUNT(', queries[0]['sql'].upper())
+
+class AccountsCacheTest(TestCase):
+    """ Список счетов пользователя отдаётся из кэша
+    и сбрасывается после изменения баланса """
+
+    def setUp(self):
+        caches[ACCOUNTS_CACHE_ALIAS].clear()
+        self.user = get_user_model().objects.create_user('user')
+        self.account = Account.objects.create(user=self.user, number='10001', type='a', currency='r', balance=100)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_invalidation(self):
+        self.client.get('/api/accounts/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/operations/payments/create/')
+        self.assertEqual(response.data[0]['balance'], '100.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            _create_payment(self.account, 'shop', Decimal('30'))
+        self.assertEqual(self.client.get('/api/accounts/').data[0]['balance'], '70.00')
+
+class IdempotencyTest(TestCase):
+    """ Повтор запроса с тем же ключом идемпотентности
+    не проводит операцию второй раз """
+
+    def setUp(self):
+        caches[ACCOUNTS_CACHE_ALIAS].clear()
+        self.user = get_user_model().objects.create_user('user')
+        self.account = Account.objects.create(user=self.user, number='10001', type='a', currency='r', balance=100)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.data = {'account': self.account.pk, 'merchant': 'shop', 'amount': '30'}
+
+    def post(self, data, key):
+        return self.client.post('/api/operations/payments/create/', data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replay(self):
+        response = self.post(self.data, 'key')
+        self.assertEqual(response.status_code, 201)
+        with CaptureQueriesContext(connection) as queries:
+            replayed = self.post(self.data, 'key')
+        reads = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT')]
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(replayed.status_code, 201)
+        self.assertEqual(replayed.data, response.data)
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(Account.objects.get(pk=self.account.pk).balance, Decimal('70'))
+        self.assertEqual(self.post(dict(self.data, amount='31'), 'key').status_code, 422)
+
+    def test_failed_and_in_flight(self):
+        self.assertEqual(self.post(dict(self.data, amount='1000'), 'key').status_code, 400)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.post(self.data, 'key').status_code, 201)
+
+        fingerprint = IdempotencyKey.objects.get().fingerprint
+        IdempotencyKey.objects.create(user=self.user, key='other', fingerprint=fingerprint,
+                                      locked_until=timezone.now() + timedelta(minutes=1))
+        with override_settings(IDEMPOTENCY_WAIT_SECONDS=0):
+            self.assertEqual(self.post(self.data, 'other').status_code, 409)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_expired_lease_reclaimed(self):
+        request = Request(APIRequestFactory().post('/api/operations/payments/create/', self.data, format='json'),
+                          parsers=[JSONParser()])
+        IdempotencyKey.objects.create(user=self.user, key='key', fingerprint=_request_fingerprint(request),
+                                      locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.post(self.data, 'key').status_code, 201)
+        record = IdempotencyKey.objects.get()
+        self.assertEqual(record.status_code, 201)
+        self.assertIsNone(record.locked_until)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def debit(self, response=None, error=None):
+        """ Обработчик запроса: списание и ответ или исключение """
+        def handler():
+            Account.objects.filter(pk=self.account.pk).update(balance=F('balance') - 10)
+            if error is not None:
+                raise error
+            return response
+        return handler
+
+    def respond(self, key, handler):
+        request = Request(APIRequestFactory().post('/api/operations/payments/create/', self.data, format='json'),
+                          parsers=[JSONParser()])
+        request.user = self.user
+        return _idempotent_response(request, key, handler)
+
+    def balance(self):
+        return Account.objects.get(pk=self.account.pk).balance
+
+    def test_rolled_back_failure_releases_key(self):
+        with self.assertRaises(RuntimeError):
+            self.respond('key', self.debit(error=RuntimeError()))
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.balance(), Decimal('100'))
+
+    def test_server_error_not_rerun(self):
+        self.assertEqual(self.respond('key', self.debit(Response({'detail': 'Ошибка.'}, status=502))).status_code, 502)
+        replayed = self.respond('key', self.debit(Response({}, status=201)))
+        self.assertEqual(replayed.status_code, 502)
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.balance(), Decimal('90'))
+
+    def test_lost_lease_rolls_back(self):
+        def handler():
+            IdempotencyKey.objects.update(locked_until=timezone.now() + timedelta(minutes=1))
+            return self.debit(Response({}, status=201))()
+
+        self.assertEqual(self.respond('key', handler).status_code, 409)
+        self.assertEqual(self.balance(), Decimal('100'))
+        self.assertIsNone(IdempotencyKey.objects.get().status_code)
+
+class OutboxTest(TestCase):
+    """ Изменения балансов пишут события с непрерывными смещениями
+    по счёту, а ретранслятор доставляет их хотя бы один раз """
+
+    def setUp(self):
+        _reset_rate_matrix()
+        user = get_user_model().objects.create_user('user')
+        self.account = Account.objects.create(user=user, number='10001', type='a', currency='r', balance=1000)
+        self.other_account = Account.objects.create(user=user, number='10002', type='a', currency='r')
+
+    def test_events(self):
+        _create_replenishment(self.account, Decimal('10'), 'r')
+        _create_payment(self.account, 'shop', Decimal('20'))
+        _create_transfer(self.account, self.other_account, Decimal('30'))
+        _apply_operations_batch(self.account.user, [
+            {'type': 'payment', 'account': self.account.pk, 'merchant': 'shop', 'amount': Decimal('1')},
+            {'type': 'transfer', 'from_account': self.account.pk,
+             'account_for_enrollment': '10002', 'amount': Decimal('2')},
+        ])
+        events = list(OutboxEvent.objects.filter(account=self.account).order_by('pk'))
+        self.assertEqual([event.offset for event in events], [1, 2, 3, 4, 5])
+        self.assertEqual([event.amount for event in events],
+                         [Decimal('10'), Decimal('-20'), Decimal('-30'), Decimal('-1'), Decimal('-2')])
+        self.assertEqual(sum(event.amount for event in events) + 1000,
+                         Account.objects.get(pk=self.account.pk).balance)
+        self.assertEqual(list(OutboxEvent.objects.filter(account=self.other_account).values_list('offset', 'kind')),
+                         [(1, 'incoming_transfer'), (2, 'incoming_transfer')])
+
+        class FailingSink(OutboxSink):
+            def publish(self, events):
+                raise ConnectionError
+
+        with self.assertRaises(ConnectionError):
+            _relay_outbox(FailingSink(), 3)
+        self.assertEqual(OutboxEvent.objects.count(), 7)
+        sink = MemorySink()
+        self.assertEqual(_relay_outbox(sink, 3), 7)
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual([event['offset'] for event in sink.events if event['account'] == self.account.pk],
+                         [1, 2, 3, 4, 5])
+
+class EventsStreamTest(TransactionTestCase):
+    """ Поток событий присылает снимок счетов и изменения
+    балансов пользователя по мере проведения операций """
+
+    def setUp(self):
+        _reset_rate_matrix()
+        self.user = get_user_model().objects.create_user('user')
+        self.token = Token.objects.create(user=self.user)
+        self.account = Account.objects.create(user=self.user, number='10001', type='a', currency='r', balance=100)
+
+    async def stream(self, headers):
+        """ Запуск потока событий. Возвращает задачу, коды ответа,
+        очередь событий и событие отключения клиента """
+        statuses, events, disconnected = [], asyncio.Queue(), asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+            for chunk in message.get('body', b'').decode().split('\n\n'):
+                if chunk.startswith('event: '):
+                    fields = dict(line.split(': ', 1) for line in chunk.split('\n'))
+                    events.put_nowait((fields['event'], json.loads(fields['data'])))
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/events/', 'query_string': b'', 'headers': headers}
+        return asyncio.ensure_future(events_application(scope, receive, send)), statuses, events, disconnected
+
+    async def test_stream(self):
+        task, statuses, events, disconnected = await self.stream([])
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(statuses, [401])
+
+        task, statuses, events, disconnected = await self.stream(
+            [(b'authorization', 'Token {}'.format(self.token.key).encode())])
+        kind, accounts = await asyncio.wait_for(events.get(), 5)
+        self.assertEqual((kind, accounts[0]['balance'], accounts[0]['event_offset']), ('snapshot', '100.00', 0))
+        await sync_to_async(_create_payment)(self.account, 'shop', Decimal('30'))
+        await sync_to_async(_create_replenishment)(self.account, Decimal('5'), 'r')
+        for offset, amount, balance in ((1, '-30.00', '70.00'), (2, '5.00', '75.00')):
+            kind, event = await asyncio.wait_for(events.get(), 5)
+            self.assertEqual((kind, event['offset'], event['amount'], event['balance']),
+                             ('operation', offset, amount, balance))
+        disconnected.set()
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(statuses, [200])
+
+@skipUnless(connection.vendor == 'postgresql', 'Требуются блокировки строк PostgreSQL')
+class ConcurrentTransferTest(TransactionTestCase):
+    """ Встречные конкурентные переводы не теряют
+    обновлений и не приводят к взаимоблокировкам """
+
+    def test_concurrent_transfers(self):
+        user = get_user_model().objects.create_user('user')
+        accounts = [
+            Account.objects.create(user=user, number=str(10001 + i), type='a', currency='r', balance=1000)
+            for i in range(4)
+        ]
+        errors = []
+
+        def work(offset):
+            try:
+                for i in range(50):
+                    from_account = accounts[(offset + i) % len(accounts)]
+                    to_account = accounts[(offset + i + 1) % len(accounts)]
+                    _create_transfer(from_account, to_account, Decimal('1'))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=work, args=(offset,)) for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Transfer.objects.count(), 400)
+        self.assertEqual(Account.objects.aggregate(total=Sum('balance'))['total'], Decimal('4000'))
+
+@skipUnless(connection.vendor == 'postgresql', 'Требуются блокировки строк PostgreSQL')
+class ConfirmRequestsSkipLockedTest(TransactionTestCase):
+    """ Массовое подтверждение пропускает запросы, заблокированные
+    другой транзакцией, и не ждёт их освобождения """
+
+    def test_skip_locked(self):
+        users = [get_user_model().objects.create_user('user{}'.format(i)) for i in range(3)]
+        requests = [RequestCreateAccount.objects.create(user=user, type='a', currency='r') for user in users]
+        locked, release = threading.Event(), threading.Event()
+
+        def hold():
+            try:
+                with transaction.atomic():
+                    list(RequestCreateAccount.objects.select_for_update().filter(pk=requests[0].pk))
+                    locked.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        try:
+            locked.wait(10)
+            self.assertEqual(_confirm_requests_create_account(RequestCreateAccount.objects.all(), 1), 2)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(list(RequestCreateAccount.objects.values_list('pk', flat=True)), [requests[0].pk])
+
+@skipUnless(connection.vendor == 'postgresql', 'Требуется планировщик PostgreSQL')
+class HistoryFilterPlanTest(TestCase):
+    """ Фильтры историй операций читают таблицы по индексам """
+
+    def setUp(self):
+        keys = _seed(users=300, accounts_per_user=3, operations_per_account=60)
+        with connection.cursor() as cursor:
+            for model in (Account, Replenishment, Transfer, Payment):
+                cursor.execute('ANALYZE {}'.format(model._meta.db_table))
+        self.user = Token.objects.get(key=keys[0]).user
+        self.staff = get_user_model().objects.create_user('staff', is_staff=True)
+
+    def scans(self, plan, table):
+        """ Виды узлов плана, читающих таблицу """
+        nodes = [plan]
+        while nodes:
+            node = nodes.pop()
+            nodes.extend(node.get('Plans', []))
+            if node.get('Relation Name') == table:
+                yield node['Node Type']
+
+    def test_index_scans(self):
+        account = Account.objects.filter(user=self.user).first()
+        after = (timezone.now() - timedelta(days=30)).isoformat()
+        common = [
+            {'created_after': after},
+            {'created_after': after, 'created_before': timezone.now().isoformat()},
+            {'amount_min': '9990'},
+            {'amount_min': '100', 'amount_max': '101'},
+            {'currency': 'r'},
+            {'account': account.pk},
+            {'account': account.pk, 'created_after': after},
+            {'account': account.pk, 'currency': 'r', 'amount_min': '500'},
+        ]
+        cases = [
+            ('/api/operations/replenishments/', 'replenishment', common),
+            ('/api/operations/transfers/', 'transfer', common + [{'to_account': account.pk}]),
+            ('/api/operations/payments/', 'payment', common + [
+                {'merchant': MERCHANTS[3][:2]},
+                {'merchant': MERCHANTS[3][:2], 'created_after': after},
+                {'account': account.pk, 'merchant': MERCHANTS[3][:2]},
+            ]),
+        ]
+        for user in (self.user, self.staff):
+            client = APIClient()
+            client.force_authenticate(user)
+            for path, table, filters in cases:
+                for params in filters:
+                    with self.subTest(user=user.username, path=path, params=params):
+                        with CaptureQueriesContext(connection) as queries:
+                            self.assertEqual(client.get(path, params).status_code, 200)
+                        checked = 0
+                        for query in queries.captured_queries:
+                            if 'FROM "{}"'.format(table) not in query['sql']:
+                                continue
+                            with connection.cursor() as cursor:
+                                cursor.execute('EXPLAIN (FORMAT JSON) ' + query['sql'])
+                                plan = cursor.fetchone()[0]
+                            if isinstance(plan, str):
+                                plan = json.loads(plan)
+                            for node_type in self.scans(plan[0]['Plan'], table):
+                                self.assertIn(node_type, ('Index Scan', 'Index Only Scan', 'Bitmap Heap Scan'))
+                                checked += 1
+                        self.assertGreater(checked, 0)
+
+class ReplicaRoutingTest(TransactionTestCase):
+    """ Чтения историй идут на реплику, запись и транзакции - на основную
+    базу, после записи пользователь закреплён за основной базой """
+    databases = '__all__'
+
+    @override_settings(DATABASE_REPLICAS=['replica'])
+    def test_router(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Account), 'default')
+        with _use_replica():
+            self.assertEqual(router.db_for_read(Account), 'replica')
+            self.assertEqual(router.db_for_write(Account), 'default')
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Account), 'default')
+
+    @override_settings(DATABASE_REPLICAS=['replica_a', 'replica_b'])
+    def test_one_replica_per_request(self):
+        router = ReplicaRouter()
+        chosen = set()
+        for _ in range(20):
+            with _use_replica():
+                aliases = {router.db_for_read(Account) for _ in range(10)}
+            self.assertEqual(len(aliases), 1)
+            chosen |= aliases
+        self.assertEqual(chosen, {'replica_a', 'replica_b'})
+
+    @skipUnless(settings.DATABASE_REPLICAS, 'Требуется псевдоним реплики в DATABASES')
+    def test_views(self):
+        caches[settings.REPLICA_PIN_CACHE].clear()
+        user = get_user_model().objects.create_user('user')
+        account = Account.objects.create(user=user, number='10001', type='a', currency='r', balance=100)
+        client = APIClient()
+        client.force_authenticate(user)
+
+        def queries_by_alias(method, path, data=None):
+            counts = dict.fromkeys(connections, 0)
+
+            def count(alias):
+                def wrapper(execute, sql, params, many, context):
+                    counts[alias] += 1
+                    return execute(sql, params, many, context)
+                return wrapper
+
+            wrappers = [connections[alias].execute_wrapper(count(alias)) for alias in connections]
+            for wrapper in wrappers:
+                wrapper.__enter__()
+            try:
+                getattr(client, method)(path, data, format='json')
+            finally:
+                for wrapper in wrappers:
+                    wrapper.__exit__(None, None, None)
+            return counts['default'], sum(counts[alias] for alias in settings.DATABASE_REPLICAS)
+
+        for path in ('/api/operations/', '/api/operations/payments/'):
+            primary, replica = queries_by_alias('get', path)
+            self.assertEqual(primary, 0)
+            self.assertGreater(replica, 0)
+        primary, replica = queries_by_alias('post', '/api/operations/payments/create/', {
+            'account': account.pk, 'merchant': 'shop', 'amount': '1',
+        })
+        self.assertEqual(replica, 0)
+        primary, replica = queries_by_alias('get', '/api/operations/payments/')
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
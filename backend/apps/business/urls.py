@@ -22,6 +22,7 @@ urlpatterns = [
     path('operations/transfers/', views.TransfersHistoryView.as_view()),
     path('operations/payments/create/', views.PaymentCreateView.as_view()),
     path('operations/payments/', views.PaymentsHistoryView.as_view()),
+    path('operations/batch/create/', views.OperationsBatchCreateView.as_view()),
 ]
 
 urlpatterns += router.urls
\ No newline at end of file
@@ -4,9 +4,9 @@ from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from django_filters.rest_framework import DjangoFilterBackend
-from decimal import *
-from collections import namedtuple
 from django.db import transaction
+from django.conf import settings
+import time
 
 from .models import (
     RequestCreateAccount,
@@ -18,27 +18,49 @@ from .models import (
 from .serializers import (
     CreateRequestCreateAccountSerializer,
     RequestCreateAccountSerializer,
-    BankAccountSerializer,
     BankAccountDetailSerializer,
-    BankAccountAdminSerializer,
     BankAccountDetailAdminSerializer,
     CreateReplenishmentSerializer,
-    ReplenishmentSerializer,
     CreateTransferAnotherSerializer,
     CreateTransferYourselfSerializer,
-    TransferSerializer,
     CreatePaymentSerializer,
-    PaymentSerializer,
-    OperationsHistorySerializer,
+    BatchOperationSerializer,
+    BankAccountValuesSerializer,
+    BankAccountAdminValuesSerializer,
+    ReplenishmentValuesSerializer,
+    TransferValuesSerializer,
+    PaymentValuesSerializer,
+    OperationValuesSerializer,
+)
+from .exports import _statement_response
+from .filters import ReplenishmentFilter, TransferFilter, PaymentFilter
+from .mixins import (
+    ConditionalListMixin,
+    IdempotentCreateMixin,
+    ReplicaReadMixin,
+    StaffBankAccountsListMixin,
+    ValuesListMixin,
+    UserBankAccountsListMixin,
+    _weak_etag,
+    _not_modified,
+)
+from .pagination import (
+    OperationsCursorPagination,
+    OperationsTimelinePagination,
 )
 from .services import (
-    _replenishment_bank_account,
+    AccountNumbersExhaustedError,
     _generate_number_bank_account,
-    _payment,
+    _confirm_requests_create_account,
+    _operations_timeline,
+    _operations_fingerprint,
+    _apply_operations_batch,
 )
 
 
-class UserBankAccountsView(viewsets.GenericViewSet,
+class UserBankAccountsView(IdempotentCreateMixin,
+                           UserBankAccountsListMixin,
+                           viewsets.GenericViewSet,
                            mixins.ListModelMixin,
                            mixins.CreateModelMixin,
                            mixins.RetrieveModelMixin,
@@ -53,7 +75,7 @@ class UserBankAccountsView(viewsets.GenericViewSet,
 
     def get_serializer_class(self):
         if self.action == 'list':
-            return BankAccountSerializer
+            return BankAccountValuesSerializer
         if self.action == 'retrieve':
             return BankAccountDetailSerializer
         return CreateRequestCreateAccountSerializer
@@ -61,6 +83,11 @@ class UserBankAccountsView(viewsets.GenericViewSet,
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    @action(detail=True, methods=['get'], url_path='statement')
+    def statement(self, request, pk=None):
+        """ Выгрузка выписки по банковскому счёту """
+        return _statement_response(self.get_object(), request)
+
 class RequestsCreateBankAccountView(viewsets.GenericViewSet,
                                 mixins.ListModelMixin,
                                 mixins.RetrieveModelMixin,
@@ -69,6 +96,7 @@ class RequestsCreateBankAccountView(viewsets.GenericViewSet,
     permission_classes = [IsAdminUser]
     queryset = RequestCreateAccount.objects.all()
     serializer_class = RequestCreateAccountSerializer
+    filterset_fields = ('type', 'currency')
 
     @action(detail=True, methods=['post'], url_path='confirm')
     @transaction.atomic
@@ -76,8 +104,12 @@ class RequestsCreateBankAccountView(viewsets.GenericViewSet,
         """ Подтверждение запроса на создание
         нового банковского счёта """
         create_request = self.get_object()
+        try:
+            number = _generate_number_bank_account(create_request.user)
+        except AccountNumbersExhaustedError as error:
+            return Response({'detail': str(error)}, status=400)
         account = Account.objects.create(user=create_request.user,
-                                         number=_generate_number_bank_account(create_request.user),
+                                         number=number,
                                          type=create_request.type,
                                          currency=create_request.currency)
         serializer = BankAccountDetailAdminSerializer(account)
@@ -85,131 +117,161 @@ class RequestsCreateBankAccountView(viewsets.GenericViewSet,
         create_request.delete()
         return Response(serializer.data, status=201)
 
-class BankAccountsAdminView(viewsets.ModelViewSet):
+    @action(detail=False, methods=['post'], url_path='confirm-bulk')
+    def confirm_requests_create_account(self, request):
+        """ Подтверждение всех запросов, подходящих
+        под фильтры, порциями """
+        started = time.perf_counter()
+        try:
+            confirmed = _confirm_requests_create_account(self.filter_queryset(self.get_queryset()),
+                                                         settings.ACCOUNT_REQUESTS_CHUNK_SIZE)
+        except AccountNumbersExhaustedError as error:
+            return Response({'detail': str(error)}, status=400)
+        return Response({'confirmed': confirmed,
+                         'seconds': round(time.perf_counter() - started, 3)})
+
+class BankAccountsAdminView(ReplicaReadMixin, ConditionalListMixin, StaffBankAccountsListMixin,
+                            viewsets.ModelViewSet):
     """ Просмотр и редактирование банковских
     счетов персоналом """
     permission_classes = [IsAdminUser]
+    replica_actions = ('list',)
+    etag_field = 'updated'
 
     def get_queryset(self):
         return Account.objects.select_related('user').all()
 
     def get_serializer_class(self):
         if self.action == 'list':
-            return BankAccountAdminSerializer
+            return BankAccountAdminValuesSerializer
         return BankAccountDetailAdminSerializer
 
-class ReplenishmentCreateView(generics.ListCreateAPIView):
+    @action(detail=True, methods=['get'], url_path='statement')
+    def statement(self, request, pk=None):
+        """ Выгрузка выписки по банковскому счёту """
+        return _statement_response(self.get_object(), request)
+
+class ReplenishmentCreateView(IdempotentCreateMixin, StaffBankAccountsListMixin, generics.ListCreateAPIView):
     """ Пополнение банковского счёта персоналом """
     permission_classes = [IsAdminUser]
     serializer_class = CreateReplenishmentSerializer
 
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = BankAccountAdminSerializer(queryset, many=True)
-        return Response(serializer.data)
-
     def get_queryset(self):
-        return Account.objects.select_related('user').all()
-
-    @transaction.atomic
-    def perform_create(self, serializer):
-        _replenishment_bank_account(self.request.data['account'],
-                                    Decimal(self.request.data['amount']),
-                                    self.request.data['currency'])
-        serializer.save()
+        return Account.objects.all()
 
-class ReplenishmentsHistoryView(generics.ListAPIView):
+class ReplenishmentsHistoryView(ReplicaReadMixin, ConditionalListMixin, ValuesListMixin, generics.ListAPIView):
     """ История попополнений банковских счетов """
-    serializer_class = ReplenishmentSerializer
+    serializer_class = ReplenishmentValuesSerializer
+    pagination_class = OperationsCursorPagination
+    filterset_class = ReplenishmentFilter
 
     def get_queryset(self):
+        queryset = Replenishment.objects.all()
         if self.request.user.is_staff:
-            return Replenishment.objects.all()
+            return queryset.all()
         accounts = Account.objects.filter(user=self.request.user)
-        return Replenishment.objects.filter(account__in=accounts)
+        return queryset.filter(account__in=accounts)
 
-class TransferCreateAnotherView(generics.ListCreateAPIView):
+class TransferCreateAnotherView(IdempotentCreateMixin, UserBankAccountsListMixin, generics.ListCreateAPIView):
     """ Перевод средств пользователем на банковский
     счёт другого пользователя """
     queryset = Account.objects.all()
     serializer_class = CreateTransferAnotherSerializer
 
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = BankAccountSerializer(queryset, many=True)
-        return Response(serializer.data)
-
     def get_queryset(self):
         return self.queryset.filter(user=self.request.user)
 
-class TransferCreateYourselfView(generics.ListCreateAPIView):
+class TransferCreateYourselfView(IdempotentCreateMixin, UserBankAccountsListMixin, generics.ListCreateAPIView):
     """ Перевод средств пользователем
     между своими счетами """
     queryset = Account.objects.all()
     serializer_class = CreateTransferYourselfSerializer
 
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = BankAccountSerializer(queryset, many=True)
-        return Response(serializer.data)
-
     def get_queryset(self):
         return self.queryset.filter(user=self.request.user)
 
-class TransfersHistoryView(generics.ListAPIView):
+class TransfersHistoryView(ReplicaReadMixin, ConditionalListMixin, ValuesListMixin, generics.ListAPIView):
     """ История переводов средств """
-    serializer_class = TransferSerializer
+    serializer_class = TransferValuesSerializer
+    pagination_class = OperationsCursorPagination
+    filterset_class = TransferFilter
 
     def get_queryset(self):
+        queryset = Transfer.objects.all()
         if self.request.user.is_staff:
-            return Transfer.objects.all()
+            return queryset.all()
         from_accounts = Account.objects.filter(user=self.request.user)
-        return Transfer.objects.filter(from_account__in=from_accounts)
+        return queryset.filter(from_account__in=from_accounts)
 
-class PaymentCreateView(generics.ListCreateAPIView):
+class PaymentCreateView(IdempotentCreateMixin, UserBankAccountsListMixin, generics.ListCreateAPIView):
     """ Оплата товаров или услуг """
     queryset = Account.objects.all()
     serializer_class = CreatePaymentSerializer
 
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = BankAccountSerializer(queryset, many=True)
-        return Response(serializer.data)
-
     def get_queryset(self):
         return self.queryset.filter(user=self.request.user)
 
-    @transaction.atomic
-    def perform_create(self, serializer):
-        _payment(self.request.data['account'],
-                 Decimal(self.request.data['amount']))
-        serializer.save()
-
-class PaymentsHistoryView(generics.ListAPIView):
+class PaymentsHistoryView(ReplicaReadMixin, ConditionalListMixin, ValuesListMixin, generics.ListAPIView):
     """ История оплат товаров или услуг пользователем """
-    serializer_class = PaymentSerializer
+    serializer_class = PaymentValuesSerializer
+    pagination_class = OperationsCursorPagination
+    filterset_class = PaymentFilter
 
     def get_queryset(self):
+        queryset = Payment.objects.all()
         if self.request.user.is_staff:
-            return Payment.objects.all()
+            return queryset.all()
         account = Account.objects.filter(user=self.request.user)
-        return Payment.objects.filter(account__in=account)
-
-class OperationsHistoryView(viewsets.ViewSet):
+        return queryset.filter(account__in=account)
+
+class OperationsBatchCreateView(IdempotentCreateMixin, generics.GenericAPIView):
+    """ Пакетное проведение оплат и переводов пользователя.
+    Ошибки возвращаются отдельно по каждой операции. Код ответа 200,
+    если проведены все операции, 207 - если часть, и 400 - если ни одной """
+    serializer_class = BatchOperationSerializer
+
+    def post(self, request, *args, **kwargs):
+        return self.idempotent(request, lambda: self.apply_batch(request))
+
+    def apply_batch(self, request):
+        if not isinstance(request.data, list):
+            return Response({'detail': 'Ожидается список операций.'}, status=400)
+        if len(request.data) > settings.OPERATIONS_BATCH_MAX_SIZE:
+            return Response({'detail': 'Слишком много операций в пакете.'}, status=400)
+        results = [None] * len(request.data)
+        operations, positions = [], []
+        for position, item in enumerate(request.data):
+            serializer = self.get_serializer(data=item)
+            if serializer.is_valid():
+                operations.append(serializer.validated_data)
+                positions.append(position)
+            else:
+                results[position] = {'status': 'error', 'errors': serializer.errors}
+        if operations:
+            for position, result in zip(positions, _apply_operations_batch(request.user, operations)):
+                operation = result.pop('operation', None)
+                if operation is not None:
+                    result['id'] = operation.pk
+                results[position] = result
+        applied = sum(result['status'] == 'ok' for result in results)
+        if not applied:
+            return Response(results, status=400)
+        return Response(results, status=200 if applied == len(results) else 207)
+
+class OperationsHistoryView(ReplicaReadMixin, viewsets.ViewSet):
     """ Просмотр всех операций пользователя """
 
     def list(self, request):
-        Operations = namedtuple('Operations', ('replenishment', 'transfer', 'payment'))
-        queryset = Operations(
-            replenishment=Replenishment.objects.select_related(
-                'account',
-            ).filter(account__user=request.user),
-            transfer=Transfer.objects.select_related(
-                'from_account',
-            ).filter(from_account__user=request.user),
-            payment=Payment.objects.select_related(
-                'account',
-            ).filter(account__user=request.user),
+        etag = _weak_etag(request.user.pk, request.get_full_path(), _operations_fingerprint(request.user))
+        if _not_modified(request, etag):
+            return Response(status=304, headers={'ETag': etag})
+        paginator = OperationsTimelinePagination()
+        page = paginator.paginate_timeline(
+            lambda limit, position: _operations_timeline(
+                request.user, limit, position, OperationValuesSerializer.lookups_by_kind()),
+            request,
         )
-        serializer = OperationsHistorySerializer(queryset)
-        return Response(serializer.data)
\ No newline at end of file
+        serializer = OperationValuesSerializer(page, many=True)
+        response = paginator.get_paginated_response(serializer.data)
+        response['ETag'] = etag
+        return response
\ No newline at end of file
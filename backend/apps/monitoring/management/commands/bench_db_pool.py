@@ -0,0 +1,94 @@
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.utils import load_backend
+from rest_framework.test import APIClient
+
+ENGINES = (
+    ('без пула', 'django.db.backends.postgresql'),
+    ('с пулом', 'backend.db.postgresql'),
+)
+
+
+class Command(BaseCommand):
+    help = ('Задержка запросов к API с пулом соединений и без него. После '
+            'каждого запроса соединение Django закрывается, как при CONN_MAX_AGE = 0')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/api/operations/')
+        parser.add_argument('--username', help='Пользователь, от имени которого выполняются запросы')
+        parser.add_argument('--requests', type=int, default=200, help='Запросов на поток')
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--pool-size', type=int, help='Размер пула, по умолчанию POOL.MAX_SIZE')
+
+    def handle(self, *args, **options):
+        base = dict(connections[DEFAULT_DB_ALIAS].settings_dict)
+        if connections[DEFAULT_DB_ALIAS].vendor != 'postgresql':
+            raise CommandError('Сравнение пула соединений выполняется только на PostgreSQL')
+        users = get_user_model().objects.filter(account__isnull=False)
+        if options['username']:
+            users = users.filter(username=options['username'])
+        user = users.first()
+        if user is None:
+            raise CommandError('Нет пользователя со счетами, заполните базу командой seed_bank')
+        connections[DEFAULT_DB_ALIAS].close()
+
+        self.stdout.write('{:<10} {:>8} {:>8} {:>8} {:>8} {:>10}'.format(
+            'режим', 'p50, мс', 'p95, мс', 'p99, мс', 'max, мс', 'запросов/с'))
+        for name, engine in ENGINES:
+            pool = dict(base.get('POOL', {}))
+            if options['pool_size']:
+                pool['MAX_SIZE'] = options['pool_size']
+            settings_dict = dict(base, ENGINE=engine, CONN_MAX_AGE=0, POOL=pool)
+            started = time.perf_counter()
+            latencies = self.run(settings_dict, user, options)
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+
+            def percentile(value):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * value))] * 1000
+
+            self.stdout.write('{:<10} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f} {:>10.0f}'.format(
+                name, percentile(0.5), percentile(0.95), percentile(0.99), latencies[-1] * 1000,
+                len(latencies) / elapsed))
+
+    def run(self, settings_dict:dict, user:object, options:dict) -> list:
+        backend = load_backend(settings_dict['ENGINE'])
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def work():
+            wrapper = backend.DatabaseWrapper(settings_dict, DEFAULT_DB_ALIAS)
+            connections[DEFAULT_DB_ALIAS] = wrapper
+            client = APIClient()
+            client.force_authenticate(user)
+            measured = []
+            try:
+                for _ in range(options['requests']):
+                    started = time.perf_counter()
+                    response = client.get(options['path'])
+                    wrapper.close()
+                    measured.append(time.perf_counter() - started)
+                    if response.status_code >= 400:
+                        raise CommandError('{} вернул {}'.format(options['path'], response.status_code))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                wrapper.close()
+                with lock:
+                    latencies.extend(measured)
+
+        threads = [threading.Thread(target=work) for _ in range(options['threads'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if hasattr(backend, '_pools'):
+            for pool in backend._pools.values():
+                pool.close_idle()
+        if errors:
+            raise CommandError(str(errors[0]))
+        return latencies
@@ -0,0 +1,167 @@
+from bisect import bisect_left
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+POOL_WAIT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+HISTOGRAMS = {
+    'http_request_duration_seconds': ('Время обработки запроса', LATENCY_BUCKETS, ('view', 'method')),
+    'http_request_db_duration_seconds': ('Время выполнения SQL-запросов за запрос', LATENCY_BUCKETS,
+                                         ('view', 'method')),
+    'http_request_db_queries': ('Число SQL-запросов за запрос', QUERY_COUNT_BUCKETS, ('view', 'method')),
+    'db_pool_wait_seconds': ('Ожидание соединения из пула', POOL_WAIT_BUCKETS, ('alias',)),
+}
+
+
+class MetricsRegistry:
+    """ Метрики процесса: гистограммы, счётчики и текущие значения.
+    Раз в flush_interval секунд снимок метрик записывается в файл
+    процесса в каталоге directory, а при выдаче метрик файлы всех
+    процессов суммируются """
+
+    def __init__(self, directory:str, flush_interval:float):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._flushed = time.monotonic()
+
+    def observe(self, name:str, labels:tuple, value:float) -> None:
+        """ Добавление значения в гистограмму """
+        buckets = HISTOGRAMS[name][1]
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            histogram[0][bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+        self._maybe_flush()
+
+    def inc(self, name:str, labels:tuple=(), value:float=1) -> None:
+        """ Увеличение счётчика """
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name:str, labels:tuple, value:float) -> None:
+        """ Установка текущего значения """
+        with self._lock:
+            self._gauges[name, labels] = value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'histograms': [[name, list(labels), [list(histogram[0]), histogram[1], histogram[2]]]
+                               for (name, labels), histogram in self._histograms.items()],
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'gauges': [[name, list(labels), value] for (name, labels), value in self._gauges.items()],
+            }
+
+    def _path(self) -> str:
+        return os.path.join(self.directory, 'metrics-{}.json'.format(os.getpid()))
+
+    def _maybe_flush(self) -> None:
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Атомарная запись снимка метрик процесса в файл """
+        self._flushed = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        descriptor, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(path, self._path())
+
+    def collect(self) -> dict:
+        """ Сумма метрик всех живых процессов. Файлы завершившихся
+        процессов удаляются, чтобы их значения не суммировались """
+        self.flush()
+        histograms, counters, gauges = {}, {}, {}
+        for filename in os.listdir(self.directory):
+            if not (filename.startswith('metrics-') and filename.endswith('.json')):
+                continue
+            pid = filename[len('metrics-'):-len('.json')]
+            if not pid.isdigit() or not _is_alive(int(pid)):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                continue
+            for name, labels, (buckets, total, count) in snapshot['histograms']:
+                merged = histograms.setdefault((name, tuple(labels)), [[0] * len(buckets), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+                merged[2] += count
+            for target, items in ((counters, snapshot['counters']), (gauges, snapshot['gauges'])):
+                for name, labels, value in items:
+                    target[name, tuple(labels)] = target.get((name, tuple(labels)), 0) + value
+        return {'histograms': histograms, 'counters': counters, 'gauges': gauges}
+
+def _is_alive(pid:int) -> bool:
+    """ Существует ли процесс с таким pid """
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _format_labels(names:tuple, labels:tuple, extra:str='') -> str:
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _render_prometheus(metrics:dict) -> str:
+    """ Метрики в текстовом формате Prometheus """
+    lines = []
+    for name, (description, buckets, label_names) in HISTOGRAMS.items():
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} histogram'.format(name))
+        for (metric, labels), (counts, total, count) in sorted(metrics['histograms'].items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(label_names, labels, 'le="{}"'.format(bound)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(label_names, labels), total))
+            lines.append('{}_count{} {}'.format(name, _format_labels(label_names, labels), count))
+    for kind, items in (('counter', metrics['counters']), ('gauge', metrics['gauges'])):
+        described = set()
+        for (name, labels), value in sorted(items.items()):
+            if name not in described:
+                described.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+            label_names = METRIC_LABELS.get(name, ())
+            lines.append('{}{} {}'.format(name, _format_labels(label_names, labels), value))
+    return '\n'.join(lines) + '\n'
+
+# Имена меток счётчиков и текущих значений, которые
+# регистрируют другие модули
+METRIC_LABELS = {}
+
+registry = MetricsRegistry(settings.METRICS_DIR, settings.METRICS_FLUSH_INTERVAL)
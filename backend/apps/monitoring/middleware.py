@@ -0,0 +1,118 @@
+from contextlib import ExitStack
+from datetime import timedelta
+import random
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .metrics import registry
+from .profiling import recorder
+
+
+def _is_staff(request) -> bool:
+    """ Запрос персонала по сессии или по классам аутентификации DRF.
+    Сам запрос не меняется, представление аутентифицирует его заново """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    wrapped = Request(request)
+    for authentication in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+        try:
+            result = authentication().authenticate(wrapped)
+        except APIException:
+            return False
+        if result is not None:
+            return result[0].is_staff
+    return False
+
+class SampledProfilingMiddleware:
+    """ Профилирование доли запросов PROFILING_SAMPLE_RATE. Персонал может
+    запросить профилирование заголовком PROFILING_FORCE_HEADER, заголовок
+    от остальных игнорируется до профилирования. Запросы, не попавшие
+    в выборку, проходят без какой-либо дополнительной работы """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = settings.PROFILING_SAMPLE_RATE
+        self.force_header = 'HTTP_' + settings.PROFILING_FORCE_HEADER.upper().replace('-', '_')
+
+    def __call__(self, request):
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not sampled and (self.force_header not in request.META or not _is_staff(request)):
+            return self.get_response(request)
+        return self.profile(request)
+
+    def profile(self, request):
+        queries = []
+
+        def record_query(execute, sql, params, many, context):
+            started = timezone.now()
+            counter = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                time_taken = time.perf_counter() - counter
+                queries.append({
+                    'query': sql,
+                    'start_time': started,
+                    'end_time': started + timedelta(seconds=time_taken),
+                    'time_taken': time_taken * 1000,
+                })
+
+        start_time = timezone.now()
+        counter = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(record_query))
+            response = self.get_response(request)
+        time_taken = time.perf_counter() - counter
+
+        recorder.record({
+            'path': request.path,
+            'query_params': request.META.get('QUERY_STRING', ''),
+            'method': request.method,
+            'view_name': request.resolver_match.view_name if request.resolver_match else '',
+            'status_code': response.status_code,
+            'start_time': start_time,
+            'end_time': start_time + timedelta(seconds=time_taken),
+            'time_taken': time_taken * 1000,
+            'queries': queries,
+        })
+        return response
+
+class MetricsMiddleware:
+    """ Гистограммы времени обработки, времени SQL-запросов и
+    числа SQL-запросов по представлениям и методам """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        database = [0, 0.0]
+
+        def count_query(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                database[0] += 1
+                database[1] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(count_query))
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        labels = (match.view_name if match is not None else '<unresolved>', request.method)
+        registry.observe('http_request_duration_seconds', labels, duration)
+        registry.observe('http_request_db_duration_seconds', labels, database[1])
+        registry.observe('http_request_db_queries', labels, database[0])
+        return response
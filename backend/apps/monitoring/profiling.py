@@ -0,0 +1,84 @@
+from collections import deque
+from uuid import uuid4
+import logging
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileRecorder:
+    """ Буфер профилей запросов. Запросы только добавляют запись
+    в очередь в памяти, а фоновый поток раз в flush_interval секунд
+    или по накоплении batch_size записей сохраняет их пачкой в таблицы
+    Silk. При переполнении буфера старые записи отбрасываются """
+
+    def __init__(self, batch_size:int, flush_interval:float, max_buffer:int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = deque(maxlen=max_buffer)
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def record(self, profile:dict) -> None:
+        self._buffer.append(profile)
+        if self._thread is None:
+            self._start()
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profile-recorder', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Не удалось сохранить профили запросов')
+
+    def flush(self) -> None:
+        """ Сохранение накопленных профилей тремя запросами bulk_create """
+        from silk.models import Request, Response, SQLQuery
+
+        profiles = []
+        while self._buffer and len(profiles) < self.batch_size:
+            profiles.append(self._buffer.popleft())
+        if not profiles:
+            return
+        requests, responses, queries = [], [], []
+        for profile in profiles:
+            request = Request(
+                id=str(uuid4()),
+                path=profile['path'][:190],
+                query_params=profile['query_params'],
+                method=profile['method'],
+                view_name=(profile['view_name'] or '')[:190],
+                start_time=profile['start_time'],
+                end_time=profile['end_time'],
+                time_taken=profile['time_taken'],
+                num_sql_queries=len(profile['queries']),
+                meta_num_queries=len(profile['queries']),
+                meta_time_spent_queries=sum(query['time_taken'] for query in profile['queries']),
+            )
+            requests.append(request)
+            responses.append(Response(id=str(uuid4()), request=request, status_code=profile['status_code']))
+            queries.extend(SQLQuery(request=request, traceback='', **query) for query in profile['queries'])
+        with transaction.atomic():
+            Request.objects.bulk_create(requests)
+            Response.objects.bulk_create(responses)
+            SQLQuery._base_manager.bulk_create(queries, batch_size=1000)
+        if self._buffer:
+            self._wakeup.set()
+
+recorder = ProfileRecorder(settings.PROFILING_BATCH_SIZE,
+                           settings.PROFILING_FLUSH_INTERVAL,
+                           settings.PROFILING_MAX_BUFFER)
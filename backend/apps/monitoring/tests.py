@@ -0,0 +1,127 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from .metrics import MetricsRegistry
+from .middleware import SampledProfilingMiddleware
+from .profiling import ProfileRecorder, recorder
+
+
+class MetricsRegistryTest(TestCase):
+    """ Метрики суммируются только по живым процессам """
+
+    def test_dead_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            registry = MetricsRegistry(directory, 10)
+            registry.inc('requests_total')
+            registry.set('connections', (), 3)
+            process = subprocess.Popen([sys.executable, '-c', ''])
+            process.wait()
+            dead = os.path.join(directory, 'metrics-{}.json'.format(process.pid))
+            with open(dead, 'w') as file:
+                json.dump({'histograms': [], 'counters': [['requests_total', [], 5]],
+                           'gauges': [['connections', [], 7]]}, file)
+
+            metrics = registry.collect()
+            self.assertEqual(metrics['counters'], {('requests_total', ()): 1})
+            self.assertEqual(metrics['gauges'], {('connections', ()): 3})
+            self.assertFalse(os.path.exists(dead))
+
+class MetricsViewTest(TestCase):
+    """ Метрики выдаются только персоналу или по токену """
+
+    def test_access(self):
+        client = APIClient()
+        self.assertEqual(client.get('/metrics/').status_code, 403)
+        client.force_login(get_user_model().objects.create_user('user'))
+        self.assertEqual(client.get('/metrics/').status_code, 403)
+        client.force_login(get_user_model().objects.create_user('staff', is_staff=True))
+        self.assertEqual(client.get('/metrics/').status_code, 200)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token(self):
+        client = APIClient()
+        client.force_login(get_user_model().objects.create_user('staff', is_staff=True))
+        self.assertEqual(client.get('/metrics/').status_code, 403)
+        self.assertEqual(APIClient().get('/metrics/', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+class SampledProfilingTest(TestCase):
+    """ Профилируются запросы из выборки и запросы персонала
+    с заголовком, остальные проходят без перехвата SQL """
+
+    def setUp(self):
+        self.staff_token = Token.objects.create(user=get_user_model().objects.create_user('staff', is_staff=True))
+        self.user_token = Token.objects.create(user=get_user_model().objects.create_user('user'))
+        self.wrapped = []
+
+    def view(self, request):
+        self.wrapped.append(bool(connection.execute_wrappers))
+        get_user_model().objects.count()
+        return HttpResponse(status=204)
+
+    def call(self, sample_rate=0, **headers):
+        request = RequestFactory().get('/api/accounts/?page=2', **headers)
+        request.user = AnonymousUser()
+        with override_settings(PROFILING_SAMPLE_RATE=sample_rate), \
+                mock.patch.object(recorder, 'record') as record:
+            SampledProfilingMiddleware(self.view)(request)
+        return [call.args[0] for call in record.call_args_list]
+
+    def test_sampling(self):
+        self.assertEqual(self.call(), [])
+        profile, = self.call(sample_rate=1)
+        self.assertEqual(self.wrapped, [False, True])
+        self.assertEqual((profile['path'], profile['query_params'], profile['status_code']),
+                         ('/api/accounts/', 'page=2', 204))
+        self.assertEqual(len(profile['queries']), 1)
+
+    def test_force_header(self):
+        self.assertEqual(self.call(HTTP_X_PROFILE='1'), [])
+        self.assertEqual(self.call(HTTP_X_PROFILE='1', HTTP_AUTHORIZATION='Token ' + self.user_token.key), [])
+        self.assertEqual(self.call(HTTP_X_PROFILE='1', HTTP_AUTHORIZATION='Token wrong'), [])
+        self.assertEqual(self.wrapped, [False, False, False])
+        profile, = self.call(HTTP_X_PROFILE='1', HTTP_AUTHORIZATION='Token ' + self.staff_token.key)
+        self.assertEqual(self.wrapped[-1], True)
+        self.assertEqual(len(profile['queries']), 1)
+
+class ProfileRecorderTest(TestCase):
+    """ Профили сохраняются пачкой в таблицы Silk """
+
+    def test_flush(self):
+        from silk.models import Request, SQLQuery
+
+        started = timezone.now()
+        profile_recorder = ProfileRecorder(batch_size=2, flush_interval=60, max_buffer=3)
+        with mock.patch.object(ProfileRecorder, '_start'):
+            for i in range(4):
+                profile_recorder.record({
+                    'path': '/api/{}/'.format(i), 'query_params': '', 'method': 'GET', 'view_name': None,
+                    'status_code': 200, 'start_time': started, 'end_time': started + timedelta(seconds=1),
+                    'time_taken': 1000.0, 'queries': [{
+                        'query': 'SELECT {}'.format(i), 'start_time': started,
+                        'end_time': started + timedelta(milliseconds=5), 'time_taken': 5.0,
+                    }],
+                })
+        profile_recorder.flush()
+        self.assertEqual(sorted(Request.objects.values_list('path', flat=True)), ['/api/1/', '/api/2/'])
+        request = Request.objects.get(path='/api/1/')
+        self.assertEqual((request.num_sql_queries, request.meta_time_spent_queries), (1, 5.0))
+        self.assertEqual(request.response.status_code, 200)
+        self.assertEqual(list(SQLQuery.objects.filter(request=request).values_list('query', flat=True)), ['SELECT 1'])
+        profile_recorder.flush()
+        self.assertEqual(Request.objects.count(), 3)
+        profile_recorder.flush()
+        self.assertEqual(Request.objects.count(), 3)
@@ -0,0 +1,19 @@
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from .metrics import registry, _render_prometheus
+
+
+def metrics(request):
+    """ Метрики всех процессов в формате Prometheus. С METRICS_TOKEN
+    доступ по заголовку Authorization: Bearer, без него - только персоналу """
+    if settings.METRICS_TOKEN:
+        expected = 'Bearer {}'.format(settings.METRICS_TOKEN)
+        if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), expected):
+            return HttpResponseForbidden()
+    elif not request.user.is_staff:
+        return HttpResponseForbidden()
+    return HttpResponse(_render_prometheus(registry.collect()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,84 @@
+import hashlib
+import hmac
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.authentication import BasicAuthentication, TokenAuthentication
+
+AUTH_CACHE_ALIAS = 'auth'
+
+
+def _auth_version_key(user_pk:int) -> str:
+    return 'auth:version:{}'.format(user_pk)
+
+def _auth_version(cache:object, user_pk:int) -> int:
+    """ Текущая версия аутентификации пользователя. Потерянная версия
+    создаётся заново из времени, чтобы не совпасть с прежними """
+    key = _auth_version_key(user_pk)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+def _invalidate_user(user_pk:int) -> None:
+    """ Сброс закэшированной аутентификации пользователя. Версия хранится
+    в общем кэше AUTH_CACHE_ALIAS, поэтому сброс виден всем процессам """
+    cache = caches[AUTH_CACHE_ALIAS]
+    key = _auth_version_key(user_pk)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+
+def _credentials_key(userid:str, password:str) -> bytes:
+    """ Ключ кэша для пары логин-пароль. Пароль в открытом
+    виде в памяти не хранится """
+    message = '{}\0{}'.format(userid, password).encode()
+    return hmac.new(settings.SECRET_KEY.encode(), message, hashlib.sha256).digest()
+
+def _get_cached_auth(key:str):
+    """ Закэшированный результат аутентификации или None. Запись
+    принимается без запросов к базе, если версия пользователя не
+    менялась: её увеличивают сигналы сохранения и удаления пользователя
+    и токена, а также CustomUserQuerySet.update() """
+    cache = caches[AUTH_CACHE_ALIAS]
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    version, result = entry
+    if version != cache.get(_auth_version_key(result[0].pk)):
+        cache.delete(key)
+        return None
+    return result
+
+def _set_cached_auth(key:str, result:tuple) -> None:
+    cache = caches[AUTH_CACHE_ALIAS]
+    cache.set(key, (_auth_version(cache, result[0].pk), result))
+
+class CachedBasicAuthentication(BasicAuthentication):
+    """ Basic-аутентификация, которая проверяет пароль хешем
+    PBKDF2 только при первом запросе с этими учётными данными """
+
+    def authenticate_credentials(self, userid, password, request=None):
+        key = 'auth:basic:' + _credentials_key(userid, password).hex()
+        cached = _get_cached_auth(key)
+        if cached is not None:
+            return cached
+        user, auth = super().authenticate_credentials(userid, password, request)
+        _set_cached_auth(key, (user, auth))
+        return (user, auth)
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """ Аутентификация по токену с кэшированием
+    пары токен-пользователь """
+
+    def authenticate_credentials(self, key):
+        cache_key = 'auth:token:' + _credentials_key('', key).hex()
+        cached = _get_cached_auth(cache_key)
+        if cached is not None:
+            return cached
+        user, token = super().authenticate_credentials(key)
+        _set_cached_auth(cache_key, (user, token))
+        return (user, token)
@@ -0,0 +1,54 @@
+import base64
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from apps.users.authentication import (
+    AUTH_CACHE_ALIAS,
+    CachedBasicAuthentication,
+    CachedTokenAuthentication,
+)
+
+
+class Command(BaseCommand):
+    help = 'Замер стоимости аутентификации с кэшем и без него'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--misses', type=int, default=20)
+        parser.add_argument('--hits', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        username = 'bench_auth_' + uuid.uuid4().hex
+        user = get_user_model().objects.create_user(username, password='bench-auth-password')
+        try:
+            token = Token.objects.create(user=user)
+            factory = APIRequestFactory()
+            basic = 'Basic ' + base64.b64encode('{}:bench-auth-password'.format(username).encode()).decode()
+            cases = (
+                ('Basic', CachedBasicAuthentication(), basic),
+                ('Token', CachedTokenAuthentication(), 'Token ' + token.key),
+            )
+            for name, authentication, header in cases:
+                request = Request(factory.get('/', HTTP_AUTHORIZATION=header))
+                miss = self.measure(authentication, request, options['misses'], caches[AUTH_CACHE_ALIAS].clear)
+                hit = self.measure(authentication, request, options['hits'])
+                self.stdout.write('{}: промах {:.1f} мкс, попадание {:.1f} мкс'.format(name, miss, hit))
+        finally:
+            user.delete()
+
+    def measure(self, authentication, request, iterations:int, before=None) -> float:
+        """ Среднее время одной аутентификации в микросекундах """
+        total = 0.0
+        for _ in range(iterations):
+            if before is not None:
+                before()
+            started = time.perf_counter()
+            authentication.authenticate(request)
+            total += time.perf_counter() - started
+        return total / iterations * 10 ** 6
@@ -1,10 +1,29 @@
 from django.db import models
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager
 
+from .authentication import _invalidate_user
+
+
+class CustomUserQuerySet(models.QuerySet):
+    """ Выборка пользователей. Изменение через update() проходит
+    мимо сигналов, поэтому сбрасывает закэшированную аутентификацию
+    изменённых пользователей само """
+
+    def update(self, **kwargs):
+        pks = list(self.values_list('pk', flat=True))
+        updated = super().update(**kwargs)
+        for pk in pks:
+            _invalidate_user(pk)
+        return updated
+
+class CustomUserManager(UserManager.from_queryset(CustomUserQuerySet)):
+    """ Менеджер пользователей с выборкой CustomUserQuerySet """
 
 class CustomUser(AbstractUser):
     """ Пользователь """
     phone = models.CharField('Номер телефона', max_length=20)
 
+    objects = CustomUserManager()
+
     class Meta:
         db_table = 'custom_user'
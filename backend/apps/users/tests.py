@@ -1,3 +1,72 @@
+import base64
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.cache import caches
 from django.test import TestCase
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from .authentication import AUTH_CACHE_ALIAS, CachedBasicAuthentication, CachedTokenAuthentication
+
+
+class AuthenticationCacheTest(TestCase):
+    """ Закэшированная аутентификация перестаёт действовать после
+    выхода, смены пароля и блокировки пользователя, в том числе
+    сделанных через update() без сигналов """
+
+    def setUp(self):
+        caches[AUTH_CACHE_ALIAS].clear()
+        self.user = get_user_model().objects.create_user('user', password='old-password')
+        self.token = Token.objects.create(user=self.user)
+
+    def get(self, authorization):
+        return APIClient().get('/api/accounts/', HTTP_AUTHORIZATION=authorization).status_code
+
+    def basic(self, password):
+        return 'Basic ' + base64.b64encode('user:{}'.format(password).encode()).decode()
+
+    def test_hit(self):
+        """ Попадание в кэш обходится без запросов и хеширования пароля """
+        authentication = CachedBasicAuthentication()
+        authentication.authenticate_credentials('user', 'old-password')
+        with self.assertNumQueries(0):
+            user, auth = authentication.authenticate_credentials('user', 'old-password')
+        self.assertEqual(user.pk, self.user.pk)
+        authentication = CachedTokenAuthentication()
+        authentication.authenticate_credentials(self.token.key)
+        with self.assertNumQueries(0):
+            user, token = authentication.authenticate_credentials(self.token.key)
+        self.assertEqual(token, self.token)
+
+    def test_update(self):
+        """ Изменение пользователя через update() сбрасывает кэш """
+        authentication = CachedTokenAuthentication()
+        self.assertFalse(authentication.authenticate_credentials(self.token.key)[0].is_staff)
+        get_user_model().objects.filter(pk=self.user.pk).update(is_staff=True)
+        self.assertTrue(authentication.authenticate_credentials(self.token.key)[0].is_staff)
+        get_user_model().objects.bulk_update([get_user_model()(pk=self.user.pk, is_staff=False)], ['is_staff'])
+        self.assertFalse(authentication.authenticate_credentials(self.token.key)[0].is_staff)
+
+    def test_revoke(self):
+        token = 'Token ' + self.token.key
+        self.assertEqual(self.get(token), 200)
+        self.token.delete()
+        self.assertEqual(self.get(token), 401)
+
+    def test_password_change(self):
+        self.assertEqual(self.get(self.basic('old-password')), 200)
+        self.user.set_password('new-password')
+        self.user.save()
+        self.assertEqual(self.get(self.basic('old-password')), 401)
+        self.assertEqual(self.get(self.basic('new-password')), 200)
+        get_user_model().objects.filter(pk=self.user.pk).update(password=make_password('other-password'))
+        self.assertEqual(self.get(self.basic('new-password')), 401)
 
-# Create your tests here.
+    def test_deactivation(self):
+        token = 'Token ' + self.token.key
+        self.assertEqual(self.get(token), 200)
+        self.assertEqual(self.get(self.basic('old-password')), 200)
+        get_user_model().objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.get(token), 401)
+        self.assertEqual(self.get(self.basic('old-password')), 401)
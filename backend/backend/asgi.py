@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from django.conf import settings
+from apps.business.events import events_application
+
+
+async def application(scope, receive, send):
+    """ Поток событий изменения балансов обслуживается без обработчика
+    Django, чтобы ожидающие соединения не занимали потоки """
+    if scope['type'] == 'http' and scope['path'] == settings.EVENTS_PATH:
+        return await events_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -0,0 +1,105 @@
+import threading
+import time
+
+from apps.monitoring.metrics import registry, METRIC_LABELS
+
+METRIC_LABELS['db_pool_connections'] = ('alias', 'state')
+METRIC_LABELS['db_pool_events_total'] = ('alias', 'event')
+
+
+class PoolTimeout(Exception):
+    """ Соединение не освободилось за время ожидания """
+
+class ConnectionPool:
+    """ Пул соединений процесса с одной базой. Не более max_size соединений
+    одновременно выдано или простаивает. Соединения старше max_lifetime
+    закрываются, а простоявшие дольше health_check_after секунд перед
+    выдачей проверяются функцией check """
+
+    def __init__(self, alias:str, connect, check, max_size:int, timeout:float,
+                 max_lifetime:float, health_check_after:float):
+        self.alias = alias
+        self.connect = connect
+        self.check = check
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._created = {}
+
+    def acquire(self) -> object:
+        """ Соединение из пула; при исчерпании пула ожидание
+        не дольше timeout секунд """
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            self._event('timeout')
+            raise PoolTimeout('Нет свободных соединений с базой {} за {} с'.format(self.alias, self.timeout))
+        registry.observe('db_pool_wait_seconds', (self.alias,), time.monotonic() - started)
+        try:
+            connection = self._take_idle()
+            if connection is None:
+                connection = self.connect()
+                self._event('connect')
+                with self._lock:
+                    self._created[id(connection)] = time.monotonic()
+        except BaseException:
+            self._slots.release()
+            raise
+        self._report()
+        return connection
+
+    def release(self, connection:object, reusable:bool=True) -> None:
+        """ Возврат соединения в пул или его закрытие """
+        try:
+            if reusable:
+                with self._lock:
+                    self._idle.append((connection, time.monotonic()))
+            else:
+                self._discard(connection)
+        finally:
+            self._slots.release()
+            self._report()
+
+    def close_idle(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, released in idle:
+            self._discard(connection)
+        self._report()
+
+    def _take_idle(self) -> object:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                connection, released = self._idle.pop()
+                created = self._created.get(id(connection), 0)
+            now = time.monotonic()
+            if self.max_lifetime and now - created > self.max_lifetime:
+                self._discard(connection, 'expired')
+                continue
+            if now - released > self.health_check_after and not self.check(connection):
+                self._discard(connection, 'unhealthy')
+                continue
+            return connection
+
+    def _discard(self, connection:object, event:str='close') -> None:
+        with self._lock:
+            self._created.pop(id(connection), None)
+        self._event(event)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _event(self, event:str) -> None:
+        registry.inc('db_pool_events_total', (self.alias, event))
+
+    def _report(self) -> None:
+        with self._lock:
+            total, idle = len(self._created), len(self._idle)
+        registry.set('db_pool_connections', (self.alias, 'active'), total - idle)
+        registry.set('db_pool_connections', (self.alias, 'idle'), idle)
@@ -0,0 +1,80 @@
+import os
+import threading
+
+from django.db.backends.postgresql.base import DatabaseWrapper as PostgreSQLDatabaseWrapper
+from psycopg2 import OperationalError, extensions
+
+from ..pool import ConnectionPool, PoolTimeout
+
+POOL_DEFAULTS = {
+    'MAX_SIZE': 10,
+    'TIMEOUT': 5.0,
+    'MAX_LIFETIME': 1800.0,
+    'HEALTH_CHECK_AFTER': 30.0,
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _check(connection:object) -> bool:
+    """ Проверка соединения, простоявшего в пуле """
+    if connection.closed:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        return True
+    except Exception:
+        return False
+
+class DatabaseWrapper(PostgreSQLDatabaseWrapper):
+    """ PostgreSQL с пулом соединений процесса. Закрытие соединения
+    Django возвращает его в пул, поэтому CONN_MAX_AGE = 0 освобождает
+    соединение в конце запроса, не разрывая его. Параметры пула
+    задаются ключом POOL настроек базы """
+
+    def get_pool(self, conn_params:dict) -> ConnectionPool:
+        key = (self.alias, os.getpid())
+        pool = _pools.get(key)
+        if pool is not None:
+            return pool
+        with _pools_lock:
+            if key not in _pools:
+                options = dict(POOL_DEFAULTS, **self.settings_dict.get('POOL', {}))
+                _pools[key] = ConnectionPool(
+                    self.alias,
+                    lambda: super(DatabaseWrapper, self).get_new_connection(conn_params),
+                    _check,
+                    options['MAX_SIZE'],
+                    options['TIMEOUT'],
+                    options['MAX_LIFETIME'],
+                    options['HEALTH_CHECK_AFTER'],
+                )
+            return _pools[key]
+
+    def get_new_connection(self, conn_params):
+        try:
+            connection = self.get_pool(conn_params).acquire()
+        except PoolTimeout as error:
+            raise OperationalError(str(error))
+        if 'isolation_level' not in self.settings_dict['OPTIONS']:
+            self.isolation_level = connection.isolation_level
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        connection = self.connection
+        reusable = not connection.closed
+        if reusable:
+            status = connection.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                reusable = False
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except Exception:
+                    reusable = False
+        with self.wrap_database_errors:
+            _pools[self.alias, os.getpid()].release(connection, reusable)
@@ -0,0 +1,121 @@
+import gzip
+import zlib
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from rest_framework.permissions import SAFE_METHODS
+from django.utils.regex_helper import _lazy_re_compile
+
+from .routers import _pin_to_primary
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+accept_encoding_re = _lazy_re_compile(r'\s*([^\s;,]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?')
+
+
+def _accepted_encodings(header:str) -> dict:
+    """ Кодировки из Accept-Encoding с их весами """
+    encodings = {}
+    for item in header.split(','):
+        match = accept_encoding_re.match(item)
+        if match is None:
+            continue
+        try:
+            quality = float(match.group(2)) if match.group(2) else 1.0
+        except ValueError:
+            continue
+        encodings[match.group(1).lower()] = quality
+    return encodings
+
+def _choose_encoding(header:str) -> str:
+    """ Кодировка ответа: brotli, если она доступна и клиент
+    принимает её не с меньшим весом, чем gzip, иначе gzip """
+    encodings = _accepted_encodings(header)
+    wildcard = encodings.get('*', 0)
+    candidates = []
+    if brotli is not None:
+        candidates.append(('br', encodings.get('br', wildcard)))
+    candidates.append(('gzip', encodings.get('gzip', wildcard)))
+    encoding, quality = max(candidates, key=lambda item: item[1])
+    return encoding if quality > 0 else None
+
+def _compress(encoding:str, content:bytes) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(content, quality=settings.COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(content, compresslevel=settings.COMPRESSION_GZIP_LEVEL, mtime=0)
+
+def _compress_sequence(encoding:str, sequence):
+    """ Сжатие потокового ответа по частям """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+        for item in sequence:
+            data = compressor.process(item)
+            if data:
+                yield data
+        yield compressor.finish()
+        return
+    compressor = zlib.compressobj(settings.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+    for item in sequence:
+        data = compressor.compress(item)
+        if data:
+            yield data
+    yield compressor.flush()
+
+class CompressionMiddleware:
+    """ Сжатие ответов gzip или brotli по заголовку Accept-Encoding.
+    Ответы меньше COMPRESSION_MIN_SIZE байт и уже сжатые ответы
+    отдаются как есть """
+    streaming_types = ('text/csv', 'application/x-ndjson')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.min_size = settings.COMPRESSION_MIN_SIZE
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.has_header('Content-Encoding') or response.status_code == 304:
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = _choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            content_type = response.get('Content-Type', '').split(';')[0]
+            if content_type not in self.streaming_types:
+                return response
+            response.streaming_content = _compress_sequence(encoding, response.streaming_content)
+            del response['Content-Length']
+        else:
+            if len(response.content) < self.min_size:
+                return response
+            compressed = _compress(encoding, response.content)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
+
+class ReplicaPinMiddleware:
+    """ После успешного изменяющего запроса пользователь закрепляется
+    за основной базой, чтобы сразу видеть свои изменения """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if request.method in SAFE_METHODS or response.status_code >= 400:
+            return response
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            _pin_to_primary(user.pk)
+        return response
@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import random
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Реплика, выбранная для чтений текущего запроса, либо None
+_replica_reads = ContextVar('replica_reads', default=None)
+
+
+def _pick_replica():
+    """ Одна реплика на все чтения запроса, чтобы страница и число
+    строк читались с одним отставанием репликации """
+    replicas = settings.DATABASE_REPLICAS
+    return random.choice(replicas) if replicas else None
+
+@contextmanager
+def _use_replica():
+    """ Чтения внутри блока могут уйти на одну реплику """
+    token = _replica_reads.set(_pick_replica())
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+def _pin_key(user_pk:int) -> str:
+    return 'replica-pin:{}'.format(user_pk)
+
+def _pin_to_primary(user_pk:int) -> None:
+    """ Чтения пользователя идут на основную базу
+    в течение REPLICA_PIN_SECONDS после записи """
+    caches[settings.REPLICA_PIN_CACHE].set(_pin_key(user_pk), True, settings.REPLICA_PIN_SECONDS)
+
+def _is_pinned(user_pk:int) -> bool:
+    return caches[settings.REPLICA_PIN_CACHE].get(_pin_key(user_pk), False)
+
+class ReplicaRouter:
+    """ Чтения, для которых выбрана реплика, уходят на неё. Запись, чтения
+    внутри транзакции основной базы и все остальные чтения идут на
+    основную базу """
+
+    def db_for_read(self, model, **hints):
+        replica = _replica_reads.get()
+        if replica is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
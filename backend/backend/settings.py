@@ -12,6 +12,9 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 from datetime import timedelta
 from pathlib import Path
 import os
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -52,6 +55,7 @@ INSTALLED_APPS = [
 
     'apps.business',
     'apps.users',
+    'apps.monitoring',
 ]
 
 # __  __________  ___  __   _____      _____   ___  ____
@@ -60,6 +64,9 @@ INSTALLED_APPS = [
 # /_/  /_/___/____/____/____/___/ |__/|__/_/ |_/_/|_/___/
 
 MIDDLEWARE = [
+    'apps.monitoring.middleware.MetricsMiddleware',
+    'backend.middleware.CompressionMiddleware',
+    'backend.middleware.ReplicaPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -69,7 +76,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
-    'silk.middleware.SilkyMiddleware',
+    'apps.monitoring.middleware.SampledProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -103,17 +110,45 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 # / // / _  |
 # /____/____/
 
+# С DATABASE_POOL=1 соединения берутся из пула процесса: не более
+# DATABASE_POOL_MAX_SIZE соединений, каждое живёт не дольше
+# DATABASE_POOL_MAX_LIFETIME секунд и проверяется перед выдачей, если
+# простояло дольше DATABASE_POOL_HEALTH_CHECK_AFTER секунд
+DATABASE_POOL = os.environ.get('DATABASE_POOL', '0') == '1'
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'ENGINE': 'backend.db.postgresql' if DATABASE_POOL else 'django.db.backends.postgresql_psycopg2',
         'NAME': os.environ.get('POSTGRES_DB'),
         'USER': os.environ.get('POSTGRES_USER'),
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD'),
         'HOST': os.environ.get('POSTGRES_HOST'),
         'PORT': os.environ.get('POSTGRES_PORT'),
+        'POOL': {
+            'MAX_SIZE': int(os.environ.get('DATABASE_POOL_MAX_SIZE', '10')),
+            'TIMEOUT': float(os.environ.get('DATABASE_POOL_TIMEOUT', '5')),
+            'MAX_LIFETIME': float(os.environ.get('DATABASE_POOL_MAX_LIFETIME', '1800')),
+            'HEALTH_CHECK_AFTER': float(os.environ.get('DATABASE_POOL_HEALTH_CHECK_AFTER', '30')),
+        },
     }
 }
 
+# Реплики только для чтения: POSTGRES_REPLICA_HOSTS="host1:5432,host2"
+DATABASE_REPLICAS = []
+for index, address in enumerate(filter(None, os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(','))):
+    host, _, port = address.strip().partition(':')
+    alias = 'replica_{}'.format(index)
+    DATABASES[alias] = dict(DATABASES['default'], HOST=host, PORT=port or DATABASES['default']['PORT'],
+                            TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['backend.routers.ReplicaRouter']
+
+# После записи чтения пользователя идут на основную базу REPLICA_PIN_SECONDS
+# секунд. При заданных репликах REPLICA_PIN_CACHE должен быть общим кэшем
+REPLICA_PIN_SECONDS = float(os.environ.get('REPLICA_PIN_SECONDS', '5'))
+REPLICA_PIN_CACHE = os.environ.get('REPLICA_PIN_CACHE', 'default')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -167,8 +202,8 @@ AUTH_USER_MODEL = 'users.CustomUser'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.BasicAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'apps.users.authentication.CachedBasicAuthentication',
+        'apps.users.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -176,8 +211,113 @@ REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend'
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'backend.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=30),
-}
\ No newline at end of file
+}
+
+OPERATIONS_PAGE_SIZE = int(os.environ.get('OPERATIONS_PAGE_SIZE', '50'))
+OPERATIONS_MAX_PAGE_SIZE = int(os.environ.get('OPERATIONS_MAX_PAGE_SIZE', '500'))
+OPERATIONS_BATCH_MAX_SIZE = int(os.environ.get('OPERATIONS_BATCH_MAX_SIZE', '5000'))
+ACCOUNT_REQUESTS_CHUNK_SIZE = int(os.environ.get('ACCOUNT_REQUESTS_CHUNK_SIZE', '1000'))
+EXCHANGE_RATES_REFRESH_SECONDS = float(os.environ.get('EXCHANGE_RATES_REFRESH_SECONDS', '5'))
+STATEMENT_EXPORT_CHUNK_SIZE = int(os.environ.get('STATEMENT_EXPORT_CHUNK_SIZE', '2000'))
+STAFF_PAGE_SIZE = int(os.environ.get('STAFF_PAGE_SIZE', '50'))
+STAFF_MAX_PAGE_SIZE = int(os.environ.get('STAFF_MAX_PAGE_SIZE', '500'))
+# Выборки больше порога считаются по статистике планировщика
+ESTIMATED_COUNT_THRESHOLD = int(os.environ.get('ESTIMATED_COUNT_THRESHOLD', '10000'))
+# Ответы на запросы с заголовком Idempotency-Key хранятся IDEMPOTENCY_KEY_TTL
+# секунд. Повтор выполняющегося запроса ждёт IDEMPOTENCY_WAIT_SECONDS и получает 409,
+# а после IDEMPOTENCY_LEASE_SECONDS без ответа (упавший процесс) выполняется заново
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', str(24 * 60 * 60)))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '2'))
+IDEMPOTENCY_LEASE_SECONDS = float(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', '30'))
+IDEMPOTENCY_PURGE_BATCH_SIZE = int(os.environ.get('IDEMPOTENCY_PURGE_BATCH_SIZE', '5000'))
+
+# События изменения балансов отправляются ретранслятором relay_outbox в приёмник
+# OUTBOX_SINK. FileSink дописывает их в OUTBOX_FILE_PATH по строке JSON на событие
+OUTBOX_SINK = os.environ.get('OUTBOX_SINK', 'apps.business.outbox.FileSink')
+OUTBOX_FILE_PATH = os.environ.get('OUTBOX_FILE_PATH', os.path.join(tempfile.gettempdir(), 'bank-outbox.ndjson'))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '1000'))
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', '1'))
+
+# Поток событий изменения балансов /api/events/ (ASGI). С EVENTS_BACKEND = 'memory'
+# события доходят только до подписчиков процесса, изменившего баланс; при
+# нескольких процессах нужен 'postgresql' (NOTIFY в канал EVENTS_CHANNEL)
+EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND', 'memory')
+EVENTS_CHANNEL = 'balance_events'
+EVENTS_PATH = '/api/events/'
+EVENTS_KEEPALIVE_SECONDS = float(os.environ.get('EVENTS_KEEPALIVE_SECONDS', '15'))
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', '100'))
+
+# Результаты аутентификации кэшируются в AUTH_CACHE_BACKEND вместе с версией
+# пользователя; сброс версии при выходе или смене пароля должен доходить до
+# всех процессов, поэтому при WEB_CONCURRENCY > 1 нужен общий кэш
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', '60'))
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get('AUTH_CACHE_MAX_ENTRIES', '10000'))
+
+# Доля профилируемых запросов; персонал может включить профилирование
+# отдельного запроса заголовком PROFILING_FORCE_HEADER
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_FORCE_HEADER = 'X-Profile'
+PROFILING_BATCH_SIZE = 100
+PROFILING_FLUSH_INTERVAL = 2.0
+PROFILING_MAX_BUFFER = 10000
+
+# Метрики процессов сохраняются в общий каталог и суммируются при выдаче.
+# Без METRICS_TOKEN /metrics/ доступен только персоналу
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'bank-metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '10'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Сжатие ответов не меньше COMPRESSION_MIN_SIZE байт
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '5'))
+
+# Списки счетов пользователей кэшируются в ACCOUNTS_CACHE_BACKEND. По умолчанию
+# это LRU-кэш процесса; при WEB_CONCURRENCY > 1 нужен общий кэш, чтобы
+# инвалидация доходила до всех процессов
+ACCOUNTS_CACHE_TTL = int(os.environ.get('ACCOUNTS_CACHE_TTL', '300'))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'accounts': {
+        'BACKEND': os.environ.get('ACCOUNTS_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('ACCOUNTS_CACHE_LOCATION', 'accounts'),
+        'TIMEOUT': ACCOUNTS_CACHE_TTL,
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('ACCOUNTS_CACHE_MAX_ENTRIES', '10000')),
+        },
+    },
+    'auth': {
+        'BACKEND': os.environ.get('AUTH_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('AUTH_CACHE_LOCATION', 'auth'),
+        'TIMEOUT': AUTH_CACHE_TTL,
+        'OPTIONS': {
+            'MAX_ENTRIES': AUTH_CACHE_MAX_ENTRIES,
+        },
+    },
+}
+
+# Число рабочих процессов сервера. Кэши из SHARED_CACHES хранят версии,
+# сброс которых должен быть виден всем процессам, поэтому при нескольких
+# процессах они не могут быть кэшами процесса
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', '1'))
+SHARED_CACHES = ('accounts', 'auth')
+PROCESS_LOCAL_CACHE_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache',)
+
+if WEB_CONCURRENCY > 1:
+    for alias in SHARED_CACHES:
+        if CACHES[alias]['BACKEND'] in PROCESS_LOCAL_CACHE_BACKENDS:
+            raise ImproperlyConfigured(
+                'Кэш {!r} при WEB_CONCURRENCY > 1 должен быть общим для процессов'.format(alias))
+if DATABASE_REPLICAS and CACHES[REPLICA_PIN_CACHE]['BACKEND'] in PROCESS_LOCAL_CACHE_BACKENDS:
+    raise ImproperlyConfigured('При заданных репликах REPLICA_PIN_CACHE должен быть общим для процессов кэшем')
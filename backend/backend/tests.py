@@ -0,0 +1,174 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import skipUnless
+import gzip
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+import uuid
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from rest_framework.renderers import JSONRenderer
+
+from .db.pool import ConnectionPool, PoolTimeout
+from .middleware import CompressionMiddleware, brotli
+from .renderers import FastJSONRenderer, orjson
+
+
+class FastJSONRendererTest(SimpleTestCase):
+    """ FastJSONRenderer выдаёт те же байты, что и JSONRenderer """
+
+    def assertSameRender(self, data):
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    @skipUnless(orjson, 'Требуется orjson')
+    def test_types(self):
+        moscow = dt_timezone(timedelta(hours=3))
+        self.assertSameRender({
+            'amount': Decimal('10.50'),
+            'created': datetime(2022, 10, 1, 12, 30, 15, 123456, tzinfo=dt_timezone.utc),
+            'local': datetime(2022, 10, 1, 12, 30, 15, tzinfo=moscow),
+            'naive': datetime(2022, 10, 1, 12, 30, 15, 999),
+            'date': datetime(2022, 10, 1).date(),
+            'time': datetime(2022, 10, 1, 12, 30, 15, 500).time(),
+            'duration': timedelta(hours=1),
+            'id': uuid.UUID(int=1),
+            'text': 'Счёт №1\u2028',
+            'items': [1, 2.5, None, True, {'nested': 'значение'}],
+            1: 'non-string key',
+        })
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+class CompressionMiddlewareTest(SimpleTestCase):
+    """ Сжатие ответов по Accept-Encoding """
+
+    def process(self, response, accept_encoding='gzip, br'):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def test_negotiation(self):
+        content = b'{"value": "' + b'x' * 2000 + b'"}'
+        response = self.process(HttpResponse(content), 'gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(response.content), content)
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        response = self.process(HttpResponse(content), 'identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.content, content)
+
+    @skipUnless(brotli, 'Требуется brotli')
+    def test_brotli(self):
+        content = b'x' * 2000
+        response = self.process(HttpResponse(content), 'gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(brotli.decompress(response.content), content)
+        self.assertEqual(self.process(HttpResponse(content), 'gzip;q=1, br;q=0.5')['Content-Encoding'], 'gzip')
+
+    @override_settings(COMPRESSION_MIN_SIZE=1024)
+    def test_skipped(self):
+        response = self.process(HttpResponse(b'x' * 100))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, b'x' * 100)
+        response = self.process(StreamingHttpResponse([b'data: x\n\n'] * 100, content_type='text/event-stream'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(b''.join(response.streaming_content), b'data: x\n\n' * 100)
+        response = self.process(HttpResponse(b'x' * 2000, headers={'Content-Encoding': 'identity'}))
+        self.assertEqual(response.content, b'x' * 2000)
+
+    def test_export_stream(self):
+        rows = [b'1,2,3\n'] * 500
+        response = self.process(StreamingHttpResponse(rows, content_type='text/csv; charset=utf-8'), 'gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), b''.join(rows))
+
+class SharedCachesSettingsTest(SimpleTestCase):
+    """ При нескольких процессах кэши с версиями
+    должны быть общими для всех процессов """
+    shared = 'django.core.cache.backends.memcached.PyMemcacheCache'
+
+    def load_settings(self, **environ):
+        return subprocess.run([sys.executable, '-c', 'import backend.settings'], cwd=settings.BASE_DIR,
+                              env=dict(os.environ, **environ), capture_output=True, text=True)
+
+    def test_process_local(self):
+        result = self.load_settings(WEB_CONCURRENCY='2')
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('ImproperlyConfigured', result.stderr)
+        self.assertEqual(self.load_settings(WEB_CONCURRENCY='2', ACCOUNTS_CACHE_BACKEND=self.shared,
+                                            AUTH_CACHE_BACKEND=self.shared).returncode, 0)
+        self.assertEqual(self.load_settings(WEB_CONCURRENCY='1').returncode, 0)
+
+    def test_replica_pin(self):
+        result = self.load_settings(POSTGRES_REPLICA_HOSTS='replica')
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('REPLICA_PIN_CACHE', result.stderr)
+        self.assertEqual(self.load_settings(POSTGRES_REPLICA_HOSTS='replica', REPLICA_PIN_CACHE='accounts',
+                                            ACCOUNTS_CACHE_BACKEND=self.shared).returncode, 0)
+
+class ConnectionPoolTest(SimpleTestCase):
+    """ Пул выдаёт соединения повторно, ограничивает их число
+    и закрывает сломанные и устаревшие соединения """
+
+    def setUp(self):
+        self.connections = []
+
+    def connect(self):
+        self.connections.append(sqlite3.connect(':memory:', check_same_thread=False))
+        return self.connections[-1]
+
+    def check(self, connection):
+        try:
+            connection.execute('SELECT 1')
+        except sqlite3.Error:
+            return False
+        return True
+
+    def pool(self, **options):
+        options = dict({'max_size': 2, 'timeout': 0.05, 'max_lifetime': 0, 'health_check_after': 0}, **options)
+        return ConnectionPool('test', self.connect, self.check, **options)
+
+    def test_reuse(self):
+        pool = self.pool()
+        connection = pool.acquire()
+        pool.release(connection)
+        self.assertIs(pool.acquire(), connection)
+        other = pool.acquire()
+        self.assertIsNot(other, connection)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_timeout(self):
+        pool = self.pool(max_size=1)
+        connection = pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+        pool.release(connection)
+        self.assertIs(pool.acquire(), connection)
+
+    def test_broken(self):
+        pool = self.pool()
+        connection = pool.acquire()
+        pool.release(connection)
+        connection.close()
+        fresh = pool.acquire()
+        self.assertIsNot(fresh, connection)
+        self.assertTrue(self.check(fresh))
+        pool.release(fresh, reusable=False)
+        self.assertFalse(self.check(fresh))
+        self.assertIsNot(pool.acquire(), fresh)
+        self.assertEqual(len(self.connections), 3)
+
+    def test_lifetime(self):
+        pool = self.pool(max_lifetime=0.01)
+        connection = pool.acquire()
+        pool.release(connection)
+        time.sleep(0.02)
+        self.assertIsNot(pool.acquire(), connection)
+        self.assertFalse(self.check(connection))
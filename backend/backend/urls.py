@@ -25,4 +25,5 @@ urlpatterns = [
     path('auth/', include('djoser.urls.authtoken')),
     path('api/users/', include('apps.users.urls')),
     path('api/', include('apps.business.urls')),
+    path('', include('apps.monitoring.urls')),
 ]